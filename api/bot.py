@@ -1,18 +1,26 @@
 import os
 import time
-import nltk
-import json
-import random
-import requests
+import logging
+import threading
 
 from api.chat import ChatAPI
+from api.search import SearchAPI
 from api.shazam import ShazamAPI
-from api.twitch import TwitchAPI
-
-from utils.models import Memory, Message
+from api.shared import SharedServices
+from api.twitch import TwitchChannel
+from api.reaction import ReactionScheduler
+
+from utils import metrics
+from utils.cache import TTLCache
+from utils.singleflight import SingleFlight
+from utils.journal import MemoryJournal
+from utils.models import Channel, Memory, Message
 from utils.pubsub import PubSub, PubEvents
 from utils.functions import check_banned_words
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from twitchAPI.chat import WhisperEvent, ChatUser
 
 BOT_FUNCTIONS = [
@@ -50,41 +58,81 @@ BOT_FUNCTIONS = [
 class BotAPI:
     pubsub: PubSub
     memory: Memory
-    twitch_api: TwitchAPI
+    journal: MemoryJournal
+    channel: Channel
+    twitch_api: TwitchChannel
     chat_api: ChatAPI
     shazam_api: ShazamAPI
+    search_api: SearchAPI
+    reaction_scheduler: ReactionScheduler
+
+    logger = logging.getLogger("bot_api")
 
     # Strings
     command_help: str = ""
-    react_string: str = ""
 
     # Bot state
     message_count: int = 0
-    processed_segment_starts: list = []
     ignored_message_threshold: int = 50
     length_message_threshold: int = 50
 
+    # Stream responses to the chat sentence by sentence
+    stream_responses: bool = True
+    max_message_length: int = 500
+
+    # Number of responses that are generated at the same time
+    max_concurrent_responses: int = 4
 
-    def __init__(self, pubsub: PubSub, memory: Memory):
+    # Seconds a recognized song and a failed recognition are reused, a track change clears both
+    song_ttl: float = 600
+    no_match_ttl: float = 30
+
+
+    def __init__(self, pubsub: PubSub, memory: Memory, journal: MemoryJournal, channel: Channel, shared: SharedServices, spill_dir: str = None):
         self.pubsub = pubsub
         self.memory = memory
+        self.journal = journal
+        self.channel = channel
+
+        # Start times of the transcript segments already responded to
+        self.processed_segment_starts: list = []
+
+        # Responses run on a worker pool, queued per user to keep their order
+        self.response_pool = ThreadPoolExecutor(max_workers=self.max_concurrent_responses, thread_name_prefix="bot_response")
+        self.response_queues: dict = {}  # Dict[str, deque]
+        self.response_lock = threading.Lock()
+
+        # Song recognitions are shared by everyone asking at the same time and reused until the track changes
+        self.song_cache = TTLCache(max_entries=1, ttl=self.song_ttl)
+        self.song_flight = SingleFlight("song")
 
         # Set the first reaction time to 5 minutes from now
         self.memory.reaction_time = time.time() + 300
+        self.journal.record("set", "reaction_time", self.memory.reaction_time)
 
-        # Initialize APIs
-        self.twitch_api = TwitchAPI(self.pubsub)
-        self.chat_api = ChatAPI(self.pubsub, self.memory)
+        # Initialize APIs, the connections are shared with the bots of the other channels
+        self.twitch_api = shared.twitch_api.join(self.channel, self.pubsub)
+        self.chat_api = ChatAPI(self.pubsub, self.memory, self.journal, self.channel, shared, spill_dir)
         self.shazam_api = ShazamAPI(self.pubsub)
+        self.search_api = shared.search_api
+
+        # Reactions are prepared and posted on their own timer
+        self.reaction_scheduler = ReactionScheduler(self.pubsub, self.memory, self.journal, self.chat_api, self.twitch_api, self.moderation)
+        self.reaction_scheduler.start()
 
         # Subscribe to events
         self.pubsub.subscribe(PubEvents.CHAT_MESSAGE, self.process_message)
         self.pubsub.subscribe(PubEvents.WHISPER_MESSAGE, self.handle_command)
         self.pubsub.subscribe(PubEvents.TRANSCRIPT, self.check_verbal_mention)
-        self.pubsub.subscribe(PubEvents.BOT_FUNCTION, self.bot_functions_callback)
+        self.pubsub.subscribe(PubEvents.TRACK_CHANGE, self.song_cache.clear)
+        self.pubsub.subscribe(PubEvents.SHUTDOWN, self.shutdown)
 
         # Set bot functions 
-        self.chat_api.add_functions(BOT_FUNCTIONS) 
+        self.chat_api.add_functions(
+            BOT_FUNCTIONS,
+            handlers={"recognize_song": self.recognize_song_tool, "google_search": self.google_search_tool},
+            direct=["recognize_song"]
+        )
 
         # Setup strings 
         self.setup_strings()
@@ -92,8 +140,7 @@ class BotAPI:
 
     # Setup constant strings
     def setup_strings(self):
-        self.command_help = f"Must be {os.environ['target_channel']} or a Mod. Commands: timeout [username] [seconds] | reset [username] | cooldown [minutes] | ban [username] | unban [username] | slowmode [seconds] | banword [word] | unbanword [word]"
-        self.react_string = f"Respond or react to the most recent thing {os.environ['target_channel']} said based only on the last couple of sentences in the audio transcript and (if provided) the image for context."
+        self.command_help = f"Must be {self.channel.name} or a Mod. Commands: timeout [username] [seconds] | reset [username] | cooldown [minutes] | ban [username] | unban [username] | slowmode [seconds] | banword [word] | unbanword [word]"
 
 
     # Process messages received from the Twitch API
@@ -106,18 +153,14 @@ class BotAPI:
             return
 
         if self.mentioned(username, message) and self.moderation(username):
-            self.send_response(chat_message)
+            self.queue_response(chat_message)
             if self.memory.slow_mode_seconds > 0:
                 time.sleep(self.memory.slow_mode_seconds)
 
-        elif self.react() and self.moderation():
-            chat_message.text = self.react_string
-            self.send_response(chat_message, react=True)
-            self.memory.reaction_time = time.time() + random.randint(600, 900)  # 10-15 minutes
-
         elif self.engage(message) and self.moderation(username):
-            chat_message.text = f"@{os.environ['target_channel']} {message}"
-            self.send_response(chat_message)
+            chat_message.text = f"@{self.channel.name} {message}"
+            self.message_count = 0
+            self.queue_response(chat_message)
             if self.memory.slow_mode_seconds > 0:
                 time.sleep(self.memory.slow_mode_seconds)
 
@@ -125,9 +168,59 @@ class BotAPI:
             self.message_count += 1
 
 
+    # Queue a response on the worker pool, responses to the same user are sent in order
+    def queue_response(self, chat_message: Message, **kwargs):
+        username = chat_message.username
+
+        with self.response_lock:
+            # A worker is already sending responses to this user
+            busy = username in self.response_queues
+            if busy:
+                self.response_queues[username].append((chat_message, kwargs))
+            else:
+                self.response_queues[username] = deque([(chat_message, kwargs)])
+
+        metrics.set_gauge(f"bot.{self.channel.name.lower()}.pending_responses", self.get_pending_responses())
+
+        if not busy:
+            self.response_pool.submit(self.process_response_queue, username)
+
+
+    # Send the queued responses of a user one after another
+    def process_response_queue(self, username: str):
+        while True:
+            with self.response_lock:
+                queue = self.response_queues[username]
+
+                # Nothing left to send
+                if not queue:
+                    del self.response_queues[username]
+                    return
+
+                chat_message, kwargs = queue.popleft()
+
+            metrics.set_gauge(f"bot.{self.channel.name.lower()}.pending_responses", self.get_pending_responses())
+
+            try:
+                self.send_response(chat_message, **kwargs)
+            except Exception as e:
+                self.logger.error(f"Failed to send response to {username}: {e}")
+
+
+    # Get the number of responses waiting to be sent
+    def get_pending_responses(self) -> int:
+        with self.response_lock:
+            return sum(len(queue) for queue in self.response_queues.values())
+
+
+    # Stop the response workers
+    def shutdown(self):
+        self.response_pool.shutdown(wait=False, cancel_futures=True)
+
+
     # Check if the user has the privilege to use special commands
     def has_priviege(self, user: ChatUser) -> bool:
-        return user.mod or user.name == os.environ["target_channel"].lower() or user.name == os.environ["admin_username"].lower()    
+        return user.mod or user.name == self.channel.name.lower() or user.name == os.environ["admin_username"].lower()    
 
 
     # Send the intro message
@@ -151,6 +244,7 @@ class BotAPI:
             return False
         if username in self.memory.timed_out_users:
             del self.memory.timed_out_users[username]  # remove if time is up
+            self.journal.record("delete", "timed_out_users", key=username)
         return True
 
 
@@ -164,13 +258,8 @@ class BotAPI:
         return self.message_count > self.ignored_message_threshold and len(message) > self.length_message_threshold
 
 
-    # Check if the bot should react
-    def react(self) -> bool:
-        return time.time() > self.memory.reaction_time
-
-
     # Send a response to the chat
-    def send_response(self, chat_message: Message, react: bool = False, respond: bool = False):
+    def send_response(self, chat_message: Message, respond: bool = False):
         bot_response = None
         username = chat_message.username
         message = chat_message.text
@@ -180,12 +269,11 @@ class BotAPI:
         if found:
             bot_response = f"@{username} Ignored message containing banned word: '{found}'"
         
-        elif react:
-            chat_message.username = os.environ["target_channel"]
-            ai_response = self.chat_api.get_ai_response_with_image(chat_message)
-            if ai_response:
-                bot_response = f"{ai_response}"
-                self.chat_api.clear_user_conversation(username)
+        elif self.stream_responses:
+            if self.send_streamed_response(chat_message):
+                self.message_count = 0
+                if respond:
+                    self.chat_api.clear_user_conversation(username)
 
         elif respond:
             ai_response = self.chat_api.get_ai_response(chat_message)
@@ -203,6 +291,33 @@ class BotAPI:
             self.message_count = 0
 
 
+    # Stream the AI response to the chat, the first sentence is sent as soon as it is complete
+    def send_streamed_response(self, chat_message: Message) -> bool:
+        prefix = f"@{chat_message.username}"
+        pending = ""
+        sent = False
+
+        for sentence in self.chat_api.get_ai_response_stream(chat_message):
+            # Send the first sentence right away
+            if not sent:
+                self.twitch_api.send_message(f"{prefix} {sentence}")
+                sent = True
+
+            # Flush the pending sentences if the next one would not fit in the same message
+            elif pending and len(f"{prefix} {pending} {sentence}") > self.max_message_length:
+                self.twitch_api.send_message(f"{prefix} {pending}")
+                pending = sentence
+
+            else:
+                pending = f"{pending} {sentence}".strip()
+
+        # Send the rest of the response
+        if pending:
+            self.twitch_api.send_message(f"{prefix} {pending}")
+
+        return sent
+
+
     # Callback for when the transcript is received
     def check_verbal_mention(self, transcript: list):
         # filter out already reacted segments by start time
@@ -211,11 +326,12 @@ class BotAPI:
         # loop through the transcript except the last segment
         for segment in transcript[:-1]:
             # check if the bot was mentioned
-            if self.mentioned(os.environ["target_channel"], segment['text']):
+            if self.mentioned(self.channel.name, segment['text']):
                 # get the transcript text
                 transcript_text = "".join([segment['text'] for segment in transcript])
 
-                # extract the sentences from the transcript
+                # extract the sentences from the transcript, nltk is only loaded once the streamer mentions the bot
+                import nltk
                 try:
                     sentences = nltk.sent_tokenize(transcript_text)
                 except LookupError:
@@ -223,7 +339,7 @@ class BotAPI:
                     sentences = nltk.sent_tokenize(transcript_text)
                 
                 # get the sentences that mention the bot
-                mentioned_sentences = [sentence for sentence in sentences if self.mentioned(os.environ["target_channel"], sentence)]
+                mentioned_sentences = [sentence for sentence in sentences if self.mentioned(self.channel.name, sentence)]
 
                 # add the sentence before and after the mentioned sentence
                 react_sentences = []
@@ -232,13 +348,13 @@ class BotAPI:
                     react_sentences.append(f"{sentences[index-1]} {sentence} {sentences[index+1]}")
 
                 # create the message
-                message = f"{os.environ['target_channel']} talked to/about you ({os.environ['bot_username']}) in the following sentences {react_sentences}. Try to only respond/react to what they said to/about you."        
+                message = f"{self.channel.name} talked to/about you ({os.environ['bot_username']}) in the following sentences {react_sentences}. Try to only respond/react to what they said to/about you."        
 
                 # create a placeholder chat message 
-                chat_message = Message(os.environ["target_channel"], message)
+                chat_message = Message(self.channel.name, message)
 
-                # send a response to the chat
-                self.send_response(chat_message, respond=True)
+                # send a response to the chat from the response workers, the transcript publisher is never held up by the request
+                self.queue_response(chat_message, respond=True)
                 
                 # add the start time to the processed list
                 self.processed_segment_starts.append(segment['start'])
@@ -247,36 +363,34 @@ class BotAPI:
                 break
 
 
-    # Callback for when the ai calls a function
-    def bot_functions_callback(self, function_name: str, arguments: str, chat_message: Message):
-        # Parse the arguments
-        args = json.loads(arguments)
-
-        if function_name == "recognize_song":
-            # Inform the user that the bot is listening
+    # Tool handler for when the ai wants to recognize the song, the result is sent as the response
+    def recognize_song_tool(self, chat_message: Message) -> str:
+        # Inform the user that the bot is listening
+        if self.song_cache.get("song") is None:
             self.twitch_api.send_message(f"@{chat_message.username} I'm listening... give me ~10 seconds") 
-            
-            # Recognize the song and get the result
-            result = self.recognize_song()
 
-            # Send the result to the chat
-            self.twitch_api.send_message(f"@{chat_message.username} {result}")
-        
-        elif function_name == "google_search":
-            # Search the web using Google
-            query = args["query"]
-            results = self.search_google(query)
+        # Recognize the song and get the result
+        return self.recognize_song()
 
-            # Get a response with the search results
-            message = f"{chat_message.text}. The google search results are: {results}"
-            response = self.chat_api.get_ai_response(Message(chat_message.username, message), with_tools=False)
 
-            # Send the response to the chat
-            self.twitch_api.send_message(f"@{chat_message.username} {response}")
-    
+    # Tool handler for when the ai wants to search the web, the snippets are given back to the ai
+    def google_search_tool(self, chat_message: Message, query: str) -> str:
+        results = self.search_api.search(query)
+        return f"The google search results are: {results}"
+
 
-    # Recognize the song currently playing in the stream
+    # Recognize the song currently playing in the stream, from the cache or by joining a recognition in flight
     def recognize_song(self):
+        result = self.song_cache.get("song")
+        if result is not None:
+            metrics.increment("song.cache_hits")
+            return result
+
+        return self.song_flight.do("song", self.detect_song)
+
+
+    # Record the stream and recognize the song
+    def detect_song(self):
         # Pause transcription for resource optimization
         self.pubsub.publish(PubEvents.PAUSE_TRANSCRIPTION)
 
@@ -290,23 +404,15 @@ class BotAPI:
         if result == "Error":
             return "I encountered an error while trying to detect the song"
         elif result == "No matches found":
-            return "I couldn't recognize the song"
+            result = "I couldn't recognize the song"
+            self.song_cache.set("song", result, ttl=self.no_match_ttl)
+            return result
         else:
-            return f"I think the song playing is {result}"
+            result = f"I think the song playing is {result}"
+            self.song_cache.set("song", result)
+            return result
         
 
-    # Search the web using Google
-    def search_google(self, query: str):
-        url = f"https://www.googleapis.com/customsearch/v1?q={query}&key={os.environ['google_api_key']}&cx={os.environ['google_cse_id']}&start=1"
-        response = requests.get(url)
-        data = response.json()
-
-        # Extract snippets from the search results
-        snippets = [item.get("snippet", "") for item in data.get("items", [])]
-
-        return snippets
-
-
     # Handles commands sent to the bot
     def handle_command(self, whisper: WhisperEvent) -> None:
         command_not_found: bool = False
@@ -328,6 +434,7 @@ class BotAPI:
             username: str = input.split(" ")[1]
             self.chat_api.clear_user_conversation(username)
             self.memory.banned_users.append(username)
+            self.journal.record("add", "banned_users", username)
             self.twitch_api.send_message(f"{username} will be ignored.")
 
         # unban <username> - unbans the user
@@ -335,6 +442,7 @@ class BotAPI:
             username: str = input.split(" ")[1].lower()
             if username in self.memory.banned_users:
                 self.memory.banned_users.remove(username)
+                self.journal.record("remove", "banned_users", username)
                 self.twitch_api.send_message(f"{username} will no longer be ignored.")
 
         # timeout <username> <duration in seconds> - times out the bot for the given user
@@ -343,6 +451,7 @@ class BotAPI:
             duration: int = int(input.split(" ")[2])
             out_time: float = time.time() + int(duration)
             self.memory.timed_out_users[username] = out_time
+            self.journal.record("put", "timed_out_users", out_time, key=username)
             self.chat_api.clear_user_conversation(username)
             self.twitch_api.send_message(f"{username} will be ignored for {duration} seconds.")
 
@@ -350,18 +459,21 @@ class BotAPI:
         elif input.startswith("cooldown "):
             out_time: float = float(input.split(" ")[1])
             self.memory.cooldown_time = time.time() + float(out_time * 60)
+            self.journal.record("set", "cooldown_time", self.memory.cooldown_time)
             self.twitch_api.send_message(f"Going in Cooldown for {out_time} minutes!")
 
         # slowmode <duration in seconds> - sets the slow mode for the bot
         elif input.startswith("slowmode "):
             sleep_time: int = int(input.split(" ")[1])
             self.memory.slow_mode_seconds = sleep_time
+            self.journal.record("set", "slow_mode_seconds", sleep_time)
             self.twitch_api.send_message(f"Slow mode set to {sleep_time} seconds!")
 
         # banword <word> - ignores messages containing the given word
         elif input.startswith("banword "):
             word = input.split(" ", 1)[1]
             self.memory.banned_words.append(word)
+            self.journal.record("add", "banned_words", word)
             self.twitch_api.send_message(f"'{word}' added to banned words.")
 
         # unbanword <word> - removes the given word from the banned words
@@ -369,6 +481,7 @@ class BotAPI:
             word = input.split(" ", 1)[1]
             if word in self.memory.banned_words:
                 self.memory.banned_words.remove(word)
+                self.journal.record("remove", "banned_words", word)
             self.twitch_api.send_message(f"'{word}' removed from banned words.")
 
         # op <message> - sends a message as the operator
@@ -397,9 +510,7 @@ class BotAPI:
 
         # react - manually trigger a reaction
         elif input == ("react"):   
-            chat_message = Message(username=os.environ["target_channel"], text=self.react_string)
-            self.send_response(chat_message, react=True)
-            self.memory.reaction_time = time.time() + random.randint(300, 600)
+            self.reaction_scheduler.react_now()
 
         # exit - shuts down the bot
         elif input == ("exit"):
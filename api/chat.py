@@ -1,27 +1,77 @@
 import os
+import json
+import time
+import queue
+import zlib
+import asyncio
 import logging
 
-from typing import List
-from openai import OpenAI
+from collections import deque
+from typing import TYPE_CHECKING, Callable, Dict, List, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 from api.image import ImageAPI
 
-from utils.models import Memory, Message
+from utils import metrics
+from utils.models import Channel, Memory, Message
+from utils.journal import MemoryJournal
+from utils.async_loop import AsyncLoop
+from utils.context import ContextBuilder
+from utils.conversation import ConversationStore
+from utils.response_cache import ResponseCache
+from utils.vision_cache import VisionCache, perceptual_hash
+from utils.router import MessageRouter, CHAT, VISION
 from utils.pubsub import PubSub, PubEvents
-from utils.functions import clean_message, clean_conversation
+from utils.sanitizer import get_sanitizer
+from utils.quality import MINIMAL
+from utils.functions import clean_message, split_sentences
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+    from api.shared import SharedServices
 
 class ChatAPI:
     pubsub: PubSub
     memory: Memory
-    openai_api: OpenAI
+    channel: Channel
+    openai_api: "AsyncOpenAI"
     image_api: ImageAPI
+    loop: AsyncLoop
+    context_builder: ContextBuilder
+    conversations: ConversationStore
+    response_cache: ResponseCache
+    router: MessageRouter
+    vision_cache: VisionCache
     system_prompt: str
 
     logger = logging.getLogger("chat_api")
 
     audio_transcript: str = ""
+    transcript_segments: list = []
     twitch_chat_history: List[str] = []
 
+    # Models of the chat responses and of the screenshots
+    chat_model: str = "gpt-3.5-turbo"
+    vision_model: str = "gpt-4-vision-preview"
+
+    # Request settings, the connections and concurrent requests are shared by all channels
+    request_timeout: float = 30
+    max_concurrent_requests: int = 4
+    max_connections: int = 10
+    hedge_percentile: float = 0.95
+    hedge_min_samples: int = 20
+    latency_samples: int = 200
+
+    # Number of tool calls of a response that run at the same time
+    max_concurrent_tools: int = 4
+
+    # Cached responses depend on the last transcript segments, the last screenshot and the time bucket they were given in
+    fingerprint_segments: int = 2
+    fingerprint_bucket_seconds: float = 120
+
+    # Prompt used to describe new scenes for the vision cache
+    scene_prompt: str = "Describe what is shown in this screenshot of a twitch stream in two short sentences."
+
     # Define the functions that the AI can call
     functions = [
         {
@@ -38,20 +88,62 @@ class ChatAPI:
         }
     ]
 
-    def __init__(self, pubsub: PubSub, memory: Memory):
+    def __init__(self, pubsub: PubSub, memory: Memory, journal: MemoryJournal, channel: Channel, shared: "SharedServices", spill_dir: str = None):
         self.pubsub = pubsub
         self.memory = memory
-        self.openai_api = OpenAI(api_key=os.environ["openai_api_key"])
+        self.channel = channel
         self.image_api = ImageAPI(pubsub)
+        self.context_builder = ContextBuilder()
+        self.conversations = ConversationStore(memory, journal, spill_dir)
+        self.response_cache = ResponseCache()
+        self.router = MessageRouter()
+        self.vision_cache = VisionCache()
+
+        # Functions of this bot, added functions are not shared with the bots of other channels
+        self.functions = list(self.functions)
+
+        # Tool lists by route
+        self.route_tools: Dict[str, list] = {}
+
+        # Tools run on their own workers, the handlers of the added functions are called with the chat message and the arguments
+        self.tool_pool = ThreadPoolExecutor(max_workers=self.max_concurrent_tools, thread_name_prefix="chat_tool")
+        self.tool_handlers: Dict[str, Callable[..., str]] = {}
+        self.direct_tools: set = set()
+
+        # Screenshots are turned off on the lowest quality tier
+        self.vision_enabled = True
+
+        # Frame hash of the last screenshot
+        self.scene_hash = 0
+
+        # Connection pool, event loop and request limit shared by all channels
+        self.openai_api = shared.openai_api
+        self.loop = shared.loop
+        self.request_semaphore = shared.request_semaphore
+
+        # Request state, only used from the event loop
+        # Latencies are kept by model and by whether the response is streamed, a stream is timed until it opens
+        self.user_locks: Dict[str, asyncio.Lock] = {}
+        self.latencies: Dict[Tuple[str, bool], deque] = {}
 
         # Subscribe to events
+        self.pubsub.subscribe(PubEvents.SHUTDOWN, self.shutdown)
         self.pubsub.subscribe(PubEvents.TRANSCRIPT, self.update_transcript)
         self.pubsub.subscribe(PubEvents.CHAT_HISTORY, self.update_twitch_chat_history)
+        self.pubsub.subscribe(PubEvents.QUALITY_TIER, self.set_quality_tier)
 
         # Set the system prompt
         self.system_prompt = f"You are an AI twitch bot, you can hear the stream through the given audio captions and you can see the stream through the given screenshot (if not mentioned just use them as context). You can also identify songs by using the shazam API and search the web using the google API. You were created by the user {os.environ['admin_username']}. Keep your messages short and under 20 words. Be non verbose, sweet and sometimes funny. For context some information about the stream are given between the two <<context>> <</context>> delimiters with each message."
 
 
+    # Callback for the quality tier event
+    def set_quality_tier(self, tier: int):
+        vision_enabled = tier < MINIMAL
+        if vision_enabled != self.vision_enabled:
+            self.vision_enabled = vision_enabled
+            self.route_tools.clear()
+
+
     # Callback for the chat history event
     def update_twitch_chat_history(self, chat_history: List[str]):
         self.twitch_chat_history = chat_history
@@ -67,24 +159,53 @@ class ChatAPI:
 
         # Update the transcript
         self.audio_transcript = transcript_text
+        self.transcript_segments = transcript
 
 
     # Get a response from the AI
     def get_ai_response(self, chat_message: Message, with_tools=True):
+        try:
+            response_text, tool_calls = self.loop.submit(self.get_ai_response_async(chat_message, with_tools), wait=True)
+
+        # Log any errors
+        except Exception as error:
+            self.logger.error(f"Error getting AI response: {error}")
+            return None
+
+        # Check if the response contains function calls
+        if tool_calls:
+            return self.handle_tool_calls(tool_calls, chat_message)
+
+        return response_text
+
+
+    # Get a response from the AI on the event loop, returns the response text and the requested tool calls
+    async def get_ai_response_async(self, chat_message: Message, with_tools=True):
         username = chat_message.username
 
-        # Add the user message to the conversation
-        self.create_user_message(chat_message, with_twitch_chat=True, with_audio_transcript=True, with_image=False)
+        # Only one request per user at a time so the conversation is never mutated concurrently
+        async with self.get_user_lock(username):
+            # Add the user message to the conversation
+            self.create_user_message(chat_message, with_twitch_chat=True, with_audio_transcript=True)
+
+            # Answer repeated questions from the cache
+            fingerprint = self.get_context_fingerprint()
+            if with_tools and (cached_response := self.get_cached_response(chat_message, fingerprint)):
+                return cached_response, None
+
+            # Only offer the tools the message may need
+            route, tool_options = self.get_tool_options(chat_message, with_tools)
 
-        try:
             # Get a response from the AI with the users conversation
-            response = self.openai_api.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=self.memory.conversations[username],
+            start = time.perf_counter()
+            response = await self.create_completion(
+                model=self.chat_model,
+                messages=self.conversations.get_messages(username),
                 max_tokens=300,
-                tools=self.functions,
-                tool_choice="auto" if with_tools else "none"
+                **tool_options
             )
+            self.router.record_latency(route, time.perf_counter() - start)
+            self.record_prompt_usage(response.usage)
 
             # Get the first choice
             choice = response.choices[0]
@@ -93,74 +214,430 @@ class ChatAPI:
 
             # Check if the response contains a function call
             if choice.message.tool_calls:
-                self.handle_function_call(choice.message.tool_calls[0].function.name, choice.message.tool_calls[0].function.arguments, chat_message)
+                tool_calls = [{"id": call.id, "name": call.function.name, "arguments": call.function.arguments} for call in choice.message.tool_calls]
+                return None, tool_calls
 
             # Check if the response contains a message
-            elif choice.message.content:
+            if choice.message.content:
                 response_text = clean_message(choice.message.content, username, choice.finish_reason, os.environ["bot_username"])
-            
+
                 # Add the response to the conversation
                 self.add_response_to_conversation(username, response_text)
 
+                # Cache the response for similar questions
+                if with_tools:
+                    self.response_cache.set(chat_message.text, chat_message.username, fingerprint, response_text)
+
                 # Return the response text
-                return response_text
-        
-        # Log any errors
+                return response_text, None
+
+            return None, None
+
+
+    # Stream a response from the AI, yielding cleaned sentences as soon as they are complete
+    def get_ai_response_stream(self, chat_message: Message, with_tools=True) -> Iterator[str]:
+        sentences = queue.Queue()
+
+        # The event loop produces the sentences, the calling thread consumes them
+        future = self.loop.submit(self.stream_ai_response(chat_message, with_tools, sentences))
+
+        while (sentence := sentences.get()) is not None:
+            yield sentence
+
+        try:
+            tool_calls = future.result()
         except Exception as error:
-            self.logger.error(f"Error getting AI response: {error}")
+            self.logger.error(f"Error streaming AI response: {error}")
+            return
+
+        # Check if the response contains function calls
+        if tool_calls:
+            response_text = self.handle_tool_calls(tool_calls, chat_message)
+            if response_text:
+                yield response_text
+
+
+    # Stream a response from the AI on the event loop into the sentences queue, returns the requested tool calls
+    async def stream_ai_response(self, chat_message: Message, with_tools: bool, sentences: queue.Queue):
+        username = chat_message.username
+
+        try:
+            async with self.get_user_lock(username):
+                # Add the user message to the conversation
+                self.create_user_message(chat_message, with_twitch_chat=True, with_audio_transcript=True)
+
+                # Answer repeated questions from the cache
+                fingerprint = self.get_context_fingerprint()
+                if with_tools and (cached_response := self.get_cached_response(chat_message, fingerprint)):
+                    sentences.put(cached_response)
+                    return None
+
+                # Only offer the tools the message may need
+                route, tool_options = self.get_tool_options(chat_message, with_tools)
+
+                # Get a streamed response from the AI with the users conversation
+                start = time.perf_counter()
+                stream = await self.create_completion(
+                    model=self.chat_model,
+                    messages=self.conversations.get_messages(username),
+                    max_tokens=300,
+                    stream=True,
+                    # The last chunk carries the token usage
+                    extra_body={"stream_options": {"include_usage": True}},
+                    **tool_options
+                )
+                self.router.record_latency(route, time.perf_counter() - start)
+
+                sanitizer = get_sanitizer(username, os.environ["bot_username"]).stream()
+                buffer = ""
+                quoted = None
+                response_sentences = []
+                tool_calls = {}
+                finish_reason = None
+
+                async with asyncio.timeout(self.request_timeout):
+                    async for chunk in stream:
+                        if not chunk.choices:
+                            self.record_prompt_usage(getattr(chunk, "usage", None))
+                            continue
+
+                        choice = chunk.choices[0]
+                        delta = choice.delta
+
+                        if choice.finish_reason:
+                            finish_reason = choice.finish_reason
+
+                        # Collect the tool call fragments, no text is sent once a tool call shows up
+                        if delta.tool_calls:
+                            for tool_call in delta.tool_calls:
+                                call = tool_calls.setdefault(tool_call.index, {"id": "", "name": "", "arguments": ""})
+                                if tool_call.id:
+                                    call["id"] = tool_call.id
+                                if tool_call.function.name:
+                                    call["name"] += tool_call.function.name
+                                if tool_call.function.arguments:
+                                    call["arguments"] += tool_call.function.arguments
+                            continue
+
+                        if tool_calls or not delta.content:
+                            continue
+
+                        # Clean the text as it arrives
+                        buffer += sanitizer.feed(delta.content)
+
+                        # Remember if the whole response is wrapped in quotes
+                        if quoted is None and buffer.strip():
+                            quoted = buffer.lstrip().startswith('"')
+                            buffer = buffer.lstrip().removeprefix('"')
+
+                        # Queue every sentence that is complete
+                        complete, buffer = split_sentences(buffer)
+                        for sentence in complete:
+                            sentence = sentence.strip()
+                            if sentence:
+                                response_sentences.append(sentence)
+                                sentences.put(sentence)
+
+                self.logger.debug(f"OpenAI streamed response finished: {finish_reason}")
+
+                # Check if the response contains a function call
+                if tool_calls:
+                    return [tool_calls[index] for index in sorted(tool_calls)]
+
+                # Queue the rest of the response
+                rest = (buffer + sanitizer.flush()).strip()
+                if quoted is None:
+                    rest = rest.removeprefix('"')
+                if quoted is not False:
+                    rest = rest.removesuffix('"')
+                if rest and finish_reason == "length":
+                    rest = f"{rest}..."
+                if rest:
+                    response_sentences.append(rest)
+                    sentences.put(rest)
+
+                # Add the response to the conversation and cache it for similar questions
+                if response_sentences:
+                    response_text = " ".join(response_sentences)
+                    self.add_response_to_conversation(username, response_text)
+                    if with_tools:
+                        self.response_cache.set(chat_message.text, chat_message.username, fingerprint, response_text)
+
+                return None
+
+        finally:
+            # Signal the end of the stream to the consumer
+            sentences.put(None)
+
+
+    # Get the response to a similar question in the same stream context and add it to the conversation
+    def get_cached_response(self, chat_message: Message, fingerprint: str) -> str | None:
+        response = self.response_cache.get(chat_message.text, chat_message.username, fingerprint, self.get_median_latency())
+        if response:
+            self.add_response_to_conversation(chat_message.username, response)
+
+        return response
+
+
+    # Fingerprint of the stream context that cached responses depend on, a new thing said or shown starts a new context
+    def get_context_fingerprint(self) -> str:
+        recent_text = " ".join(segment["text"] for segment in list(self.transcript_segments)[-self.fingerprint_segments:])
+        context = f"{self.channel.description}|{recent_text}|{self.scene_hash:016x}|{int(time.time() // self.fingerprint_bucket_seconds)}"
+        return f"{zlib.crc32(context.encode()):08x}"
+
+
+    # Get the recent latencies of the completions of a model, streamed or not
+    def get_latencies(self, model: str, stream: bool) -> deque:
+        if (model, stream) not in self.latencies:
+            self.latencies[(model, stream)] = deque(maxlen=self.latency_samples)
+        return self.latencies[(model, stream)]
+
+
+    # Get the median latency of the chat responses, the time until a streamed response opens if there are any
+    def get_median_latency(self) -> float:
+        latencies = self.get_latencies(self.chat_model, True) or self.get_latencies(self.chat_model, False)
+        latencies = sorted(latencies)
+        return latencies[len(latencies) // 2] if latencies else 0.0
+
+
+    # Get the lock that keeps the requests of a user in order
+    def get_user_lock(self, username: str) -> asyncio.Lock:
+        if username not in self.user_locks:
+            self.user_locks[username] = asyncio.Lock()
+        return self.user_locks[username]
+
+
+    # Create a completion with bounded concurrency and a timeout
+    async def create_completion(self, **kwargs):
+        latencies = self.get_latencies(kwargs["model"], bool(kwargs.get("stream")))
+
+        async with self.request_semaphore:
+            start = time.perf_counter()
+            response = await asyncio.wait_for(self.hedged_request(latencies, **kwargs), self.request_timeout)
+            latencies.append(time.perf_counter() - start)
+
+            if kwargs["model"] == self.chat_model:
+                metrics.set_gauge("chat.latency_s", self.get_median_latency())
+            return response
+
+
+    # Send a second identical request if the first one is slower than the hedge percentile of its kind, the first to finish wins
+    async def hedged_request(self, latencies: deque, **kwargs):
+        first = asyncio.ensure_future(self.openai_api.chat.completions.create(**kwargs))
+
+        # Vision requests are the most expensive ones and are never doubled, nor are requests without enough samples to know what slow is
+        hedge_delay = self.get_hedge_delay(latencies) if kwargs["model"] != self.vision_model else None
+        if hedge_delay is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        self.logger.info(f"Request slower than {hedge_delay:.2f}s, sending hedged request")
+        second = asyncio.ensure_future(self.openai_api.chat.completions.create(**kwargs))
+
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+    # Get the latency percentile after which a request is hedged
+    def get_hedge_delay(self, latencies: deque) -> float | None:
+        if len(latencies) < self.hedge_min_samples:
             return None
 
+        latencies = sorted(latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile))
+        return latencies[index]
+
+
+    # Shutdown the tool workers, the event loop is stopped with the shared services
+    def shutdown(self):
+        self.tool_pool.shutdown(wait=False, cancel_futures=True)
+
+
+    # Record how much of the prompt was served from the provider prompt cache
+    def record_prompt_usage(self, usage):
+        if usage is None:
+            return
 
-    # Add a function to the list of functions
-    def add_functions(self, functions: list):
+        # Usage is a model on responses and a plain dict on stream chunks
+        def field(value, name):
+            return value.get(name) if isinstance(value, dict) else getattr(value, name, None)
+
+        prompt_tokens = field(usage, "prompt_tokens") or 0
+        details = field(usage, "prompt_tokens_details")
+        cached_tokens = (field(details, "cached_tokens") if details else None) or 0
+
+        metrics.increment("prompt_cache.prompt_tokens", prompt_tokens)
+        metrics.increment("prompt_cache.cached_tokens", cached_tokens)
+
+        total_prompt_tokens = metrics.get("prompt_cache.prompt_tokens")
+        metrics.set_gauge("prompt_cache.hit_rate", metrics.get("prompt_cache.cached_tokens") / total_prompt_tokens if total_prompt_tokens else 0.0)
+
+        self.logger.debug(f"Prompt tokens: {prompt_tokens}, cached: {cached_tokens}")
+
+
+    # Route the message and get the tool options of its completion, chit-chat gets no tools at all
+    def get_tool_options(self, chat_message: Message, with_tools: bool):
+        if not with_tools:
+            return None, {}
+
+        route = self.router.route(chat_message.text)
+        if route == CHAT:
+            return route, {}
+
+        return route, {"tools": self.get_route_tools(route), "tool_choice": "auto"}
+
+
+    # Get the tools of a route, the same list every time so the tool schemas stay a stable cacheable prefix
+    def get_route_tools(self, route: str) -> list:
+        if route not in self.route_tools:
+            # Screenshots are only offered when the message is about what is on screen and vision is enabled
+            tools = self.functions if route == VISION and self.vision_enabled else [tool for tool in self.functions if tool["function"]["name"] != "image_input"]
+            self.route_tools[route] = list(tools)
+
+        return self.route_tools[route]
+
+
+    # Add functions to the list of functions with their handlers, the result of a direct function is sent as is when it is the only call
+    def add_functions(self, functions: list, handlers: Dict[str, Callable[..., str]] = None, direct: list = ()):
         # Append functions to the list
         self.functions.extend(functions)
+        self.tool_handlers.update(handlers or {})
+        self.direct_tools.update(direct)
 
+        # Rebuild the tool lists of the routes
+        self.route_tools.clear()
 
-    # Handle a function call from the AI
-    def handle_function_call(self, function_name: str, arguments: str, chat_message: Message):
-        if function_name == "image_input":
-            self.get_ai_response_with_image(chat_message)
-        else:
-            self.pubsub.publish(PubEvents.BOT_FUNCTION, function_name, arguments, chat_message)
 
+    # Run all function calls of a response at the same time and get one response from their results
+    def handle_tool_calls(self, tool_calls: List[dict], chat_message: Message) -> str | None:
+        start = time.perf_counter()
+        futures = [self.tool_pool.submit(self.run_tool, call, chat_message) for call in tool_calls]
+        results = [future.result() for future in futures]
+        self.logger.debug(f"Ran {len(tool_calls)} tool calls in {time.perf_counter() - start:.2f}s")
 
-    # Initialize a conversation with the user
-    def init_conversation(self, username: str):
-        self.memory.conversations[username] = [
-            {
-                "role": "system",
-                "content": self.system_prompt
-            }
-        ]
+        try:
+            # The result of a lone direct tool is already the answer
+            if len(tool_calls) == 1 and tool_calls[0]["name"] in self.direct_tools:
+                return self.loop.submit(self.add_direct_response_async(chat_message, results[0][0]), wait=True)
 
+            return self.loop.submit(self.get_tool_response_async(chat_message, tool_calls, results), wait=True)
 
-    # Update the system prompt
-    def update_system_prompt(self, username: str):
-        self.memory.conversations[username][0]["content"] = self.system_prompt
+        # Log any errors
+        except Exception as error:
+            self.logger.error(f"Error getting AI response to tool results: {error}")
+            return None
+
+
+    # Run a function call, returns the result text and the screenshot if one was taken
+    def run_tool(self, tool_call: dict, chat_message: Message) -> Tuple[str, str | None]:
+        name = tool_call["name"]
+
+        try:
+            if name == "image_input":
+                base64_image, scene_description = self.capture_scene()
+                if base64_image:
+                    return "The screenshot is attached.", base64_image
+                if scene_description:
+                    return f"The stream currently shows: {scene_description}", None
+                return "The screenshot could not be taken.", None
+
+            # Functions without a handler are only announced
+            handler = self.tool_handlers.get(name)
+            if handler is None:
+                self.pubsub.publish(PubEvents.BOT_FUNCTION, name, tool_call["arguments"], chat_message)
+                return "Done.", None
+
+            arguments = json.loads(tool_call["arguments"] or "{}")
+            return str(handler(chat_message, **arguments)), None
 
+        except Exception as error:
+            self.logger.error(f"Error running tool {name}: {error}")
+            return f"The {name} tool failed.", None
+
+
+    # Add the result of a direct tool to the conversation on the event loop, conversations are only changed under the user lock
+    async def add_direct_response_async(self, chat_message: Message, text: str) -> str:
+        async with self.get_user_lock(chat_message.username):
+            self.add_response_to_conversation(chat_message.username, text)
+
+        return text
 
-    # Generate extra context for the message prompt
-    def generate_prompt_context(self, with_twitch_chat: bool, with_audio_transcript: bool):
-        twitch_chat_history_string = ""
-        transcript_string = ""
-        channel_description_string = ""
 
-        # Add the channel description to the prompt
-        if "channel_description" in os.environ.keys():
-            channel_description_string = f"\n- Channel description: {os.environ['channel_description']}"
+    # Get a response from the AI to the results of its function calls on the event loop
+    async def get_tool_response_async(self, chat_message: Message, tool_calls: List[dict], results: List[Tuple[str, str | None]]) -> str | None:
+        username = chat_message.username
+
+        async with self.get_user_lock(username):
+            if username not in self.conversations:
+                return None
+
+            messages = self.conversations.get_messages(username)
+            base64_image = next((image for _, image in results if image), None)
 
-        # Add the twitch chat history to the prompt
-        if with_twitch_chat and len(self.twitch_chat_history) > 0:
-            twitch_chat = '\n'.join(self.twitch_chat_history)
-            twitch_chat_history_string = f"\n- Twitch chat history: '{twitch_chat}'"
+            if base64_image is None:
+                model = self.chat_model
+                messages.append({
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [{"id": call["id"], "type": "function", "function": {"name": call["name"], "arguments": call["arguments"]}} for call in tool_calls]
+                })
+                messages.extend({"role": "tool", "tool_call_id": call["id"], "content": text} for call, (text, _) in zip(tool_calls, results))
 
-        # Add the audio transcript to the prompt
-        if with_audio_transcript and len(self.audio_transcript) > 0:
-            transcript_string = f"\n- Audio transcript: {self.audio_transcript}"
+            # The vision model takes no tool messages, the results go along with the screenshot
+            else:
+                model = self.vision_model
+                tool_results = "\n".join(f"{call['name']}: {text}" for call, (text, _) in zip(tool_calls, results))
+                messages.append({"role": "user", "content": self.create_image_content(f"Results of the tools you used:\n{tool_results}", base64_image)})
 
-        # Return the updated prompt
-        return f"<<context>> {channel_description_string} {twitch_chat_history_string} {transcript_string} <</context>>"
+            response = await self.create_completion(model=model, messages=messages, max_tokens=300)
+            self.record_prompt_usage(response.usage)
+
+            choice = response.choices[0]
+            if not choice.message.content:
+                return None
+
+            response_text = clean_message(choice.message.content, username, choice.finish_reason, os.environ["bot_username"])
+            self.add_response_to_conversation(username, response_text)
+
+            return response_text
+
+
+    # Initialize a conversation with the user
+    def init_conversation(self, username: str):
+        self.conversations.init(username, self.system_prompt)
+
+
+    # Update the system prompt, only when it changed so the cached prompt prefix is kept
+    def update_system_prompt(self, username: str):
+        system_message = self.conversations.get(username)[0]
+        if system_message["content"] != self.system_prompt:
+            self.conversations.set_system_prompt(username, self.system_prompt)
+
+
+    # Generate extra context for the message prompt within the context token budget
+    def generate_prompt_context(self, chat_message: Message, with_twitch_chat: bool, with_audio_transcript: bool):
+        return self.context_builder.build(
+            transcript=self.transcript_segments if with_audio_transcript else [],
+            chat_history=self.twitch_chat_history if with_twitch_chat else [],
+            description=self.channel.description,
+            username=chat_message.username,
+            message=chat_message.text
+        )
 
 
     # Add the user message to the conversation
@@ -168,60 +645,44 @@ class ChatAPI:
             self,
             chat_message: Message,
             with_twitch_chat: bool,
-            with_audio_transcript: bool,
-            with_image: bool):
+            with_audio_transcript: bool):
         
         # Get the message information
         username = chat_message.username
         message = chat_message.text
 
         # Initialize the conversation if it doesn't exist
-        if username not in self.memory.conversations:
+        if username not in self.conversations:
             self.init_conversation(username)
 
         # Update the system prompt
         self.update_system_prompt(username)
 
         # Generate extra context for the prompt
-        extra_context = self.generate_prompt_context(with_twitch_chat, with_audio_transcript)            
+        extra_context = self.generate_prompt_context(chat_message, with_twitch_chat, with_audio_transcript)            
 
-        # Add the message with context to the conversation
-        prompt = f"{extra_context}\nReply to the following chat message '{username}: {message}'"
+        # Add the message with context to the conversation, the context changes with every message so it goes last
+        prompt = f"Reply to the following chat message '{username}: {message}'\n{extra_context}"
 
-        if with_image:
-            # Pause transcription for resource optimization
-            self.pubsub.publish(PubEvents.PAUSE_TRANSCRIPTION)
+        # The wire form carries the context, the history form is stored already clean
+        self.conversations.append(username, "user", f"{username}: {message}", wire=prompt)
 
-            # Get a base64 screenshot of the stream
-            base64_image = self.image_api.get_base64_screenshot()
 
-            # Resume transcription
-            self.pubsub.publish(PubEvents.RESUME_TRANSCRIPTION)
-
-            # Add the prompt to the conversation with the image
-            self.memory.conversations[username].append({
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                            "detail": "low"
-                        }
-                    }
-                ]
-            })
-        
-        else:
-            # Add the prompt to the conversation
-            self.memory.conversations[username].append({
-                "role": "user",
-                "content": prompt
-            })
+    # Create the content of a message with a prompt and an image
+    def create_image_content(self, prompt: str, base64_image: str) -> list:
+        return [
+            {
+                "type": "text",
+                "text": prompt
+            },
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{base64_image}",
+                    "detail": "low"
+                }
+            }
+        ]
 
 
     # Add the response from the AI to the conversation
@@ -231,46 +692,115 @@ class ChatAPI:
             response: str):
         
         # Check if the conversation exists
-        if username not in self.memory.conversations:
+        if username not in self.conversations or not response:
             return
         
         # Add the response to the conversation
-        self.memory.conversations[username].append({
-            "role": "assistant",
-            "content": response
-        })
-
-        # keep only the last 10 messages
-        while len(self.memory.conversations[username]) > 10:
-            self.memory.conversations[username].pop(1)
-        
-        # remove images and old context messages from the conversation
-        self.memory.conversations[username] = clean_conversation(self.memory.conversations[username])
+        self.conversations.append(username, "assistant", response)
+
+        # keep the conversation within its token budget
+        self.conversations.trim(username)
 
 
     # Clear the conversation with the user from the memory
     def clear_user_conversation(self, username: str):
-        if username.lower() in self.memory.conversations:
-            del self.memory.conversations[username.lower()]
+        self.conversations.clear(username.lower())
 
 
-    # Use a screenshot of the stream to get more context/information on what is shown/happening
-    def get_ai_response_with_image(self, chat_message: Message):
-        
-        # Add the user message to the conversation
-        self.create_user_message(chat_message, with_twitch_chat=False, with_audio_transcript=True, with_image=True)
-
-        # Get a response from the AI
-        response = self.openai_api.chat.completions.create(
-            model="gpt-4-vision-preview",
-            messages=self.memory.conversations[chat_message.username],
-            max_tokens=300
+    # Get a reaction to a screenshot and a transcript snapshot, no conversation is touched so an unused reaction can be thrown away
+    def get_reaction(self, chat_message: Message, base64_image: str | None, scene_description: str | None, transcript: list) -> str | None:
+        try:
+            return self.loop.submit(self.get_reaction_async(chat_message, base64_image, scene_description, transcript), wait=True)
+
+        # Log any errors
+        except Exception as error:
+            self.logger.error(f"Error getting AI reaction: {error}")
+            return None
+
+
+    # Get a reaction from the AI on the event loop
+    async def get_reaction_async(self, chat_message: Message, base64_image: str | None, scene_description: str | None, transcript: list) -> str | None:
+        username = chat_message.username
+
+        # Context of the snapshot only, the chat is not part of a reaction
+        extra_context = self.context_builder.build(
+            transcript=transcript,
+            chat_history=[],
+            description=self.channel.description,
+            username=username,
+            message=chat_message.text
         )
+        prompt = f"{chat_message.text}\n{extra_context}"
+        if scene_description:
+            prompt = f"{prompt}\nThe stream currently shows: {scene_description}"
 
-        # Get the response text
-        text = response.choices[0].message.content
+        messages = [
+            {
+                "role": "system",
+                "content": self.system_prompt
+            },
+            {
+                "role": "user",
+                "content": self.create_image_content(prompt, base64_image) if base64_image else prompt
+            }
+        ]
 
-        # Add the response to the conversation
-        self.add_response_to_conversation(chat_message.username, text)
+        response = await self.create_completion(model=self.vision_model if base64_image else self.chat_model, messages=messages, max_tokens=300)
+        self.record_prompt_usage(response.usage)
 
-        return text
+        choice = response.choices[0]
+        if not choice.message.content:
+            return None
+
+        return clean_message(choice.message.content, username, choice.finish_reason, os.environ["bot_username"])
+
+
+    # Capture the stream, returns a base64 screenshot or the description of a recent scene that looks the same
+    def capture_scene(self) -> Tuple[str | None, str | None]:
+        if not self.vision_enabled:
+            return None, None
+
+        # Pause transcription for resource optimization
+        self.pubsub.publish(PubEvents.PAUSE_TRANSCRIPTION)
+
+        # Get a raw frame of the stream
+        frame = self.image_api.take_frame()
+
+        # Resume transcription
+        self.pubsub.publish(PubEvents.RESUME_TRANSCRIPTION)
+
+        if frame is None:
+            return None, None
+
+        # Reuse the description of a scene that barely changed
+        frame_hash = perceptual_hash(frame)
+        self.scene_hash = frame_hash
+        scene_description = self.vision_cache.get(frame_hash)
+        if scene_description:
+            return None, scene_description
+
+        base64_image = self.image_api.encode_base64_jpeg(frame)
+
+        # Describe a scene that stays on screen in the background for the next requests
+        if self.vision_cache.claim(frame_hash):
+            self.loop.submit(self.describe_scene(frame_hash, base64_image))
+
+        return base64_image, None
+
+
+    # Describe a screenshot for the vision cache
+    async def describe_scene(self, frame_hash: int, base64_image: str):
+        try:
+            response = await self.create_completion(
+                model=self.vision_model,
+                messages=[{"role": "user", "content": self.create_image_content(self.scene_prompt, base64_image)}],
+                max_tokens=100
+            )
+            self.record_prompt_usage(response.usage)
+
+            description = response.choices[0].message.content
+            if description:
+                self.vision_cache.set(frame_hash, description.strip())
+
+        finally:
+            self.vision_cache.release(frame_hash)
@@ -1,33 +1,52 @@
 import base64
 import subprocess
 
+import numpy as np
+
 from utils.ffmpeg_base import FfmpegBase
 
 class ImageAPI(FfmpegBase):
-    # Take screenshot of twitch stream
-    def take_screenshot(self) -> bytes:  
-        # Start recording the stream 
+    # Size of the captured frames
+    frame_width: int = 640
+    frame_height: int = 360
+
+    # Take a raw rgb frame of the twitch stream
+    def take_frame(self) -> np.ndarray | None:
+        frame_size = self.frame_width * self.frame_height * 3  # 3 bytes per pixel
+
+        # Start recording the stream
         self.start_recording()
 
-        # Pipe the stream output to ffmpeg
-        self.ffmpeg_process = subprocess.Popen(
-            ['ffmpeg', '-i', 'pipe:0', '-vframes', '1', '-vcodec', 'png', '-f', 'image2pipe', '-loglevel', 'panic', '-'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE)
+        try:
+            # Pipe the stream output to ffmpeg
+            self.ffmpeg_process = subprocess.Popen(
+                ['ffmpeg', '-i', 'pipe:0', '-vframes', '1', '-vf', f'scale={self.frame_width}:{self.frame_height}', '-pix_fmt', 'rgb24', '-f', 'rawvideo', '-loglevel', 'panic', '-'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
 
-        # Wait for all the bytes to be written to stdout
-        out_bytes = self.ffmpeg_process.stdout.read(480 * 640 * 3)  # 3 bytes per pixel
+            # Wait for the whole frame to be written to stdout
+            out_bytes = self.ffmpeg_process.stdout.read(frame_size)
 
-        # Stop recording the stream
-        self.stop_recording()
+        finally:
+            # Stop recording the stream
+            self.stop_recording()
 
-        return out_bytes
-    
+        # The stream ended before a whole frame was decoded
+        if len(out_bytes) < frame_size:
+            self.logger.error(f"Incomplete frame: {len(out_bytes)}/{frame_size} bytes")
+            return None
 
-    # Get the screenshot as a base64 string
-    def get_base64_screenshot(self):
-        # Get the screenshot as bytes
-        image_bytes = self.take_screenshot()
+        return np.frombuffer(out_bytes, dtype=np.uint8).reshape(self.frame_height, self.frame_width, 3)
+
+
+    # Encode a raw rgb frame as a base64 jpeg
+    def encode_base64_jpeg(self, frame: np.ndarray) -> str:
+        height, width, _ = frame.shape
+
+        result = subprocess.run(
+            ['ffmpeg', '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-i', 'pipe:0', '-vframes', '1', '-vcodec', 'mjpeg', '-f', 'image2pipe', '-loglevel', 'panic', '-'],
+            input=frame.tobytes(),
+            stdout=subprocess.PIPE)
 
         # Encode the image data to base64
-        return base64.b64encode(image_bytes).decode('utf-8')
\ No newline at end of file
+        return base64.b64encode(result.stdout).decode('utf-8')
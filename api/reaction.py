@@ -0,0 +1,184 @@
+import time
+import random
+import logging
+import threading
+
+from typing import Callable
+from dataclasses import dataclass
+
+from api.chat import ChatAPI
+from api.twitch import TwitchChannel
+
+from utils import metrics
+from utils.journal import MemoryJournal
+from utils.models import Memory, Message
+from utils.pubsub import PubSub, PubEvents
+
+
+@dataclass
+class Reaction:
+    text: str
+    prepared_at: float
+
+
+class ReactionScheduler:
+    pubsub: PubSub
+    memory: Memory
+    journal: MemoryJournal
+    chat_api: ChatAPI
+    twitch_api: TwitchChannel
+
+    logger = logging.getLogger("reaction_scheduler")
+
+    # Reactions are prepared one preparation time before their slot, the preparation time is a moving average of the measured ones
+    # The margin covers the variation of the preparation time and the timer checks
+    initial_prepare_time: float = 10
+    prepare_time_weight: float = 0.2
+    lead_margin: float = 2
+    poll_interval: float = 1
+
+    # A prepared reaction is stale when its context is older than this many lead times
+    max_age_leads: float = 2
+
+    # Seconds to wait before preparing again after a failed attempt
+    retry_delay: float = 30
+
+    # Reactions are spaced further apart on lower quality tiers
+    tier_interval_scale = [1, 1.5, 2]
+
+    def __init__(self, pubsub: PubSub, memory: Memory, journal: MemoryJournal, chat_api: ChatAPI, twitch_api: TwitchChannel, moderation: Callable[[], bool]):
+        self.pubsub = pubsub
+        self.memory = memory
+        self.journal = journal
+        self.chat_api = chat_api
+        self.twitch_api = twitch_api
+        self.moderation = moderation
+        self.channel = chat_api.channel
+
+        self.prompt = f"Respond or react to the most recent thing {self.channel.name} said based only on the last couple of sentences in the audio transcript and (if provided) the image for context."
+
+        # The reaction waiting for its slot
+        self.prepared: Reaction | None = None
+        self.prepare_time: float = self.initial_prepare_time
+        self.retry_time: float = 0.0
+        self.interval_scale: float = 1
+
+        # The timer thread and manual reactions never prepare or post at the same time
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=f"reaction_scheduler_{self.channel.name}", daemon=True)
+
+        self.pubsub.subscribe(PubEvents.QUALITY_TIER, self.set_quality_tier)
+        self.pubsub.subscribe(PubEvents.SHUTDOWN, self.shutdown)
+
+
+    # Start the timer thread
+    def start(self):
+        self.thread.start()
+
+
+    # Callback for the quality tier event
+    def set_quality_tier(self, tier: int):
+        self.interval_scale = self.tier_interval_scale[min(tier, len(self.tier_interval_scale) - 1)]
+
+
+    # Stop the timer thread
+    def shutdown(self):
+        self.stop_event.set()
+
+
+    # Check the reaction timer until shutdown, independent of the chat traffic
+    def run(self):
+        while not self.stop_event.wait(self.poll_interval):
+            try:
+                with self.lock:
+                    self.tick()
+            except Exception as e:
+                self.logger.error(f"Failed to schedule reaction: {e}")
+
+
+    # Prepare the reaction ahead of its slot and post it when the slot opens
+    def tick(self):
+        now = time.time()
+        reaction_time = self.memory.reaction_time
+
+        # Too early or not allowed to react
+        if now < reaction_time - self.get_lead_time() or not self.moderation():
+            return
+
+        # Throw away a reaction the stream has moved on from
+        if self.prepared is not None and self.is_stale(self.prepared):
+            self.logger.info(f"Discarding stale reaction prepared {now - self.prepared.prepared_at:.1f}s ago")
+            metrics.increment("reactions.discarded")
+            self.prepared = None
+
+        if self.prepared is None:
+            if now < self.retry_time:
+                return
+
+            self.prepared = self.prepare()
+            if self.prepared is None:
+                self.retry_time = time.time() + self.retry_delay
+                return
+
+        # Wait for the slot
+        if time.time() < reaction_time:
+            return
+
+        self.post(self.prepared, random.randint(600, 900))  # 10-15 minutes
+
+
+    # React right away, the prepared reaction is used if it is still fresh
+    def react_now(self):
+        with self.lock:
+            reaction = self.prepared
+            if reaction is None or self.is_stale(reaction):
+                reaction = self.prepare()
+
+            if reaction is not None:
+                self.post(reaction, random.randint(300, 600))  # 5-10 minutes
+
+
+    # Take the screenshot and transcript snapshot and get the reaction to them
+    def prepare(self) -> Reaction | None:
+        start = time.time()
+
+        transcript = list(self.chat_api.transcript_segments)
+        base64_image, scene_description = self.chat_api.capture_scene()
+
+        chat_message = Message(self.channel.name, self.prompt)
+        text = self.chat_api.get_reaction(chat_message, base64_image, scene_description, transcript)
+        if not text:
+            return None
+
+        # Only successful preparations tell how long the next one takes
+        duration = time.time() - start
+        self.prepare_time += (duration - self.prepare_time) * self.prepare_time_weight
+        metrics.set_gauge("reactions.prepare_s", self.prepare_time)
+
+        self.logger.debug(f"Prepared reaction in {duration:.1f}s")
+        return Reaction(text, start)
+
+
+    # Get how long before its slot a reaction is prepared
+    def get_lead_time(self) -> float:
+        return self.prepare_time + self.lead_margin
+
+
+    # Check if the context of a reaction is outdated, a reaction posted on time is about one lead time old
+    def is_stale(self, reaction: Reaction) -> bool:
+        return time.time() - reaction.prepared_at > self.max_age_leads * self.get_lead_time()
+
+
+    # Post a reaction and schedule the next one
+    def post(self, reaction: Reaction, next_reaction_delay: float):
+        self.twitch_api.send_message(reaction.text)
+
+        self.prepared = None
+        self.memory.reaction_time = time.time() + next_reaction_delay * self.interval_scale
+        self.journal.record("set", "reaction_time", self.memory.reaction_time)
+
+        context_age = time.time() - reaction.prepared_at
+        metrics.increment("reactions.posted")
+        metrics.set_gauge("reactions.context_age_s", context_age)
+        self.logger.info(f"Posted reaction {context_age:.1f}s after its context was captured")
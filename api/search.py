@@ -0,0 +1,86 @@
+import os
+import logging
+import requests
+
+from typing import List
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from utils import metrics
+from utils.cache import TTLCache
+from utils.singleflight import SingleFlight
+
+
+class SearchAPI:
+    logger = logging.getLogger("search_api")
+
+    url: str = "https://www.googleapis.com/customsearch/v1"
+
+    # Connect and read timeouts in seconds and the number of kept alive connections
+    connect_timeout: float = 3.05
+    read_timeout: float = 5
+    max_connections: int = 4
+
+    # Number of cached queries and how long their results are reused
+    cache_entries: int = 256
+    cache_ttl: float = 3600
+
+    def __init__(self):
+        # Shared keep alive connections, a failed connection or server error is retried once
+        self.session = requests.Session()
+        retries = Retry(total=1, backoff_factor=0.2, status_forcelist=(500, 502, 503, 504))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, max_retries=retries))
+
+        self.cache = TTLCache(self.cache_entries, self.cache_ttl)
+        self.flight = SingleFlight("search")
+
+
+    # Normalize a query so different spellings of the same query share results
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.lower().split())
+
+
+    # Search the web, repeated queries are served from the cache and concurrent ones share one request
+    def search(self, query: str) -> List[str]:
+        query = self.normalize(query)
+
+        snippets = self.cache.get(query)
+        if snippets is not None:
+            metrics.increment("search.cache_hits")
+            return snippets
+
+        metrics.increment("search.cache_misses")
+        return self.flight.do(query, self.fetch, query)
+
+
+    # Get the result snippets of a query from google
+    def fetch(self, query: str) -> List[str]:
+        params = {
+            "q": query,
+            "key": os.environ["google_api_key"],
+            "cx": os.environ["google_cse_id"],
+            "start": 1
+        }
+
+        try:
+            response = self.session.get(self.url, params=params, timeout=(self.connect_timeout, self.read_timeout))
+            response.raise_for_status()
+            data = response.json()
+
+        # Errors are not cached
+        except (requests.RequestException, ValueError) as e:
+            self.logger.error(f"Failed to search '{query}': {e}")
+            return []
+
+        # Extract snippets from the search results
+        snippets = [item.get("snippet", "") for item in data.get("items", [])]
+        self.cache.set(query, snippets)
+
+        return snippets
+
+
+    # Close the kept alive connections
+    def close(self):
+        self.session.close()
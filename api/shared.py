@@ -0,0 +1,57 @@
+import os
+import httpx
+import asyncio
+import logging
+
+from openai import AsyncOpenAI
+
+from api.chat import ChatAPI
+from api.search import SearchAPI
+from api.twitch import TwitchAPI
+
+from utils.async_loop import AsyncLoop
+from utils.pubsub import PubSub, PubEvents
+
+
+# Connections, pools and the event loop used by the bots of every channel
+class SharedServices:
+    pubsub: PubSub
+    twitch_api: TwitchAPI
+    openai_api: AsyncOpenAI
+    search_api: SearchAPI
+    loop: AsyncLoop
+
+    logger = logging.getLogger("shared_services")
+
+    def __init__(self, pubsub: PubSub):
+        self.pubsub = pubsub
+
+        # One connection pool for the requests of all channels
+        self.openai_api = AsyncOpenAI(
+            api_key=os.environ["openai_api_key"],
+            timeout=ChatAPI.request_timeout,
+            max_retries=1,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=ChatAPI.max_connections, max_keepalive_connections=ChatAPI.max_connections))
+        )
+
+        # Start the event loop that runs the requests
+        self.loop = AsyncLoop("chat_api")
+        self.loop.start()
+
+        # Bounds the requests of all channels together, only used from the event loop
+        self.request_semaphore = asyncio.Semaphore(ChatAPI.max_concurrent_requests)
+
+        self.search_api = SearchAPI()
+
+        self.pubsub.subscribe(PubEvents.SHUTDOWN, self.shutdown)
+
+
+    # Authenticate and connect the one chat connection that joins every channel
+    def connect_twitch(self):
+        self.twitch_api = TwitchAPI(self.pubsub)
+
+
+    # Close the connections and stop the event loop
+    def shutdown(self):
+        self.search_api.close()
+        self.loop.stop()
@@ -3,43 +3,74 @@ import base64
 import requests
 import subprocess
 
+from utils import metrics
 from utils.ffmpeg_base import FfmpegBase
+from utils.pubsub import PubSub
+from utils.fingerprint import FingerprintIndex, get_fingerprint_index, wav_to_samples
 
 
 class ShazamAPI(FfmpegBase):
+    fingerprint_index: FingerprintIndex
+
+    # Sample rate of the recording and seconds recorded before the local index is tried
+    sample_rate: int = 44100
+    local_match_seconds: float = 3
+
+    def __init__(self, pubsub: PubSub):
+        super().__init__(pubsub)
+
+        # Tracks shazam identified before on any channel are matched locally
+        self.fingerprint_index = get_fingerprint_index()
+
+
     def detect_song(self):
-        # record audio from the stream
-        bytes = self.record_audio()
-        
+        # record audio from the stream, stops early if the local index knows the song
+        bytes, song = self.record_audio()
+        if song is not None:
+            metrics.increment("song.local_matches")
+            return song
+
         # get audio data from the file
         base64_data = self.get_audio_data(bytes)
-        
+
         # get the result from the shazam API
         song = self.get_shazam_result(base64_data)
-        
+
+        # index the song so it is recognized locally next time
+        if song not in ("Error", "No matches found"):
+            self.fingerprint_index.add(song, wav_to_samples(bytes), self.sample_rate)
+
         return song
 
 
-    # records output audio from the stream.
-    def record_audio(self) -> bytes:
+    # records output audio from the stream, returns the audio and the song if the local index matched the first seconds
+    def record_audio(self) -> tuple:
         # Start recording the stream
         self.start_recording()
-        
-        # Pipe the output to ffmpeg with 1 channel and 44100 sample rate for 8 seconds
-        self.ffmpeg_process = subprocess.Popen(
-            ['ffmpeg', '-i', 'pipe:0', '-ac', '1', '-ar', '44100', '-t', '8', '-acodec', 'pcm_s16le', '-f', 'wav', '-loglevel', 'panic', '-'],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE)
-        
-        # Total Bytes = 8 seconds * 44100 Hz * 1 channel * 2 bytes/sample = 705600 bytes
-        # Wait for all the bytes to be written to stdout
-        out_bytes = self.ffmpeg_process.stdout.read(705600)  
-
-        # Stop recording the stream
-        self.stop_recording()
+
+        try:
+            # Pipe the output to ffmpeg with 1 channel and 44100 sample rate for 8 seconds
+            self.ffmpeg_process = subprocess.Popen(
+                ['ffmpeg', '-i', 'pipe:0', '-ac', '1', '-ar', str(self.sample_rate), '-t', '8', '-acodec', 'pcm_s16le', '-f', 'wav', '-loglevel', 'panic', '-'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+
+            # Match the first seconds against the local index
+            out_bytes = self.ffmpeg_process.stdout.read(int(self.local_match_seconds * self.sample_rate * 2))
+            song = self.fingerprint_index.match(wav_to_samples(out_bytes), self.sample_rate)
+            if song is not None:
+                return out_bytes, song
+
+            # Total Bytes = 8 seconds * 44100 Hz * 1 channel * 2 bytes/sample = 705600 bytes
+            # Wait for the rest of the bytes to be written to stdout
+            out_bytes += self.ffmpeg_process.stdout.read(705600 - len(out_bytes))
+
+        finally:
+            # Stop recording the stream
+            self.stop_recording()
 
         # return the audio bytes
-        return out_bytes
+        return out_bytes, None
 
 
     # Get the audio data from the file
@@ -1,11 +1,11 @@
 import os
 import logging
-import asyncio
 
-from utils.models import Message
-from utils.pubsub import PubSub, PubEvents
+from typing import Dict, List, Tuple
 
-from concurrent.futures import ThreadPoolExecutor
+from utils.models import Channel, Message
+from utils.async_loop import AsyncLoop
+from utils.pubsub import PubSub, PubEvents
 
 from twitchAPI.helper import first
 from twitchAPI.twitch import Twitch, TwitchUser
@@ -16,45 +16,83 @@ from twitchAPI.type import AuthScope, UnauthorizedException, InvalidRefreshToken
 
 class TwitchAPI:
     pubsub: PubSub
+    loop: AsyncLoop
 
     twitch: Twitch
     chat: Chat
-    chat_history = []
     bot_user: TwitchUser
 
     logger = logging.getLogger('twitch_api')
 
+    # Number of chat messages kept per channel
+    max_chat_history: int = 20
+
     def __init__(self, pubsub: PubSub):
         self.pubsub = pubsub
 
+        # Joined channels by lower case name with the pubsub their messages are published to, in join order
+        self.rooms: Dict[str, Tuple[Channel, PubSub]] = {}
+        self.chat_histories: Dict[str, List[str]] = {}
+
         # Subscribe to the shutdown event
         self.pubsub.subscribe(PubEvents.SHUTDOWN, self.shutdown)
 
         self.logger.info("Initializing Twitch API...")
 
+        # Start the event loop that owns the twitch and chat objects
+        self.loop = AsyncLoop("twitch_api")
+        self.loop.start()
+
         # Authenticate Twitch API
-        with ThreadPoolExecutor() as pool:
-            pool.submit(lambda:asyncio.run(self.authenticate()))
+        self.loop.submit(self.authenticate(), wait=True)
         
         # Initialize twitch chat
-        with ThreadPoolExecutor() as pool:
-            pool.submit(lambda:asyncio.run(self.init_chat()))
-
-        # Set about section of target channel in environment
-        self.set_channel_description()
+        self.loop.submit(self.init_chat(), wait=True)
 
         self.logger.info("Twitch API Initialized")
 
 
+    # Join the chat of a channel, its messages and whispers addressed to it are published to the given pubsub
+    def join(self, channel: Channel, pubsub: PubSub) -> "TwitchChannel":
+        # Set the about section of the channel
+        channel.description = self.loop.submit(self.get_channel_info(channel.name), wait=True).description
+
+        self.rooms[channel.name.lower()] = (channel, pubsub)
+        self.chat_histories[channel.name.lower()] = []
+        self.loop.submit(self.chat.join_room(channel.name), wait=True)
+
+        self.logger.info(f"Joined {channel.name}")
+        return TwitchChannel(self, channel, pubsub)
+
+
+    # Leave the chat of a channel
+    def leave(self, channel: Channel):
+        if self.rooms.pop(channel.name.lower(), None) is None:
+            return
+
+        try:
+            self.loop.submit(self.chat.leave_room(channel.name), wait=True, timeout=5)
+        except Exception as e:
+            self.logger.error(f"Failed to leave room {channel.name}: {e}")
+
+
     # API Shutdown
     def shutdown(self):
-        with ThreadPoolExecutor() as pool:
-            pool.submit(lambda:asyncio.run(self.chat.leave_room(os.environ["target_channel"])))
-        
+        for channel, _ in list(self.rooms.values()):
+            self.leave(channel)
+
         try:
             self.chat.stop()
         except:
             pass
+
+        try:
+            self.loop.submit(self.twitch.close(), wait=True, timeout=5)
+        except Exception as e:
+            self.logger.error(f"Failed to close Twitch API: {e}")
+
+        # Stop the event loop
+        self.loop.stop()
         
         self.logger.info("Twitch API Shutdown")
 
@@ -74,9 +112,6 @@ class TwitchAPI:
 
         # We are done with our setup, lets start this bot up!
         self.chat.start()
-
-        # Join channel
-        await self.chat.join_room(os.environ["target_channel"])
     
 
     # This will be called whenever a message in a channel was send by either the bot OR another user
@@ -85,56 +120,65 @@ class TwitchAPI:
         if msg.user.name == os.environ["bot_username"].lower():
             return
 
+        # Ignore messages of channels that were left
+        room = self.rooms.get(msg.room.name.lower())
+        if room is None:
+            return
+        _, pubsub = room
+
         # Add message to chat history
-        self.chat_history.append(f"{msg.user.name}: {msg.text}")
+        chat_history = self.chat_histories[msg.room.name.lower()]
+        chat_history.append(f"{msg.user.name}: {msg.text}")
 
         # Keep chat history at 20 messages
-        if len(self.chat_history) > 20:
-            self.chat_history.pop(0)
+        if len(chat_history) > self.max_chat_history:
+            chat_history.pop(0)
 
         # publish chat history
-        self.pubsub.publish(PubEvents.CHAT_HISTORY, self.chat_history.copy())    
+        pubsub.publish(PubEvents.CHAT_HISTORY, chat_history.copy())    
 
         # Create message object
         chat_message = Message(msg.user.name, msg.text, msg.user.mod)
 
         # Add message to message queue
-        self.pubsub.publish(PubEvents.CHAT_MESSAGE, chat_message)
+        pubsub.publish(PubEvents.CHAT_MESSAGE, chat_message)
 
 
-    # This will be called whenever a whisper was send to the bot
+    # This will be called whenever a whisper was send to the bot, "#channel command" addresses a channel, otherwise it goes to the first one
     async def on_whisper(self, whisper: WhisperEvent):
-        self.pubsub.publish(PubEvents.WHISPER_MESSAGE, whisper)
+        if not self.rooms:
+            return
 
+        room = None
+        if whisper.message.startswith("#"):
+            name, _, command = whisper.message[1:].partition(" ")
+            room = self.rooms.get(name.lower())
+            if room is not None:
+                whisper.message = command
 
-    # Send message to chat
-    def send_message(self, message: str):
+        _, pubsub = room or next(iter(self.rooms.values()))
+        pubsub.publish(PubEvents.WHISPER_MESSAGE, whisper)
+
+
+    # Send message to the chat of a channel, set wait to block until the message is sent
+    def send_message(self, channel: str, message: str, wait: bool = False):
         # Limit message length
         if len(message) > 500:
             message = message[:475] + "..."
 
         # Send message
-        with ThreadPoolExecutor() as pool:
-            pool.submit(lambda:asyncio.run(self.chat.send_message(os.environ["target_channel"], message)))
-
+        return self.loop.submit(self.chat.send_message(channel, message), wait=wait)
 
-    # Send whisper to user
-    def send_whisper(self, user: TwitchUser, message: str):
-        with ThreadPoolExecutor() as pool:
-            pool.submit(lambda:asyncio.run(self.twitch.send_whisper(self.bot_user.id, user.id, message)))
 
-
-    # Get about section of target channel using the get_stream_info function
-    def set_channel_description(self):
-        with ThreadPoolExecutor() as pool:
-            target_channel: TwitchUser = pool.submit(lambda:asyncio.run(self.get_channel_info())).result()
-            os.environ["channel_description"] = target_channel.description
+    # Send whisper to user, set wait to block until the whisper is sent
+    def send_whisper(self, user: TwitchUser, message: str, wait: bool = False):
+        return self.loop.submit(self.twitch.send_whisper(self.bot_user.id, user.id, message), wait=wait)
 
 
     # Get channel information
-    async def get_channel_info(self):
+    async def get_channel_info(self, channel: str) -> TwitchUser:
         # Get channel
-        target_channel = await first(self.twitch.get_users(logins=[os.environ["target_channel"]]))
+        target_channel = await first(self.twitch.get_users(logins=[channel]))
 
         return target_channel
 
@@ -173,3 +217,31 @@ class TwitchAPI:
         # Set tokens in config
         os.environ["twitch_user_token"] = twitch_user_token
         os.environ["twitch_user_refresh_token"] = refresh_token
+
+
+# The twitch connection as seen by the bot of one channel
+class TwitchChannel:
+    twitch_api: TwitchAPI
+    channel: Channel
+
+    def __init__(self, twitch_api: TwitchAPI, channel: Channel, pubsub: PubSub):
+        self.twitch_api = twitch_api
+        self.channel = channel
+
+        # Leave the chat when the channel shuts down
+        pubsub.subscribe(PubEvents.SHUTDOWN, self.leave)
+
+
+    # Send message to the chat of the channel, set wait to block until the message is sent
+    def send_message(self, message: str, wait: bool = False):
+        return self.twitch_api.send_message(self.channel.name, message, wait=wait)
+
+
+    # Send whisper to user, set wait to block until the whisper is sent
+    def send_whisper(self, user: TwitchUser, message: str, wait: bool = False):
+        return self.twitch_api.send_whisper(user, message, wait=wait)
+
+
+    # Leave the chat of the channel
+    def leave(self):
+        self.twitch_api.leave(self.channel)
@@ -0,0 +1,116 @@
+# Compare the latency of the chat side under ingest load with ingest running as a thread of the
+# same process against ingest running in its own process, bridged over a unix domain socket.
+# The chat latency is how late a short timer fires and runs a small handler, the transcript
+# latency is how long a published transcript takes to reach the chat pubsub.
+#
+# Run from the repository root: python -m benchmarks.bench_ipc
+import os
+import time
+import array
+import tempfile
+import threading
+import statistics
+import multiprocessing
+
+from utils.ipc import PubSubBridge
+from utils.pubsub import PubSub, PubEvents
+
+SECONDS = 5
+TIMER_INTERVAL = 0.002
+SAMPLE_RATE = 16000
+
+
+# Stand-in for the numpy buffer work of the transcription, pure python so it holds the gil
+def ingest_work(stop_event, pubsub: PubSub):
+    samples = array.array("h", range(-SAMPLE_RATE // 2, SAMPLE_RATE // 2))
+    last_transcript = time.time()
+
+    while not stop_event.is_set():
+        energy = sum(sample * sample for sample in samples)
+
+        # Publish a transcript every 100 ms with the time it was published
+        if time.time() - last_transcript > 0.1:
+            last_transcript = time.time()
+            pubsub.publish(PubEvents.TRANSCRIPT, [{"start": "0.0", "end": "1.0", "text": f"energy {energy}", "sent": time.time()}])
+
+
+# Ingest in its own process, its pubsub listens on the socket
+def run_ingest_process(path: str, stop_event):
+    pubsub = PubSub()
+    bridge = PubSubBridge(pubsub, path, listen=True)
+    bridge.start()
+
+    ingest_work(stop_event, pubsub)
+    pubsub.publish(PubEvents.SHUTDOWN)
+
+
+# Measure how late a timer fires on the chat side and how long the transcripts took to arrive
+def measure_chat(pubsub: PubSub) -> tuple:
+    transcript_latencies = []
+    pubsub.subscribe(PubEvents.TRANSCRIPT, lambda transcript: transcript_latencies.append((time.time() - transcript[0]["sent"]) * 1000))
+
+    timer_latencies = []
+    end = time.perf_counter() + SECONDS
+    while time.perf_counter() < end:
+        start = time.perf_counter()
+        time.sleep(TIMER_INTERVAL)
+        "".join(reversed("a short chat message to handle"))
+        timer_latencies.append((time.perf_counter() - start - TIMER_INTERVAL) * 1000)
+
+    return timer_latencies, transcript_latencies
+
+
+def run_idle() -> tuple:
+    return measure_chat(PubSub())
+
+
+def run_same_process() -> tuple:
+    pubsub = PubSub()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=ingest_work, args=(stop_event, pubsub))
+    thread.start()
+
+    try:
+        return measure_chat(pubsub)
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def run_split_process() -> tuple:
+    context = multiprocessing.get_context("fork")
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+
+    stop_event = context.Event()
+    process = context.Process(target=run_ingest_process, args=(path, stop_event))
+    process.start()
+
+    pubsub = PubSub()
+    bridge = PubSubBridge(pubsub, path, listen=False)
+    bridge.start()
+
+    try:
+        return measure_chat(pubsub)
+    finally:
+        stop_event.set()
+        process.join()
+        pubsub.publish(PubEvents.SHUTDOWN)
+
+
+def report(name: str, latencies: list):
+    if not latencies:
+        print(f"{name:<36} no samples")
+        return
+
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p99 = latencies[max(0, int(len(latencies) * 0.99) - 1)]
+    print(f"{name:<36} mean {statistics.mean(latencies):8.3f} ms | p50 {p50:8.3f} ms | p99 {p99:8.3f} ms | n {len(latencies)}")
+
+
+if __name__ == "__main__":
+    for name, run in (("idle", run_idle), ("ingest in same process", run_same_process), ("ingest in own process", run_split_process)):
+        timer_latencies, transcript_latencies = run()
+        report(f"{name}, chat timer", timer_latencies)
+        if transcript_latencies:
+            report(f"{name}, transcript", transcript_latencies)
@@ -0,0 +1,52 @@
+# Compare the throughput of the precompiled sanitizer against the previous chain of
+# remove_mentions, remove_hashtags, remove_links and the quotation loop.
+#
+# Run from the repository root: python -m benchmarks.bench_sanitizer
+import re
+import time
+
+from utils.functions import clean_message
+
+USERNAME = "some_viewer"
+BOT_USERNAME = "the_bot"
+ITERATIONS = 2000
+
+
+# The previous implementation, kept here for comparison
+def legacy_clean_message(message: str, username: str, finish_reason: str, bot_username: str):
+    message = message.replace("@User", "").replace("@user", "").replace(f"@{bot_username}", "").replace(
+        f"@{username}:", "").replace(f"@{username}", "").replace(f"{bot_username}:", "")
+    message = re.sub(r'#\w+', '', message)
+    for link in re.findall(r"\b[a-zA-Z]+\.[a-zA-Z]+\b", message):
+        message = message.replace(link, '***')
+    message = message.replace("\n", " ")
+    while message.startswith('"') and message.endswith('"'):
+        message = str(message[1:-1])
+    if finish_reason == "length":
+        message = f"{message}..."
+    return message
+
+
+def measure(function, text: str) -> float:
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        function(text, USERNAME, "stop", BOT_USERNAME)
+    elapsed = time.perf_counter() - start
+    return len(text) * ITERATIONS / elapsed / 1_000_000
+
+
+if __name__ == "__main__":
+    sentence = f"@{USERNAME}: check out example.com and docs.python for more #python #tips\n"
+    samples = {
+        "short reply": f"\"@{USERNAME} that was a great play, gg! #hype\"",
+        "long reply": sentence * 20,
+        "very long reply": sentence * 200,
+        "many links": " ".join(f"site{chr(97 + i % 26)}{chr(97 + i // 26)}.com" for i in range(500)),
+    }
+
+    for name, text in samples.items():
+        assert clean_message(text, USERNAME, "stop", BOT_USERNAME) == legacy_clean_message(text, USERNAME, "stop", BOT_USERNAME)
+
+        legacy = measure(legacy_clean_message, text)
+        current = measure(clean_message, text)
+        print(f"{name:<16} {len(text):>6} chars | legacy {legacy:7.2f} MB/s | precompiled {current:7.2f} MB/s | {current / legacy:5.2f}x")
@@ -0,0 +1,55 @@
+# Compare the latency of sending a chat message with a throwaway thread pool and event loop
+# per call (old TwitchAPI behaviour) against submitting to one long lived loop thread.
+#
+# Run from the repository root: python -m benchmarks.bench_twitch_send
+import time
+import asyncio
+import statistics
+
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.async_loop import AsyncLoop
+
+ITERATIONS = 2000
+
+
+# Stand-in for Chat.send_message, the network write itself is not what is measured here
+async def fake_send_message(room: str, message: str):
+    await asyncio.sleep(0)
+
+
+# Old behaviour: a new thread pool and a new event loop for every message
+def send_with_new_loop():
+    with ThreadPoolExecutor() as pool:
+        pool.submit(lambda: asyncio.run(fake_send_message("channel", "message")))
+
+
+# New behaviour: submit the coroutine to the persistent loop and wait for it
+def send_with_persistent_loop(loop: AsyncLoop):
+    loop.submit(fake_send_message("channel", "message"), wait=True)
+
+
+def measure(function, *args) -> list:
+    latencies = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        function(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<20} mean {statistics.mean(latencies):8.3f} ms | p50 {p50:8.3f} ms | p99 {p99:8.3f} ms")
+
+
+if __name__ == "__main__":
+    loop = AsyncLoop("bench")
+    loop.start()
+
+    report("new loop per call", measure(send_with_new_loop))
+    report("persistent loop", measure(send_with_persistent_loop, loop))
+
+    loop.stop()
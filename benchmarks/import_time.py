@@ -0,0 +1,76 @@
+# Report how long importing the entry points takes and which packages the time goes to,
+# from the output of python -X importtime. Heavy optional dependencies that show up in the
+# import of an entry point that should not need them are flagged.
+#
+# Run from the repository root: python -m benchmarks.import_time [--budget-ms 500] [module ...]
+import sys
+import argparse
+import subprocess
+
+from collections import defaultdict
+
+# Entry points and the heavy packages each one should not import
+TARGETS = {
+    "main": ["openai", "nltk", "faster_whisper", "numpy", "twitchAPI", "httpx"],
+    "api.bot": ["nltk", "faster_whisper"],
+    "api.chat": ["nltk", "faster_whisper"],
+    "utils.deepgram_transcription": ["faster_whisper", "openai", "nltk"],
+    "utils.local_transcription": ["faster_whisper", "openai", "nltk"],
+}
+
+TOP_PACKAGES = 8
+
+
+# Import a module in a fresh interpreter, returns the self and cumulative microseconds of every imported module
+def measure(module: str) -> tuple:
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        imports.append((name.strip(), int(self_us), int(cumulative_us)))
+
+    error = result.stderr.strip().splitlines()[-1] if result.returncode else None
+    return imports, error
+
+
+def report(module: str, unwanted: list, budget_ms: float | None) -> bool:
+    imports, error = measure(module)
+
+    # The module itself is the last import to finish
+    total_ms = next((cumulative for name, _, cumulative in reversed(imports) if name == module), sum(self_us for _, self_us, _ in imports)) / 1000
+
+    packages = defaultdict(int)
+    for name, self_us, _ in imports:
+        packages[name.split(".")[0]] += self_us
+
+    print(f"\n{module}: {total_ms:8.1f} ms, {len(imports)} modules")
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:TOP_PACKAGES]:
+        print(f"    {package:<32} {self_us / 1000:8.1f} ms")
+
+    ok = True
+    flagged = sorted({name.split(".")[0] for name, _, _ in imports} & set(unwanted))
+    if flagged:
+        print(f"    imports {', '.join(flagged)} eagerly")
+        ok = False
+    if budget_ms is not None and total_ms > budget_ms:
+        print(f"    over the budget of {budget_ms:.0f} ms")
+        ok = False
+    if error:
+        print(f"    import failed: {error}")
+        ok = False
+
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", default=list(TARGETS))
+    parser.add_argument("--budget-ms", type=float, default=None, help="fail when an import takes longer than this")
+    args = parser.parse_args()
+
+    results = [report(module, TARGETS.get(module, []), args.budget_ms) for module in args.modules]
+    sys.exit(0 if all(results) else 1)
@@ -1,30 +1,51 @@
+import os
 import time
 import signal
 import logging
+import argparse
+import functools
 import threading
 
-from api.bot import BotAPI
+from typing import TYPE_CHECKING, Dict, List
 
 from utils.stream import Stream
-from utils.models import Config, Memory
+from utils import metrics
+from utils.ipc import PubSubBridge
+from utils.startup import StartupGraph
+from utils.quality import QualityController
+from utils.conversation import ConversationStore
+from utils.models import Channel, Config, Memory
 from utils.pubsub import PubSub, PubEvents
-from utils.deepgram_transcription import TranscriptionServer
-from utils.functions import load_config, save_config, load_memory, save_memory, set_environ, setup_logging
+from utils.journal import MemoryJournal
+from utils.functions import load_config, save_config, load_memory, set_environ, setup_logging, get_channels
+
+
+# The bots, the audio analysis and the transcription backends are imported by the role and backend that uses them
+if TYPE_CHECKING:
+    from api.bot import BotAPI
+    from api.shared import SharedServices
+    from utils.audio import AudioClassifier
+    from utils.deepgram_transcription import TranscriptionServer
+
+# Ingest reads and transcribes the streams, chat runs the bots, all runs both in one process
+ROLES = ["all", "ingest", "chat"]
 
 
 class CLI:
     config: Config
-    memory: Memory
     pubsub: PubSub
-    bot_api: BotAPI
+    shared: "SharedServices"
+    channels: List[Channel]
+    role: str
 
     stop_event = threading.Event()
-    audio_captions: str = ""
     
     setup_logging()
     logger = logging.getLogger('main')
 
-    def __init__(self):
+    def __init__(self, role: str = "all"):
+        self.role = role
+
         # Register shutdown handler
         signal.signal(signal.SIGINT, self.shutdown_handler)
 
@@ -32,7 +53,6 @@ class CLI:
         self.pubsub = PubSub()
 
         # Subscribe to events
-        self.pubsub.subscribe(PubEvents.TRANSCRIPT, self.update_captions)
         self.pubsub.subscribe(PubEvents.SHUTDOWN, self.shutdown)
 
         # Load config from file
@@ -40,41 +60,180 @@ class CLI:
         
         # Set the environment variables
         set_environ(self.config)
-        
-        # Load memory from file
-        self.memory = load_memory()
-        
-        # Initialize the bot API
-        self.bot_api = BotAPI(self.pubsub, self.memory)
 
-        # Initialize the stream
-        self.stream = Stream(self.pubsub)
+        # Every channel gets its own pubsub when several are served, a single channel uses the process pubsub
+        self.channels = get_channels(self.config)
+        self.multi_channel = len(self.channels) > 1
+        self.stopped_channels: set = set()
 
-        # Initialize the transcription server
-        self.transcription = TranscriptionServer(self.pubsub)
-        
-        # Start the main thread, stream and transcription
-        self.stream.start()
-        self.transcription.start()
+        # Channel state by channel name
+        self.channel_pubsubs: Dict[str, PubSub] = {}
+        self.memories: Dict[str, Memory] = {}
+        self.journals: Dict[str, MemoryJournal] = {}
+        self.bot_apis: Dict[str, "BotAPI"] = {}
+        self.streams: Dict[str, Stream] = {}
+        self.transcriptions: Dict[str, "TranscriptionServer"] = {}
+        self.audio_classifiers: Dict[str, "AudioClassifier"] = {}
+        self.bridges: Dict[str, PubSubBridge] = {}
+        self.audio_captions: Dict[str, str] = {}
+
+        # Pass the process wide events on to the channels
+        if self.multi_channel:
+            self.pubsub.subscribe(PubEvents.SHUTDOWN, functools.partial(self.forward, PubEvents.SHUTDOWN))
+            self.pubsub.subscribe(PubEvents.QUALITY_TIER, functools.partial(self.forward, PubEvents.QUALITY_TIER))
+
+        # Independent start-up steps run at the same time, the bots wait for the chat connection and their memory
+        self.startup = StartupGraph()
+
+        if self.role != "ingest":
+            # Connections, pools and models shared by all channels
+            self.startup.add("shared", self.create_shared)
+            self.startup.add("twitch", self.connect_twitch, after=["shared"])
+
+            # Adapt the quality to the load, the tier reaches the ingest process through the bridge and its load comes back through it
+            self.startup.add("quality", self.start_quality_controller)
+
+        for channel in self.channels:
+            self.add_channel(channel)
+
+        try:
+            self.startup.run()
+        except Exception as e:
+            self.logger.error(f"Start-up failed: {e}")
+            self.pubsub.publish(PubEvents.SHUTDOWN)
+            raise
+
+        # Start the main thread
         self.start()
 
-    
+
+    # Add the start-up steps of the parts of a channel that run in this process
+    def add_channel(self, channel: Channel):
+        pubsub = PubSub() if self.multi_channel else self.pubsub
+        self.channel_pubsubs[channel.name] = pubsub
+        self.audio_captions[channel.name] = ""
+
+        # Subscribe to events
+        pubsub.subscribe(PubEvents.TRANSCRIPT, functools.partial(self.update_captions, channel.name))
+
+        # A channel that stops on its own, its stream ended or it was told to exit
+        if self.multi_channel:
+            pubsub.subscribe(PubEvents.SHUTDOWN, functools.partial(self.channel_stopped, channel))
+
+        # The transcription load of the ingest process feeds the quality controller of the chat process
+        if self.role == "chat":
+            pubsub.subscribe(PubEvents.METRICS, metrics.set_gauges)
+
+        if self.role != "ingest":
+            self.startup.add(f"memory.{channel.name}", functools.partial(self.load_channel_memory, channel))
+            self.startup.add(f"bot.{channel.name}", functools.partial(self.add_chat, channel, pubsub), after=["twitch", f"memory.{channel.name}"])
+
+        if self.role != "chat":
+            self.startup.add(f"stream.{channel.name}", functools.partial(self.start_stream, channel, pubsub))
+            self.startup.add(f"transcription.{channel.name}", functools.partial(self.start_transcription, channel, pubsub))
+
+        # The ingest process listens, the chat process connects and both reconnect when the other one restarts
+        if self.role != "all":
+            self.startup.add(f"bridge.{channel.name}", functools.partial(self.start_bridge, channel, pubsub))
+
+
+    # Create the connections, pools and models shared by all channels
+    def create_shared(self):
+        from api.shared import SharedServices
+
+        self.shared = SharedServices(self.pubsub)
+
+
+    # Authenticate and connect to the twitch chat
+    def connect_twitch(self):
+        self.shared.connect_twitch()
+
+
+    # Start adapting the quality to the load
+    def start_quality_controller(self):
+        self.quality_controller = QualityController(self.pubsub)
+        self.quality_controller.start()
+
+
+    # Load the memory of a channel from file and replay the changes made after it was saved
+    def load_channel_memory(self, channel: Channel):
+        path = self.get_memory_path(channel)
+        self.memories[channel.name] = load_memory(path)
+
+        self.journals[channel.name] = MemoryJournal(self.memories[channel.name], path)
+        self.journals[channel.name].open()
+
+
+    # Create the bot of a channel, it joins the chat of the channel
+    def add_chat(self, channel: Channel, pubsub: PubSub):
+        from api.bot import BotAPI
+
+        # Conversations spilled to disk are kept apart per channel
+        spill_dir = os.path.join(ConversationStore.spill_dir, channel.name.lower()) if self.multi_channel else None
+
+        # Initialize the bot API
+        self.bot_apis[channel.name] = BotAPI(pubsub, self.memories[channel.name], self.journals[channel.name], channel, self.shared, spill_dir)
+
+
+    # Connect to the stream of a channel
+    def start_stream(self, channel: Channel, pubsub: PubSub):
+        self.streams[channel.name] = Stream(pubsub, channel.name)
+        self.streams[channel.name].start()
+
+
+    # Load the model or open the websocket of the transcription of a channel and classify its audio
+    def start_transcription(self, channel: Channel, pubsub: PubSub):
+        from utils.audio import AudioClassifier
+
+        if self.config.transcription_backend == "local":
+            from utils.local_transcription import TranscriptionServer
+        else:
+            from utils.deepgram_transcription import TranscriptionServer
+
+        self.audio_classifiers[channel.name] = AudioClassifier(pubsub)
+
+        self.transcriptions[channel.name] = TranscriptionServer(pubsub, channel.name)
+        self.transcriptions[channel.name].start()
+
+
+    # Connect the pubsub of a channel to the other process
+    def start_bridge(self, channel: Channel, pubsub: PubSub):
+        path = os.path.join(self.config.ipc_dir, f"{channel.name.lower()}.sock")
+        self.bridges[channel.name] = PubSubBridge(pubsub, path, listen=self.role == "ingest")
+        self.bridges[channel.name].start()
+
+
+    # Get the memory file of a channel
+    def get_memory_path(self, channel: Channel) -> str:
+        return f"memory_{channel.name.lower()}.json" if self.multi_channel else "memory.json"
+
 
     # Start the main thread.
     def start(self):
         while not self.stop_event.is_set():
-            # update the reaction time
-            time_to_reaction = self.memory.reaction_time - time.time()
-            
             # print status
-            print(f"\nCounter: {self.bot_api.get_message_count()} | Time to reaction: {time_to_reaction}\nCaptions:\n{self.audio_captions}")
+            for channel in self.channels:
+                status = f"\n[{channel.name}]"
+
+                # update the reaction time
+                if channel.name in self.bot_apis:
+                    time_to_reaction = self.memories[channel.name].reaction_time - time.time()
+                    status += f" Counter: {self.bot_apis[channel.name].get_message_count()} | Time to reaction: {time_to_reaction}"
+
+                print(f"{status}\nCaptions:\n{self.audio_captions[channel.name]}")
+
+                # Send the transcription gauges of the channel to the chat process
+                if self.role == "ingest":
+                    self.channel_pubsubs[channel.name].publish(PubEvents.METRICS, metrics.get_gauges(f"transcription.{channel.name.lower()}.*"))
+
+            print(f"\nMetrics: {metrics.format_metrics()}")
 
             # sleep for 5 seconds
             time.sleep(5)
 
 
     # Callable for audio transcript
-    def update_captions(self, transcript: list):
+    def update_captions(self, channel: str, transcript: list):
         # Extract the text from the transcript
         text = map(lambda x: x['text'], transcript)
 
@@ -82,7 +241,29 @@ class CLI:
         transcript_text = "".join(text)
 
         # Update the captions
-        self.audio_captions = transcript_text
+        self.audio_captions[channel] = transcript_text
+
+
+    # Publish a process wide event to every channel that is still running
+    # The last channel to stop publishes the process shutdown while it holds the lock of its own shutdown
+    def forward(self, event: PubEvents, *args):
+        for name, pubsub in list(self.channel_pubsubs.items()):
+            if name not in self.stopped_channels:
+                pubsub.publish(event, *args)
+
+
+    # Save the memory of a stopped channel, the process shuts down with the last one
+    def channel_stopped(self, channel: Channel):
+        if self.stop_event.is_set():
+            return
+
+        self.logger.info(f'Channel {channel.name} stopped')
+        self.stopped_channels.add(channel.name)
+        if channel.name in self.journals:
+            self.journals[channel.name].close()
+
+        if len(self.stopped_channels) == len(self.channels):
+            self.pubsub.publish(PubEvents.SHUTDOWN)
 
 
     # Shutdown handler for when a shutdown signal is received
@@ -100,8 +281,14 @@ class CLI:
         save_config(self.config)
 
         self.logger.info('Saving memory...')
-        save_memory(self.memory)
+        for channel in self.channels:
+            if channel.name in self.journals:
+                self.journals[channel.name].close()
 
 
 if __name__ == '__main__':
-    cli = CLI()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--role", choices=ROLES, default="all", help="run stream ingest and transcription, the chat bots or both in this process")
+    args = parser.parse_args()
+
+    cli = CLI(args.role)
@@ -0,0 +1,18 @@
+import pytest
+
+from utils.journal import MemoryJournal
+from utils.functions import load_memory
+
+
+# Load the memory and its journal the way the bot does at start-up, in a directory of its own
+@pytest.fixture
+def open_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def open_memory(path: str = "memory.json"):
+        memory = load_memory(path)
+        journal = MemoryJournal(memory, path)
+        journal.open()
+        return memory, journal
+
+    return open_memory
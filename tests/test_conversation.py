@@ -0,0 +1,11 @@
+from utils.functions import count_tokens
+from utils.conversation import ConversationStore
+
+
+def test_first_append_is_counted_once(open_memory):
+    memory, journal = open_memory()
+    memory.conversations["bob"] = [{"role": "system", "content": "sys"}, {"role": "user", "content": "bob: hello there"}]
+    store = ConversationStore(memory, journal, spill_dir="conversations")
+
+    store.append("bob", "assistant", "general kenobi")
+    assert store.get_token_count("bob") == count_tokens("bob: hello there") + count_tokens("general kenobi")
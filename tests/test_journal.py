@@ -0,0 +1,65 @@
+from utils import metrics
+from utils.journal import MemoryJournal
+from utils.functions import load_memory
+from utils.conversation import ConversationStore
+
+
+def test_replay_crosses_compaction(open_memory, monkeypatch):
+    monkeypatch.setattr(MemoryJournal, "compact_after", 4)
+    monkeypatch.setattr(MemoryJournal, "commit_interval", 0)
+    monkeypatch.setattr(ConversationStore, "token_budget", 12)
+
+    memory, journal = open_memory()
+    store = ConversationStore(memory, journal, spill_dir="conversations")
+
+    store.init("bob", "sys")
+    for turn in range(1, 9):
+        store.append("bob", "user", f"bob: question number {turn}", wire=f"wire {turn}")
+        store.append("bob", "assistant", f"answer number {turn}")
+        store.trim("bob")
+        journal.flush()
+    memory.banned_users.append("eve")
+    journal.record("add", "banned_users", "eve")
+
+    # Crash without the final snapshot
+    expected = [{key: value for key, value in message.items() if key != "wire"} for message in memory.conversations["bob"]]
+    journal.flush()
+
+    recovered, _ = open_memory()
+    assert recovered.conversations["bob"] == expected
+    assert recovered.summaries["bob"] == memory.summaries["bob"]
+    assert recovered.banned_users == ["eve"]
+
+
+def test_changes_are_written_in_groups(open_memory, monkeypatch):
+    # The writer only takes the changes when it is closed, never because the interval ran out
+    monkeypatch.setattr(MemoryJournal, "commit_interval", 3600)
+
+    memory, journal = open_memory()
+    writes = metrics.get("memory.journal_writes")
+    for username in ("amy", "bob", "cat"):
+        memory.banned_users.append(username)
+        journal.record("add", "banned_users", username)
+    journal.close()
+
+    assert metrics.get("memory.journal_writes") - writes == 1
+    assert load_memory("memory.json").banned_users == ["amy", "bob", "cat"]
+
+
+def test_torn_change_is_dropped(open_memory):
+    memory, journal = open_memory()
+    memory.slow_mode_seconds = 5
+    journal.record("set", "slow_mode_seconds", 5)
+    journal.flush()
+    with journal.lock:
+        journal.file.write('{"op":"set","fie')
+        journal.file.flush()
+
+    recovered, journal = open_memory()
+    assert recovered.slow_mode_seconds == 5
+
+    # New changes follow the last complete one
+    recovered.cooldown_time = 1.0
+    journal.record("set", "cooldown_time", 1.0)
+    journal.flush()
+    assert open_memory()[0].cooldown_time == 1.0
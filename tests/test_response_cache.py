@@ -0,0 +1,17 @@
+from utils.response_cache import ResponseCache
+
+
+def test_personal_answer_is_not_shared():
+    cache = ResponseCache()
+    cache.set("what's my name?", "Bob", "ctx", "Your name is Bob")
+
+    assert cache.get("what's my name?", "alice", "ctx", 0.0) is None
+    assert cache.get("whats my name", "bob", "ctx", 0.0) == "Your name is Bob"
+
+
+def test_general_answer_is_shared():
+    cache = ResponseCache()
+    cache.set("what game is this?", "bob", "ctx", "Elden Ring")
+
+    assert cache.get("what game is this?", "alice", "ctx", 0.0) == "Elden Ring"
+    assert cache.get("what game is this?", "alice", "other", 0.0) is None
@@ -0,0 +1,15 @@
+from utils.router import MessageRouter, VISION
+
+
+def test_goodbyes_skip_vision():
+    router = MessageRouter()
+
+    assert router.route("see you tomorrow") != VISION
+    assert router.route("see ya") != VISION
+
+
+def test_questions_about_the_screen_take_vision():
+    router = MessageRouter()
+
+    assert router.route("can you see my screen") == VISION
+    assert router.route("did u see that") == VISION
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import threading
+
+from typing import Any, Coroutine
+from concurrent.futures import Future
+
+
+class AsyncLoop:
+    loop: asyncio.AbstractEventLoop
+    thread: threading.Thread
+
+    logger = logging.getLogger("async_loop")
+
+    def __init__(self, name: str = "async_loop"):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+
+    # Start the event loop thread
+    def start(self):
+        self.thread.start()
+
+
+    # Run the event loop until it is stopped
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+        # Cancel whatever is still pending and close the loop
+        pending = asyncio.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+
+
+    # Stop the event loop and wait for the thread to finish
+    def stop(self, timeout: float = 5):
+        if self.loop.is_closed():
+            return
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+
+
+    # Submit a coroutine to the loop, optionally waiting for its result
+    def submit(self, coroutine: Coroutine, wait: bool = False, timeout: float = None) -> Any | Future:
+        # Waiting from inside the loop thread would deadlock the loop
+        if wait and threading.current_thread() is self.thread:
+            coroutine.close()
+            raise RuntimeError(f"Cannot wait for a coroutine from inside the {self.name} loop")
+
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+        if wait:
+            return future.result(timeout)
+
+        # Log errors of fire and forget coroutines
+        future.add_done_callback(self.log_exception)
+        return future
+
+
+    # Log the exception of a finished future
+    def log_exception(self, future: Future):
+        if future.cancelled():
+            return
+
+        error = future.exception()
+        if error is not None:
+            self.logger.error(f"[{self.name}] Coroutine failed: {error}")
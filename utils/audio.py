@@ -0,0 +1,179 @@
+import time
+import logging
+
+import numpy as np
+
+from collections import Counter, deque
+
+from utils import metrics
+from utils.pubsub import PubSub, PubEvents
+
+# States of the stream audio
+SILENCE = "silence"
+SPEECH = "speech"
+MUSIC = "music"
+
+
+class AudioClassifier:
+    pubsub: PubSub
+    change_detector: "AudioChangeDetector"
+
+    logger = logging.getLogger("audio_classifier")
+
+    # Format of the published audio frames, 16 kHz mono signed 16 bit pcm
+    sample_rate: int = 16000
+
+    # Windows are classified as a whole, their features are computed over short frames
+    window_seconds: float = 1.0
+    frame_size: int = 512
+
+    # Level below which a window is silence
+    silence_rms: float = 0.01
+
+    # Speech has many quiet frames between syllables, music is steady and either tonal or rhythmic
+    speech_low_energy_ratio: float = 0.25
+    music_flatness: float = 0.3
+    music_onset_rate: float = 6
+
+    # Number of windows the state is smoothed over
+    smoothing_windows: int = 3
+
+    def __init__(self, pubsub: PubSub):
+        self.pubsub = pubsub
+        self.change_detector = AudioChangeDetector(pubsub, self.sample_rate, self.frame_size)
+
+        self.buffer = bytearray()
+        self.window_size = int(self.sample_rate * self.window_seconds)
+        self.hanning = np.hanning(self.frame_size).astype(np.float32)
+
+        self.decisions: deque = deque(maxlen=self.smoothing_windows)
+        self.state = SILENCE
+
+        self.pubsub.subscribe(PubEvents.AUDIO_FRAMES, self.add_frames)
+
+
+    # Collect the published pcm bytes into windows
+    def add_frames(self, pcm: bytes):
+        window_bytes = self.window_size * 2
+        self.buffer += pcm
+
+        while len(self.buffer) >= window_bytes:
+            window = np.frombuffer(bytes(self.buffer[:window_bytes]), dtype=np.int16).astype(np.float32) / 32768.0
+            del self.buffer[:window_bytes]
+            self.process_window(window)
+
+
+    # Classify a window, publish the state when it changes and pass the window on to the track change detection
+    def process_window(self, window: np.ndarray):
+        frames = window[:len(window) // self.frame_size * self.frame_size].reshape(-1, self.frame_size)
+        power = np.abs(np.fft.rfft(frames * self.hanning, axis=1)) ** 2
+
+        self.decisions.append(self.classify(frames, power))
+        state = Counter(self.decisions).most_common(1)[0][0]
+        metrics.increment(f"audio.{state}_s", self.window_seconds)
+
+        if state != self.state:
+            self.logger.debug(f"Audio state changed from {self.state} to {state}")
+            self.state = state
+            self.pubsub.publish(PubEvents.AUDIO_STATE, state)
+
+        self.change_detector.process_window(power, state)
+
+
+    # Classify a window from its energy, spectral flatness and onset rate
+    def classify(self, frames: np.ndarray, power: np.ndarray) -> str:
+        frame_rms = np.sqrt(np.mean(frames ** 2, axis=1))
+        if np.sqrt(np.mean(frame_rms ** 2)) < self.silence_rms:
+            return SILENCE
+
+        # Share of frames well below the average energy
+        low_energy_ratio = np.mean(frame_rms < 0.5 * frame_rms.mean())
+
+        # Geometric over arithmetic mean of the spectrum, low for tonal sound and high for noise
+        power = power + 1e-10
+        flatness = np.mean(np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1))
+
+        # Rising spectral energy that stands out marks an onset
+        flux = np.sum(np.maximum(0, np.diff(np.sqrt(power), axis=0)), axis=1)
+        onset_rate = np.sum(flux > flux.mean() + flux.std()) / self.window_seconds
+
+        if low_energy_ratio >= self.speech_low_energy_ratio:
+            return SPEECH
+        if flatness < self.music_flatness or onset_rate >= self.music_onset_rate:
+            return MUSIC
+        return SPEECH
+
+
+class AudioChangeDetector:
+    pubsub: PubSub
+
+    logger = logging.getLogger("audio_change")
+
+    # Spectral profiles are computed per window, the last few windows are compared against the ones before them
+    num_bands: int = 16
+    recent_windows: int = 4
+    history_windows: int = 20
+
+    # Cosine distance between the recent and earlier profile that counts as a new track
+    # and the shortest time between two track changes
+    change_threshold: float = 0.25
+    min_track_seconds: float = 30
+
+    def __init__(self, pubsub: PubSub, sample_rate: int, frame_size: int):
+        self.pubsub = pubsub
+
+        self.profiles: deque = deque(maxlen=self.recent_windows + self.history_windows)
+        self.last_change = time.monotonic()
+
+        # Log spaced frequency bands from 60 Hz to the nyquist frequency
+        edges = np.geomspace(60, sample_rate / 2, self.num_bands + 1)
+        self.band_starts = (edges[:-1] * frame_size / sample_rate).astype(int)
+
+
+    # Get the normalized log band energies of the frame spectra of a window
+    def get_profile(self, power: np.ndarray) -> np.ndarray:
+        profile = np.log1p(np.add.reduceat(power.mean(axis=0), self.band_starts))
+        norm = np.linalg.norm(profile)
+        return profile / norm if norm else profile
+
+
+    # Compare a window with the track so far, only music windows are part of a track
+    def process_window(self, power: np.ndarray, state: str):
+        # Silence after music ends the track
+        if state == SILENCE:
+            if self.profiles:
+                self.profiles.clear()
+                self.track_changed("silence")
+            return
+
+        # Talking over the music does not change the track
+        if state != MUSIC:
+            return
+
+        self.profiles.append(self.get_profile(power))
+        if len(self.profiles) < self.profiles.maxlen:
+            return
+
+        profiles = np.array(self.profiles)
+        history = profiles[:self.history_windows].mean(axis=0)
+        recent = profiles[self.history_windows:].mean(axis=0)
+        distance = 1 - np.dot(history, recent) / (np.linalg.norm(history) * np.linalg.norm(recent))
+
+        if distance > self.change_threshold:
+            # The recent windows start the new track
+            recent = list(self.profiles)[-self.recent_windows:]
+            self.profiles.clear()
+            self.profiles.extend(recent)
+            self.track_changed(f"spectral distance {distance:.2f}")
+
+
+    # Publish a track change unless the last one was too recent
+    def track_changed(self, reason: str):
+        now = time.monotonic()
+        if now - self.last_change < self.min_track_seconds:
+            return
+
+        self.last_change = now
+        metrics.increment("audio.track_changes")
+        self.logger.debug(f"Track changed ({reason})")
+        self.pubsub.publish(PubEvents.TRACK_CHANGE)
@@ -0,0 +1,78 @@
+import time
+import threading
+
+from typing import Any, Hashable, List, Tuple
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, max_entries: int = 256, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Entries by key as (expiry time, value), ordered from least to most recently used
+        self.entries: OrderedDict[Hashable, Tuple[float, Any]] = OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.entries)
+
+
+    # Get a value, returns the default if it is missing or expired
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return default
+
+            self.entries.move_to_end(key)
+            return entry[1]
+
+
+    # Add or replace a value, evicting the least recently used entry when full
+    def set(self, key: Hashable, value: Any, ttl: float = None):
+        expiry = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        with self.lock:
+            self.entries[key] = (expiry, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+    # Remove a value
+    def delete(self, key: Hashable):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+    # Remove all values
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    # Get all entries that have not expired, expired entries are dropped
+    def items(self) -> List[Tuple[Hashable, Any]]:
+        now = time.monotonic()
+
+        with self.lock:
+            expired = [key for key, (expiry, _) in self.entries.items() if expiry < now]
+            for key in expired:
+                del self.entries[key]
+
+            return [(key, value) for key, (_, value) in self.entries.items()]
+
+
+    # Mark a key as recently used
+    def touch(self, key: Hashable):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
@@ -0,0 +1,156 @@
+import re
+import logging
+
+from typing import Callable, Dict, List, Tuple
+
+from utils.functions import count_tokens
+
+
+class ContextBuilder:
+    logger = logging.getLogger("context_builder")
+
+    # Token budget of the whole context and the share the transcript and chat may take at most,
+    # the description gets whatever is left
+    token_budget: int = 600
+    transcript_share: float = 0.5
+    chat_share: float = 0.35
+
+    def __init__(self):
+        # Rendered fragments by section, each entry is (inputs key, fragment, tokens)
+        self.cache: Dict[str, Tuple[tuple, str, int]] = {}
+
+
+    # Build the context for a chat message within the token budget
+    def build(self, transcript: list, chat_history: List[str], description: str, username: str, message: str) -> str:
+        remaining = self.token_budget
+
+        # The transcript may be updated in place by the transcription thread
+        transcript = list(transcript)
+
+        # Most recent transcript first
+        transcript_cap = min(remaining, int(self.token_budget * self.transcript_share))
+        transcript_string, transcript_tokens = self.render_transcript(transcript, transcript_cap)
+        remaining -= transcript_tokens
+
+        # Then the chat lines relevant to the message, including what the transcript left unused
+        chat_cap = min(remaining, int(self.token_budget * self.chat_share) + transcript_cap - transcript_tokens)
+        chat_string, chat_tokens = self.render_chat(chat_history, username, message, chat_cap)
+        remaining -= chat_tokens
+
+        # Then the description with the rest of the budget
+        description_string, description_tokens = self.render_description(description, remaining)
+
+        total = transcript_tokens + chat_tokens + description_tokens
+        self.logger.debug(f"Context tokens: transcript {transcript_tokens} | chat {chat_tokens} | description {description_tokens} | total {total}/{self.token_budget}")
+
+        return f"<<context>> {description_string} {chat_string} {transcript_string} <</context>>"
+
+
+    # Return the cached fragment of a section or render it again if its inputs changed
+    def cached(self, section: str, key: tuple, render: Callable[[], Tuple[str, int]]) -> Tuple[str, int]:
+        entry = self.cache.get(section)
+        if entry is not None and entry[0] == key:
+            return entry[1], entry[2]
+
+        fragment, tokens = render()
+        self.cache[section] = (key, fragment, tokens)
+        return fragment, tokens
+
+
+    # Render the newest transcript segments that fit in the budget
+    def render_transcript(self, transcript: list, budget: int) -> Tuple[str, int]:
+        if not transcript or budget <= 0:
+            return "", 0
+
+        # The transcript list is updated in place, so the key is built from its content
+        key = (len(transcript), transcript[0]['start'], transcript[-1]['start'], transcript[-1]['text'], budget)
+
+        def render():
+            texts = []
+            tokens = count_tokens("- Audio transcript:")
+
+            for segment in reversed(transcript):
+                segment_tokens = count_tokens(segment['text'])
+                if tokens + segment_tokens > budget:
+                    break
+                texts.append(segment['text'])
+                tokens += segment_tokens
+
+            if not texts:
+                return "", 0
+
+            return f"\n- Audio transcript: {''.join(reversed(texts))}", tokens
+
+        return self.cached("transcript", key, render)
+
+
+    # Render the chat lines most relevant to the message that fit in the budget, in their original order
+    # Not cached, the message is new with every request
+    def render_chat(self, chat_history: List[str], username: str, message: str, budget: int) -> Tuple[str, int]:
+        if not chat_history or budget <= 0:
+            return "", 0
+
+        words = self.get_words(message)
+        tokens = count_tokens("- Twitch chat history: ''")
+
+        # Rank the lines by shared words and by the user, newer lines win ties
+        ranked = sorted(
+            range(len(chat_history)),
+            key=lambda index: (self.score_chat_line(chat_history[index], username, words), index),
+            reverse=True
+        )
+
+        selected = []
+        for index in ranked:
+            line_tokens = count_tokens(chat_history[index]) + 1
+            if tokens + line_tokens > budget:
+                continue
+            selected.append(index)
+            tokens += line_tokens
+
+        if not selected:
+            return "", 0
+
+        twitch_chat = '\n'.join(chat_history[index] for index in sorted(selected))
+        return f"\n- Twitch chat history: '{twitch_chat}'", tokens
+
+
+    # Render the channel description, cut to the budget
+    def render_description(self, description: str, budget: int) -> Tuple[str, int]:
+        if not description or budget <= 0:
+            return "", 0
+
+        key = (description, budget)
+
+        def render():
+            tokens = count_tokens("- Channel description:")
+            words = []
+
+            for word in description.split():
+                word_tokens = count_tokens(word)
+                if tokens + word_tokens > budget:
+                    break
+                words.append(word)
+                tokens += word_tokens
+
+            if not words:
+                return "", 0
+
+            return f"\n- Channel description: {' '.join(words)}", tokens
+
+        return self.cached("description", key, render)
+
+
+    # Score a chat line by the words it shares with the message and whether it was written by the user
+    def score_chat_line(self, line: str, username: str, words: set) -> int:
+        author, _, text = line.partition(": ")
+        score = len(words & self.get_words(text))
+        if author.lower() == username.lower():
+            score += 2
+        return score
+
+
+    # Get the lower case words of a text, short words are ignored
+    @staticmethod
+    def get_words(text: str) -> set:
+        return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 2}
@@ -0,0 +1,309 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from typing import Dict, List
+from collections import OrderedDict
+
+from utils import metrics
+from utils.models import Memory
+from utils.journal import MemoryJournal
+from utils.functions import count_tokens
+
+
+class ConversationStore:
+    memory: Memory
+    journal: MemoryJournal
+
+    logger = logging.getLogger("conversation_store")
+
+    # Token budget of a conversation without the system prompt and of the rolling summary
+    token_budget: int = 1200
+    summary_token_budget: int = 200
+
+    # Words kept from each message when it is folded into the summary
+    summary_words: int = 15
+
+    # Users kept in memory, idle time in seconds after which a user is spilled to disk and where to
+    max_users: int = 500
+    idle_ttl: float = 3600
+    spill_dir: str = "conversations"
+
+    # Estimated bytes of a message on top of its content
+    message_overhead: int = 64
+
+    def __init__(self, memory: Memory, journal: MemoryJournal, spill_dir: str = None):
+        self.memory = memory
+        self.journal = journal
+        if spill_dir is not None:
+            self.spill_dir = spill_dir
+        self.lock = threading.RLock()
+
+        # Users in memory ordered from least to most recently used, with their last use
+        self.last_used: OrderedDict[str, float] = OrderedDict((username, time.time()) for username in memory.conversations)
+
+        # Estimated size of each conversation in memory
+        self.sizes: Dict[str, int] = {username: self.get_size(conversation) for username, conversation in memory.conversations.items()}
+
+        # The message of each user that still carries its wire form
+        self.pending: Dict[str, dict] = {}
+
+        # Token count of each conversation without the system prompt
+        self.token_counts: Dict[str, int] = {}
+
+
+    # Check if a user has a conversation, a conversation spilled to disk is loaded back
+    def __contains__(self, username: str) -> bool:
+        with self.lock:
+            if username not in self.memory.conversations and not self.load(username):
+                return False
+
+            self.touch(username)
+            self.evict()
+            return True
+
+
+    # Get the stored conversation of a user
+    def get(self, username: str) -> list:
+        return self.memory.conversations[username]
+
+
+    # Get the messages to send for a user, the summary of evicted turns follows the system prompt
+    def get_messages(self, username: str) -> list:
+        conversation = self.memory.conversations[username]
+        summary = self.memory.summaries.get(username)
+
+        # Send the wire form of the pending message, the history form of everything else
+        messages = [
+            {"role": message["role"], "content": message["wire"]} if "wire" in message else message
+            for message in conversation
+        ]
+
+        if summary:
+            messages.insert(1, {
+                "role": "system",
+                "content": f"Summary of your earlier conversation with {username}:\n" + "\n".join(summary)
+            })
+
+        return messages
+
+
+    # Start a conversation with the system prompt
+    def init(self, username: str, system_prompt: str):
+        self.memory.conversations[username] = [
+            {
+                "role": "system",
+                "content": system_prompt
+            }
+        ]
+        self.journal.record("put", "conversations", self.memory.conversations[username], key=username)
+        self.token_counts[username] = 0
+        self.pending.pop(username, None)
+
+        with self.lock:
+            self.sizes[username] = self.get_size(self.memory.conversations[username])
+            self.touch(username)
+            self.evict()
+
+
+    # Add a message to the conversation of a user, the wire form is only sent with the next request
+    def append(self, username: str, role: str, content: str, wire: str | list = None):
+        message = {"role": role, "content": content}
+
+        # Only the newest message keeps its wire form
+        self.drop_wire(username)
+        if wire is not None:
+            message["wire"] = wire
+            self.pending[username] = message
+
+        # Count the conversation before the message is added, a conversation counted for the first time would hold it already
+        tokens = self.get_token_count(username)
+
+        # The change is recorded once it is made, a snapshot taken for the record always holds it
+        conversation = self.memory.conversations[username]
+        conversation.append(message)
+        self.journal.record("append", "conversations", {"role": role, "content": content}, key=username, index=len(conversation) - 1)
+        self.token_counts[username] = tokens + count_tokens(content)
+        self.sizes[username] = self.sizes.get(username, 0) + len(content) + self.message_overhead
+
+
+    # Replace the system prompt of a conversation
+    def set_system_prompt(self, username: str, system_prompt: str):
+        self.memory.conversations[username][0]["content"] = system_prompt
+        self.record_conversation(username)
+
+
+    # Record the whole conversation and summary of a user in the journal, without the wire form
+    def record_conversation(self, username: str):
+        conversation = [{key: value for key, value in message.items() if key != "wire"} for message in self.memory.conversations[username]]
+        self.journal.record("put", "conversations", conversation, key=username)
+
+        if username in self.memory.summaries:
+            self.journal.record("put", "summaries", self.memory.summaries[username], key=username)
+
+
+    # Drop the wire form of the pending message of a user
+    def drop_wire(self, username: str):
+        message = self.pending.pop(username, None)
+        if message is not None:
+            message.pop("wire", None)
+
+
+    # Remove the conversation and summary of a user, in memory and on disk
+    def clear(self, username: str):
+        with self.lock:
+            self.unload(username)
+
+            path = self.get_spill_path(username)
+            if os.path.exists(path):
+                os.remove(path)
+
+            self.update_metrics()
+
+
+    # Forget everything about a user that is kept in memory
+    def unload(self, username: str):
+        if self.memory.conversations.pop(username, None) is not None:
+            self.journal.record("delete", "conversations", key=username)
+        if self.memory.summaries.pop(username, None) is not None:
+            self.journal.record("delete", "summaries", key=username)
+
+        self.token_counts.pop(username, None)
+        self.pending.pop(username, None)
+        self.last_used.pop(username, None)
+        self.sizes.pop(username, None)
+
+
+    # Mark a user as recently used
+    def touch(self, username: str):
+        self.last_used[username] = time.time()
+        self.last_used.move_to_end(username)
+
+
+    # Spill idle users and the least recently used users over the limit to disk
+    def evict(self):
+        with self.lock:
+            now = time.time()
+
+            while self.last_used:
+                username, last_used = next(iter(self.last_used.items()))
+                if len(self.last_used) <= self.max_users and now - last_used < self.idle_ttl:
+                    break
+                self.spill(username)
+
+            self.update_metrics()
+
+
+    # Write the conversation of a user to disk and drop it from memory
+    def spill(self, username: str):
+        # A pending wire form is never written to disk
+        self.drop_wire(username)
+
+        conversation = self.memory.conversations.get(username)
+        if conversation is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(self.get_spill_path(username), "w") as outfile:
+                json.dump({"conversation": conversation, "summary": self.memory.summaries.get(username, [])}, outfile)
+
+        self.unload(username)
+        self.logger.debug(f"Spilled conversation of {username} to disk")
+
+
+    # Load the conversation of a user back from disk, returns False if there is none
+    def load(self, username: str) -> bool:
+        path = self.get_spill_path(username)
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with open(path, "r") as infile:
+                data = json.load(infile)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Failed to load conversation of {username}: {e}")
+            return False
+
+        os.remove(path)
+
+        self.memory.conversations[username] = data["conversation"]
+        if data.get("summary"):
+            self.memory.summaries[username] = data["summary"]
+        self.record_conversation(username)
+        self.sizes[username] = self.get_size(data["conversation"])
+        self.touch(username)
+        self.logger.debug(f"Loaded conversation of {username} from disk")
+
+        self.evict()
+        return True
+
+
+    # Get the file a user is spilled to
+    def get_spill_path(self, username: str) -> str:
+        filename = re.sub(r"[^\w]", "_", username.lower())
+        return os.path.join(self.spill_dir, f"{filename}.json")
+
+
+    # Estimate the size of a conversation in bytes
+    def get_size(self, conversation: list) -> int:
+        return sum(len(str(message.get("content", ""))) + self.message_overhead for message in conversation)
+
+
+    # Publish the memory accounting of the store
+    def update_metrics(self):
+        metrics.set_gauge("conversations.users", len(self.last_used))
+        metrics.set_gauge("conversations.kbytes", sum(self.sizes.values()) / 1024)
+
+
+    # Get the token count of a conversation, counted once for conversations loaded from memory
+    def get_token_count(self, username: str) -> int:
+        if username not in self.token_counts:
+            conversation = self.memory.conversations[username]
+            self.token_counts[username] = sum(count_tokens(message["content"]) for message in conversation[1:])
+        return self.token_counts[username]
+
+
+    # Trim the conversation to the token budget, evicted turns are folded into the summary
+    def trim(self, username: str):
+        conversation = self.memory.conversations[username]
+        tokens = self.get_token_count(username)
+        evicted = []
+
+        # Evict whole turns, always keeping the system prompt and the latest exchange
+        while len(conversation) > 3 and (tokens > self.token_budget or conversation[1].get("role") != "user"):
+            message = conversation.pop(1)
+            tokens -= count_tokens(message["content"])
+            evicted.append(message)
+
+        self.token_counts[username] = tokens
+        self.sizes[username] = self.get_size(conversation)
+
+        # Only the new length and the summary are recorded, not the whole conversation
+        if evicted:
+            self.fold_into_summary(username, evicted)
+            self.journal.record("trim", "conversations", len(conversation), key=username)
+            self.journal.record("put", "summaries", self.memory.summaries[username], key=username)
+            self.logger.debug(f"Evicted {len(evicted)} messages of {username}, {tokens} tokens left")
+
+
+    # Add the evicted messages to the summary and drop its oldest lines when it is over budget
+    def fold_into_summary(self, username: str, messages: List[dict]):
+        summary: list = self.memory.summaries.setdefault(username, [])
+
+        for message in messages:
+            words = str(message.get("content", "")).split()
+            if not words:
+                continue
+
+            text = " ".join(words[:self.summary_words])
+            if len(words) > self.summary_words:
+                text += "..."
+
+            # User messages already start with the username
+            if message.get("role") == "assistant":
+                text = f"you: {text}"
+            summary.append(f"- {text}")
+
+        while len(summary) > 1 and sum(count_tokens(line) for line in summary) > self.summary_token_budget:
+            summary.pop(0)
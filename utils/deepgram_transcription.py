@@ -1,20 +1,29 @@
 import os
 import json
+import time
 import logging
 import threading
 import websocket
 import subprocess
 
+from utils.lag import LagTracker
+from utils.audio import MUSIC, SILENCE
 from utils.ffmpeg_base import FfmpegBase
 from utils.pubsub import PubSub, PubEvents
 
 from websocket import WebSocketConnectionClosedException
 
 class TranscriptionServer(FfmpegBase):
-    def __init__(self, pubsub: PubSub):
+    # Replace music without speech with silence so deepgram does not transcribe it
+    # Off by default, speech over background music is classified as music too, when on only music that lasted this long is replaced
+    skip_music: bool = False
+    min_music_seconds: float = 10
+
+    def __init__(self, pubsub: PubSub, channel: str):
         super().__init__(pubsub)
         
         self.pubsub = pubsub
+        self.channel = channel
         self.stop_event = threading.Event()
 
         self.logger = logging.getLogger("deepgram")
@@ -23,9 +32,19 @@ class TranscriptionServer(FfmpegBase):
         self.transcript = []
         self.transcript_duration_limit = 180
 
+        # Wall clock lag of the transcript behind the stream, deepgram times start at zero with every connection
+        self.lag_tracker = LagTracker(f"transcription.{channel.lower()}", 16000)
+        self.connection_offset = None
+        self.transcript_end = None
+
         # subscribe to showtdown event
         self.pubsub.subscribe(PubEvents.SHUTDOWN, self.stop)   
 
+        # subscribe to the audio state
+        self.audio_state = SILENCE
+        self.music_since: float | None = None
+        self.pubsub.subscribe(PubEvents.AUDIO_STATE, self.set_audio_state)
+
         # WebSocket client
         self.ws = None
         self.ws_is_open = False
@@ -36,6 +55,9 @@ class TranscriptionServer(FfmpegBase):
 
     # Open the WebSocket connection
     def ws_open_connection(self):
+        # The stream time of the new connection is set when its first audio is sent
+        self.connection_offset = None
+
         # Create the WebSocket client
         ws_url = self.create_ws_url()
         extra_headers={"Authorization": f"Token {os.environ['deepgram_api_key']}"}
@@ -95,6 +117,18 @@ class TranscriptionServer(FfmpegBase):
             self.logger.error(f"Error while closing websocket: {e}")
 
 
+    # Callback for the audio state event
+    def set_audio_state(self, state: str):
+        self.audio_state = state
+        self.music_since = time.monotonic() if state == MUSIC else None
+
+
+    # Check if the audio has been music for long enough to replace it
+    def is_sustained_music(self) -> bool:
+        music_since = self.music_since
+        return music_since is not None and time.monotonic() - music_since >= self.min_music_seconds
+
+
     def create_ws_url(self):
         # Options
         encoding = "linear16"
@@ -106,7 +140,7 @@ class TranscriptionServer(FfmpegBase):
         ws_url = f"wss://api.deepgram.com/v1/listen?model={model}&encoding={encoding}&sample_rate={sample_rate}&channels={channels}&smart_format=true"
         
         # Add keywords
-        keywords = [os.environ['bot_username'], os.environ['target_channel']]
+        keywords = [os.environ['bot_username'], self.channel]
         for keyword in keywords:
             ws_url += f"&keywords={keyword}:2"
 
@@ -131,11 +165,23 @@ class TranscriptionServer(FfmpegBase):
             while not self.stop_event.is_set():
                 # Read the audio stream
                 out_bytes = self.ffmpeg_process.stdout.read(4096 * 2)
+                self.lag_tracker.add(len(out_bytes) // 2)
+
+                # Share the pcm audio with the audio analysis
+                self.pubsub.publish(PubEvents.AUDIO_FRAMES, out_bytes)
+
+                # Keep the timing but drop the music
+                if self.skip_music and self.is_sustained_music():
+                    out_bytes = bytes(len(out_bytes))
 
                 # Check if the WebSocket connection is open
                 if not self.check_ws_connection():
                     continue
                 
+                # Map the times of a new connection to the stream time
+                if self.connection_offset is None:
+                    self.start_connection_offset(self.lag_tracker.get_live_edge() - len(out_bytes) / 2 / 16000)
+
                 # Send the audio stream to the WebSocket server
                 self.ws.send(out_bytes, websocket.ABNF.OPCODE_BINARY)
 
@@ -146,6 +192,31 @@ class TranscriptionServer(FfmpegBase):
             self.stop_recording()
 
 
+    # Start the stream time of a connection, audio dropped since the last transcript is marked as a gap
+    def start_connection_offset(self, offset: float):
+        self.connection_offset = offset
+
+        if self.transcript_end is not None and offset - self.transcript_end > 1:
+            gap = offset - self.transcript_end
+            self.transcript.append({
+                'start': round(self.transcript_end, 3),
+                'end': round(offset, 3),
+                'duration': 0.0,
+                'text': f"[skipped {gap:.0f}s] "
+            })
+            self.lag_tracker.record_skip(gap)
+
+
+    # Skip to the live edge by reconnecting, the audio read until the new connection is open is dropped
+    def drop_to_live(self, lag: float):
+        self.logger.warning(f"Transcript was {lag:.1f}s behind the stream, reconnecting at the live edge")
+
+        try:
+            self.ws.close()
+        except Exception as e:
+            self.logger.error(f"Error while closing websocket: {e}")
+
+
     # Handle the opening of the WebSocket connection
     def on_open(self, ws):
         self.ws_is_open = True
@@ -161,8 +232,8 @@ class TranscriptionServer(FfmpegBase):
                 self.logger.debug(f"Deepgram WS Message: {message}")
                 return
 
-            # Get the data
-            start = json_message.get("start")
+            # Get the data in stream time
+            start = (self.connection_offset or 0.0) + json_message.get("start")
             duration = json_message.get("duration")
             end = start + duration
             text: str = json_message['channel']['alternatives'][0]['transcript']
@@ -187,8 +258,14 @@ class TranscriptionServer(FfmpegBase):
                 transcript_duration = sum([float(segment['duration']) for segment in self.transcript])
 
             # publish the transcript
+            self.transcript_end = end
             self.pubsub.publish(PubEvents.TRANSCRIPT, self.transcript)
 
+            # skip to the live edge if the transcript fell too far behind
+            lag = self.lag_tracker.record(end)
+            if self.lag_tracker.is_behind(lag):
+                self.drop_to_live(lag)
+
         except Exception as e:
             self.logger.error(f"Error while processing {message}: {e}")
 
@@ -0,0 +1,203 @@
+import os
+import time
+import logging
+import functools
+import threading
+
+import numpy as np
+
+from typing import List, Tuple
+
+from utils import metrics
+
+
+# Get the samples of 16 bit mono wav bytes as floats
+def wav_to_samples(wav_bytes: bytes) -> np.ndarray:
+    data_start = wav_bytes.find(b"data")
+    data_start = 44 if data_start == -1 else data_start + 8
+
+    pcm = wav_bytes[data_start:]
+    pcm = pcm[:len(pcm) // 2 * 2]
+    return np.frombuffer(pcm, dtype=np.int16).astype(np.float32) / 32768.0
+
+
+# Get the index shared by every channel, one file is only ever written by one index
+@functools.lru_cache(maxsize=None)
+def get_fingerprint_index(path: str = "fingerprints.npz") -> "FingerprintIndex":
+    return FingerprintIndex(path)
+
+
+class FingerprintIndex:
+    logger = logging.getLogger("fingerprint")
+
+    # Spectrogram settings, audio is downsampled before hashing
+    sample_rate: int = 11025
+    window_size: int = 1024
+    hop_size: int = 256
+
+    # Peaks are local maxima within these many bins and frames, each peak is paired with the next peaks in time
+    freq_radius: int = 10
+    time_radius: int = 5
+    fan_out: int = 8
+    max_time_delta: int = 63
+
+    # Number of hashes that must agree on the same track and time offset for a match
+    min_votes: int = 12
+
+    def __init__(self, path: str = "fingerprints.npz"):
+        self.path = path
+
+        # Hashes sorted for binary search, with the track and frame offset of each hash
+        self.hashes = np.empty(0, dtype=np.uint32)
+        self.track_ids = np.empty(0, dtype=np.uint32)
+        self.offsets = np.empty(0, dtype=np.uint32)
+        self.titles: List[str] = []
+
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.load()
+
+
+    # Compute the peak pair hashes of audio samples with the frame of each anchor peak
+    def fingerprint(self, samples: np.ndarray, sample_rate: int) -> Tuple[np.ndarray, np.ndarray]:
+        empty = np.empty(0, dtype=np.uint32), np.empty(0, dtype=np.uint32)
+
+        # Downsample by averaging, the hashed bands are all below the new nyquist frequency
+        factor = max(1, sample_rate // self.sample_rate)
+        samples = samples[:len(samples) // factor * factor].reshape(-1, factor).mean(axis=1)
+        if len(samples) < self.window_size:
+            return empty
+
+        # Log magnitude spectrogram, the last bin is dropped so frequencies fit in 9 bits
+        frames = np.lib.stride_tricks.sliding_window_view(samples, self.window_size)[::self.hop_size]
+        spectrogram = np.log1p(np.abs(np.fft.rfft(frames * np.hanning(self.window_size), axis=1))[:, :-1])
+
+        # Peaks are the local maxima that stand out from the rest of the spectrogram
+        local_max = self.sliding_max(self.sliding_max(spectrogram, self.freq_radius, axis=1), self.time_radius, axis=0)
+        peaks = (spectrogram == local_max) & (spectrogram > spectrogram.mean() + spectrogram.std())
+        peak_times, peak_freqs = np.nonzero(peaks)
+        if len(peak_times) < 2:
+            return empty
+
+        # Pair each peak with the following peaks, sorted by time already
+        hashes, anchors = [], []
+        for step in range(1, self.fan_out + 1):
+            anchor_times, target_times = peak_times[:-step], peak_times[step:]
+            anchor_freqs, target_freqs = peak_freqs[:-step], peak_freqs[step:]
+
+            delta = target_times - anchor_times
+            valid = (delta > 0) & (delta <= self.max_time_delta)
+
+            hashes.append((anchor_freqs[valid].astype(np.uint32) << 15) | (target_freqs[valid].astype(np.uint32) << 6) | delta[valid].astype(np.uint32))
+            anchors.append(anchor_times[valid].astype(np.uint32))
+
+        return np.concatenate(hashes), np.concatenate(anchors)
+
+
+    # Maximum of each value and its neighbours within the radius along an axis
+    @staticmethod
+    def sliding_max(values: np.ndarray, radius: int, axis: int) -> np.ndarray:
+        padding = [(0, 0)] * values.ndim
+        padding[axis] = (radius, radius)
+        padded = np.pad(values, padding, constant_values=-np.inf)
+        return np.lib.stride_tricks.sliding_window_view(padded, 2 * radius + 1, axis=axis).max(axis=-1)
+
+
+    # Find the track of audio samples, None if it is not indexed
+    def match(self, samples: np.ndarray, sample_rate: int) -> str | None:
+        start = time.perf_counter()
+        query_hashes, query_offsets = self.fingerprint(samples, sample_rate)
+
+        with self.lock:
+            if not len(self.hashes) or not len(query_hashes):
+                return None
+
+            # Binary search the range of every query hash
+            left = np.searchsorted(self.hashes, query_hashes, side="left")
+            right = np.searchsorted(self.hashes, query_hashes, side="right")
+            counts = right - left
+            total = int(counts.sum())
+            if not total:
+                metrics.increment("fingerprint.misses")
+                return None
+
+            # Expand the ranges into the matching entries
+            query_index = np.repeat(np.arange(len(query_hashes)), counts)
+            entry_index = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(left, counts)
+
+            tracks = self.track_ids[entry_index].astype(np.int64)
+            deltas = self.offsets[entry_index].astype(np.int64) - query_offsets[query_index].astype(np.int64)
+
+        # Matching audio has many hashes at the same offset into the same track
+        keys, votes = np.unique((tracks << 32) | (deltas & 0xFFFFFFFF), return_counts=True)
+        best = int(np.argmax(votes))
+        elapsed = (time.perf_counter() - start) * 1000
+
+        if votes[best] < self.min_votes:
+            metrics.increment("fingerprint.misses")
+            self.logger.debug(f"No local match ({votes[best]} votes, {elapsed:.1f}ms)")
+            return None
+
+        title = self.titles[int(keys[best] >> 32)]
+        metrics.increment("fingerprint.hits")
+        self.logger.debug(f"Local match '{title}' ({votes[best]} votes, {elapsed:.1f}ms)")
+        return title
+
+
+    # Index the audio samples of a track and save the index in the background
+    def add(self, title: str, samples: np.ndarray, sample_rate: int):
+        hashes, offsets = self.fingerprint(samples, sample_rate)
+        if not len(hashes):
+            return
+
+        order = np.argsort(hashes, kind="stable")
+        hashes, offsets = hashes[order], offsets[order]
+
+        with self.lock:
+            if title not in self.titles:
+                self.titles.append(title)
+            track_id = self.titles.index(title)
+
+            # Merge the new hashes into the sorted arrays
+            positions = np.searchsorted(self.hashes, hashes)
+            self.hashes = np.insert(self.hashes, positions, hashes)
+            self.track_ids = np.insert(self.track_ids, positions, np.full(len(hashes), track_id, dtype=np.uint32))
+            self.offsets = np.insert(self.offsets, positions, offsets)
+
+        metrics.set_gauge("fingerprint.tracks", len(self.titles))
+        self.logger.info(f"Indexed {len(hashes)} hashes of '{title}'")
+
+        threading.Thread(target=self.save, name="fingerprint_save", daemon=True).start()
+
+
+    # Load the index from disk
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with np.load(self.path) as data:
+                self.hashes = data["hashes"]
+                self.track_ids = data["track_ids"]
+                self.offsets = data["offsets"]
+                self.titles = [str(title) for title in data["titles"]]
+
+            metrics.set_gauge("fingerprint.tracks", len(self.titles))
+            self.logger.info(f"Loaded {len(self.titles)} tracks from {self.path}")
+
+        except Exception as e:
+            self.logger.error(f"Failed to load fingerprint index: {e}")
+
+
+    # Save the index to disk, replacing the old file at once so a crash never leaves half an index
+    def save(self):
+        with self.lock:
+            hashes, track_ids, offsets, titles = self.hashes, self.track_ids, self.offsets, list(self.titles)
+
+        temp_path = f"{self.path}.tmp.npz"
+        with self.save_lock:
+            try:
+                np.savez(temp_path, hashes=hashes, track_ids=track_ids, offsets=offsets, titles=np.array(titles, dtype=str))
+                os.replace(temp_path, self.path)
+            except Exception as e:
+                self.logger.error(f"Failed to save fingerprint index: {e}")
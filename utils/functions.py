@@ -4,58 +4,45 @@ import sys
 import json
 import time
 import logging
+import functools
 import dataclasses
 
-from utils.models import Config, Memory
+from typing import List
 
-# Remove quotations from the message
-def remove_quotations(text: str):
-    while text.startswith('"') and text.endswith('"'):
-        text = str(text[1:-1])
-    return str(text)
-
-
-# Remove mentions from the message
-def remove_mentions(text: str, username: str, bot_username: str):
-    text = text.replace("@User", "").replace("@user", "").replace(f"@{bot_username}", "").replace(
-        f"@{username}:", "").replace(f"@{username}", "").replace(f"{bot_username}:", "")
-    return text
-
-
-# Remove links from the message
-def remove_links(text: str):
-    link_regex = r"\b[a-zA-Z]+\.[a-zA-Z]+\b"
-    links = re.findall(link_regex, text)
-    # Replace links with a placeholder
-    for link in links:
-        text = text.replace(link, '***')
-
-    return text
+from utils.models import Channel, Config, Memory
+from utils.sanitizer import get_sanitizer
 
-
-# Remove hashtags from the message
-def remove_hashtags(text: str):
-    # Define the regex pattern to match hashtags
-    pattern = r'#\w+'
-
-    # Use the sub() function from the re module to remove the hashtags
-    cleaned_text = re.sub(pattern, '', text)
-
-    return cleaned_text
+# Remove quotations wrapping the message
+def remove_quotations(text: str):
+    count = min(len(text) - len(text.lstrip('"')), len(text) - len(text.rstrip('"')))
+    return text[count:len(text) - count]
 
 
 # Remove unwanted charachters from the message
 def clean_message(message: str, username: str, finish_reason: str, bot_username: str):
-    message = remove_mentions(message, username, bot_username)
-    message = remove_hashtags(message)
-    message = remove_links(message)
-    message = message.replace("\n", " ")
+    message = get_sanitizer(username, bot_username).clean(message)
     message = remove_quotations(message)
     if finish_reason == "length":
         message = f"{message}..."
     return message
 
 
+# Split the complete sentences off a streamed text buffer, returns the sentences and the incomplete remainder
+def split_sentences(text: str):
+    parts = re.split(r"(?<=[.!?])\s+", text)
+    return parts[:-1], parts[-1]
+
+
+# Words and single punctuation characters, used for local token estimates
+TOKEN_REGEX = re.compile(r"\w+|[^\w\s]")
+
+
+# Estimate the number of tokens in a text locally, a word counts as one token per 4 characters and punctuation as one token
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    return sum(max(1, len(piece) // 4) for piece in TOKEN_REGEX.findall(text))
+
+
 # Check if the message contains any banned words
 def check_banned_words(message: str, banned_words: list):
     return next((word for word in banned_words if word.lower() in message.lower()), None)
@@ -140,6 +127,12 @@ def set_environ(config: Config):
         os.environ[key] = str(value)
 
 
+# Get the channels to serve, a single channel unless several are configured
+def get_channels(config: Config) -> List[Channel]:
+    names = [name.strip() for name in config.target_channels.split(",") if name.strip()]
+    return [Channel(name) for name in names or [config.target_channel]]
+
+
 # Load config from json file
 def load_config() -> Config:
     try:
@@ -170,31 +163,43 @@ def save_config(config: Config) -> None:
 
 
 # Load memory from json file
-def load_memory() -> Memory:
+def load_memory(path: str = "memory.json") -> Memory:
     try:
-        with open("memory.json", "r") as infile:
+        with open(path, "r") as infile:
             json_data = json.load(infile)
             loaded_memory = Memory(**json_data)
-            return loaded_memory
+
+        # Clean conversations saved before messages were stored cleaned
+        for user, conversation in loaded_memory.conversations.items():
+            if any(isinstance(message.get("content"), list) or "<<context>>" in (message.get("content") or "") for message in conversation[1:]):
+                loaded_memory.conversations[user] = clean_conversation(conversation)
+
+        return loaded_memory
 
     except FileNotFoundError:
-        with open("memory.json", "w") as outfile:
+        with open(path, "w") as outfile:
             json.dump(dataclasses.asdict(Memory()), outfile, indent=4)
-        with open("memory.json", "r") as infile:
+        with open(path, "r") as infile:
             json_data = json.load(infile)
             loaded_memory = Memory(**json_data)
             return loaded_memory
 
 
 # Save memory to json file
-def save_memory(memory: Memory) -> None:
-    # Clean all conversations
-    for user, conversation in memory.conversations.items():
-        memory.conversations[user] = clean_conversation(conversation)
-
-    # Save the memory to the json file
-    with open("memory.json", "w") as outfile:
-        json.dump(dataclasses.asdict(memory), outfile, indent=4)
+def save_memory(memory: Memory, path: str = "memory.json") -> None:
+    data = dataclasses.asdict(memory)
+
+    # Drop the wire form of messages that never got a response, the memory itself is left as it is
+    for conversation in data["conversations"].values():
+        conversation[-1].pop("wire", None)
+
+    # Save the memory to a temporary file and swap it in, a crash never leaves a half written memory file
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as outfile:
+        json.dump(data, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp_path, path)
 
 
 def setup_logging(level: int = logging.DEBUG):
@@ -0,0 +1,314 @@
+import os
+import queue
+import socket
+import struct
+import marshal
+import logging
+import functools
+import threading
+
+from typing import Dict, Set
+
+from utils import metrics
+from utils.pubsub import PubSub, PubEvents
+
+# Kinds of frames sent between two bridged pubsubs
+EVENT = 0
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+
+
+# Connects the pubsubs of two processes over a unix domain socket, an event is only sent when the other side subscribed to it
+class PubSubBridge:
+    pubsub: PubSub
+
+    logger = logging.getLogger("pubsub_bridge")
+
+    # Frame header of kind, event and payload length, the payload is the marshalled arguments
+    header = struct.Struct("!BBI")
+
+    # Events that stay in their process, either process stops and restarts on its own
+    local_events: Set[PubEvents] = {PubEvents.SHUTDOWN}
+
+    # Frames waiting to be sent before events are dropped and seconds between two connection attempts
+    max_queued: int = 1024
+    reconnect_delay: float = 1
+
+    def __init__(self, pubsub: PubSub, path: str, listen: bool):
+        self.pubsub = pubsub
+        self.path = path
+        self.listen = listen
+        self.name = os.path.splitext(os.path.basename(path))[0]
+
+        self.connection: socket.socket | None = None
+        self.server: socket.socket | None = None
+        self.send_queue: queue.Queue = queue.Queue(maxsize=self.max_queued)
+
+        # Received events waiting to be published with the thread that publishes them, one per event
+        # A slow subscriber never holds up the socket reader nor the other events
+        self.receive_queues: Dict[PubEvents, queue.Queue] = {}
+
+        # Forwarders of the events the other process subscribed to and their subscriptions
+        self.forwarders: Dict[PubEvents, functools.partial] = {}
+        self.forwarder_ids: Dict[PubEvents, object] = {}
+
+        # Events this process subscribed to at the other one
+        self.wanted: Set[PubEvents] = set()
+
+        # The event being published on behalf of the other process, it is not sent back
+        self.receiving = threading.local()
+
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.receive_thread = threading.Thread(target=self.run, name=f"pubsub_bridge_{self.name}", daemon=True)
+        self.send_thread = threading.Thread(target=self.send_frames, name=f"pubsub_bridge_send_{self.name}", daemon=True)
+
+        self.pubsub.watch(self.update_subscription)
+        self.pubsub.subscribe(PubEvents.SHUTDOWN, self.stop)
+
+
+    # Start connecting to the other process
+    def start(self):
+        self.receive_thread.start()
+        self.send_thread.start()
+
+
+    # Stop the bridge, the other process keeps running
+    def stop(self):
+        self.stop_event.set()
+        self.disconnect()
+
+        if self.server is not None:
+            self.server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+    # Connect and receive frames until stopped, a lost connection is connected again
+    def run(self):
+        while not self.stop_event.is_set():
+            connection = self.accept() if self.listen else self.connect()
+            if connection is None:
+                continue
+
+            self.on_connect(connection)
+            try:
+                self.receive_frames(connection)
+            except OSError as e:
+                if not self.stop_event.is_set():
+                    self.logger.warning(f"[{self.name}] Connection lost: {e}")
+            finally:
+                self.disconnect()
+
+
+    # Wait for the other process to connect
+    def accept(self) -> socket.socket | None:
+        if self.server is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.path)
+            self.server.listen(1)
+            self.server.settimeout(self.reconnect_delay)
+
+        try:
+            connection, _ = self.server.accept()
+            connection.settimeout(None)
+            return connection
+        except (socket.timeout, OSError):
+            return None
+
+
+    # Connect to the other process, retried until it is up
+    def connect(self) -> socket.socket | None:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+            return connection
+        except OSError:
+            connection.close()
+            self.stop_event.wait(self.reconnect_delay)
+            return None
+
+
+    # Tell the other process which events to send
+    def on_connect(self, connection: socket.socket):
+        self.logger.info(f"[{self.name}] Connected")
+        metrics.increment("ipc.connects")
+
+        with self.lock:
+            self.connection = connection
+
+            # Frames queued for the last connection are outdated
+            while not self.send_queue.empty():
+                self.send_queue.get_nowait()
+
+            self.wanted = {event for event in PubEvents if self.is_wanted(event)}
+            for event in self.wanted:
+                self.send_queue.put_nowait((SUBSCRIBE, event, b""))
+
+
+    # Close the connection and drop the subscriptions of the other process
+    def disconnect(self):
+        with self.lock:
+            connection, self.connection = self.connection, None
+
+            forwarder_ids, self.forwarder_ids = self.forwarder_ids, {}
+            self.forwarders = {}
+
+        for event, sub_id in forwarder_ids.items():
+            self.pubsub.unsubscribe(event, sub_id)
+
+        if connection is not None:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+
+    # Read frames until the connection closes
+    def receive_frames(self, connection: socket.socket):
+        while not self.stop_event.is_set():
+            kind, event_value, length = self.header.unpack(self.receive_exactly(connection, self.header.size))
+            payload = self.receive_exactly(connection, length) if length else b""
+            event = PubEvents(event_value)
+
+            if kind == EVENT:
+                try:
+                    self.get_receive_queue(event).put_nowait(payload)
+                except queue.Full:
+                    metrics.increment("ipc.dropped")
+
+            elif kind == SUBSCRIBE:
+                self.add_forwarder(event)
+
+            elif kind == UNSUBSCRIBE:
+                self.remove_forwarder(event)
+
+
+    # Get the queue of a received event, its publishing thread is started with it
+    def get_receive_queue(self, event: PubEvents) -> queue.Queue:
+        if event not in self.receive_queues:
+            self.receive_queues[event] = queue.Queue(maxsize=self.max_queued)
+            threading.Thread(target=self.dispatch_events, args=(event, self.receive_queues[event]), name=f"pubsub_bridge_{event.name.lower()}_{self.name}", daemon=True).start()
+
+        return self.receive_queues[event]
+
+
+    # Publish the received frames of an event in the order they came in
+    def dispatch_events(self, event: PubEvents, receive_queue: queue.Queue):
+        while not self.stop_event.is_set():
+            try:
+                payload = receive_queue.get(timeout=self.reconnect_delay)
+            except queue.Empty:
+                continue
+
+            args, kwargs = marshal.loads(payload)
+            self.receiving.event = event
+            try:
+                self.pubsub.publish(event, *args, **kwargs)
+            except Exception as e:
+                self.logger.error(f"[{self.name}] Failed to publish {event.name}: {e}")
+            finally:
+                self.receiving.event = None
+
+
+    # Read a number of bytes from the connection
+    @staticmethod
+    def receive_exactly(connection: socket.socket, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = connection.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("closed by the other process")
+            data += chunk
+        return bytes(data)
+
+
+    # Send the frames in the queue, publishers never wait on the socket
+    def send_frames(self):
+        while not self.stop_event.is_set():
+            try:
+                kind, event, payload = self.send_queue.get(timeout=self.reconnect_delay)
+            except queue.Empty:
+                continue
+
+            connection = self.connection
+            if connection is None:
+                continue
+
+            try:
+                connection.sendall(self.header.pack(kind, event.value, len(payload)) + payload)
+            except OSError as e:
+                self.logger.warning(f"[{self.name}] Failed to send {event.name}: {e}")
+
+
+    # Queue a frame, events are dropped when the other process does not keep up
+    def send(self, kind: int, event: PubEvents, payload: bytes = b""):
+        try:
+            self.send_queue.put_nowait((kind, event, payload))
+        except queue.Full:
+            metrics.increment("ipc.dropped")
+
+
+    # Send the events the other process subscribed to
+    def add_forwarder(self, event: PubEvents):
+        with self.lock:
+            if event in self.forwarders or event in self.local_events:
+                return
+            self.forwarders[event] = functools.partial(self.forward, event)
+
+        self.forwarder_ids[event] = self.pubsub.subscribe(event, self.forwarders[event])
+
+
+    # Stop sending an event the other process unsubscribed from
+    def remove_forwarder(self, event: PubEvents):
+        with self.lock:
+            self.forwarders.pop(event, None)
+            sub_id = self.forwarder_ids.pop(event, None)
+
+        if sub_id is not None:
+            self.pubsub.unsubscribe(event, sub_id)
+
+
+    # Forwarder of a locally published event
+    def forward(self, event: PubEvents, *args, **kwargs):
+        # The event came from the other process
+        if getattr(self.receiving, "event", None) == event:
+            return
+
+        try:
+            payload = marshal.dumps((args, kwargs))
+        except ValueError as e:
+            metrics.increment("ipc.unencodable")
+            self.logger.error(f"[{self.name}] Cannot send {event.name}: {e}")
+            return
+
+        metrics.increment("ipc.sent")
+        self.send(EVENT, event, payload)
+
+
+    # Check if this process has subscribers of an event that the other process has to send
+    def is_wanted(self, event: PubEvents) -> bool:
+        return event not in self.local_events and self.pubsub.has_subscribers(event, exclude=self.forwarders.get(event))
+
+
+    # Watcher of the local subscriptions, the other process is told when an event is first or no longer wanted
+    def update_subscription(self, event: PubEvents):
+        if self.connection is None:
+            return
+
+        wanted = self.is_wanted(event)
+        with self.lock:
+            if wanted == (event in self.wanted):
+                return
+
+            if wanted:
+                self.wanted.add(event)
+            else:
+                self.wanted.discard(event)
+
+        self.send(SUBSCRIBE if wanted else UNSUBSCRIBE, event)
@@ -0,0 +1,231 @@
+import os
+import json
+import logging
+import threading
+
+from typing import Any, List
+
+from utils import metrics
+from utils.models import Memory
+from utils.functions import save_memory
+
+
+# Append-only log of the changes to the memory, replayed on top of the last snapshot at start-up
+# Every change is idempotent, replaying a change the snapshot already holds leaves the memory as it is
+# Changes are written by a background thread, the thread that made a change never waits on the disk
+class MemoryJournal:
+    memory: Memory
+
+    logger = logging.getLogger("memory_journal")
+
+    # Number of changes after which the journal is folded into the snapshot
+    compact_after: int = 500
+
+    # Seconds the writer waits for more changes, the changes that came in are written with a single sync
+    commit_interval: float = 0.05
+
+    def __init__(self, memory: Memory, snapshot_path: str = "memory.json"):
+        self.memory = memory
+        self.snapshot_path = snapshot_path
+        self.path = f"{os.path.splitext(snapshot_path)[0]}.journal"
+
+        # Encoded changes waiting for the writer, with the number of changes recorded and written so far
+        self.condition = threading.Condition()
+        self.pending: List[str] = []
+        self.recorded = 0
+        self.written = 0
+        self.closing = False
+
+        # Held while the journal file is written or emptied
+        self.lock = threading.Lock()
+        self.file = None
+        self.records = 0
+        self.thread = threading.Thread(target=self.run, name="memory_journal", daemon=True)
+
+
+    # Apply the changes recorded since the last snapshot and open the journal for new ones
+    def open(self):
+        replayed = self.replay()
+        if replayed:
+            self.logger.info(f"Replayed {replayed} changes from {self.path}")
+
+        self.file = open(self.path, "a", encoding="utf-8")
+        self.records = replayed
+        self.thread.start()
+
+
+    # Apply the recorded changes to the memory, a change torn by a crash ends the journal
+    def replay(self) -> int:
+        if not os.path.exists(self.path):
+            return 0
+
+        replayed = 0
+        valid_bytes = 0
+
+        with open(self.path, "rb") as infile:
+            for line in infile:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("incomplete line")
+                    self.apply(json.loads(line))
+                except (ValueError, KeyError, TypeError) as e:
+                    self.logger.warning(f"Journal {self.path} ends with a broken change after {replayed} changes: {e}")
+                    break
+
+                replayed += 1
+                valid_bytes += len(line)
+
+        # Drop the torn change so new changes follow the last complete one
+        if valid_bytes < os.path.getsize(self.path):
+            with open(self.path, "r+b") as outfile:
+                outfile.truncate(valid_bytes)
+
+        return replayed
+
+
+    # Apply a recorded change to the memory
+    def apply(self, change: dict):
+        op = change["op"]
+        field = change["field"]
+        value = change.get("value")
+
+        if op == "set":
+            setattr(self.memory, field, value)
+            return
+
+        container = getattr(self.memory, field)
+
+        if op == "add":
+            if value not in container:
+                container.append(value)
+
+        elif op == "remove":
+            if value in container:
+                container.remove(value)
+
+        elif op == "put":
+            container[change["key"]] = value
+
+        elif op == "delete":
+            container.pop(change["key"], None)
+
+        # Add to a list in a dict at a known position, skipped when the list already holds it
+        elif op == "append":
+            items = container.get(change["key"])
+            if items is not None and len(items) == change["index"]:
+                items.append(value)
+
+        # Cut a list in a dict down to a length, keeping its first item and dropping the oldest after it
+        elif op == "trim":
+            items = container.get(change["key"])
+            if items is not None and len(items) > value:
+                del items[1:len(items) - value + 1]
+
+        else:
+            raise ValueError(f"unknown change {op}")
+
+
+    # Record a change that was made to the memory, the change is encoded now and written by the writer
+    def record(self, op: str, field: str, value: Any = None, **extra):
+        line = json.dumps({"op": op, "field": field, "value": value, **extra}, separators=(",", ":")) + "\n"
+
+        with self.condition:
+            if self.file is None or self.closing:
+                return
+
+            self.pending.append(line)
+            self.recorded += 1
+            if len(self.pending) == 1:
+                self.condition.notify_all()
+
+
+    # Wait until every change recorded so far is on disk and the writer is done with it, a compaction it led to included
+    def flush(self):
+        with self.condition:
+            target = self.recorded
+            while self.written < target and self.thread.is_alive():
+                self.condition.wait()
+
+
+    # Write the recorded changes in groups and compact the journal once it grows long enough
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closing:
+                    self.condition.wait()
+
+                # Let the changes of the same moment gather, close wakes the writer up early
+                if not self.closing:
+                    self.condition.wait(self.commit_interval)
+
+                batch, self.pending = self.pending, []
+                closing = self.closing
+
+            if batch:
+                self.write(batch)
+
+            if not closing and self.records >= self.compact_after:
+                self.compact()
+
+            with self.condition:
+                self.written += len(batch)
+                self.condition.notify_all()
+
+            if closing:
+                return
+
+
+    # Write a group of changes with a single sync
+    def write(self, batch: List[str]):
+        with self.lock:
+            try:
+                self.file.write("".join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                self.logger.error(f"Failed to write {len(batch)} changes to {self.path}: {e}")
+
+            self.records += len(batch)
+
+        metrics.increment("memory.journal_changes", len(batch))
+        metrics.increment("memory.journal_writes")
+
+
+    # Write the snapshot and empty the journal
+    # Changes recorded while the snapshot is written follow it in the emptied journal, replaying them again is harmless
+    def compact(self):
+        with self.lock:
+            self.records = 0
+
+            # Other threads may change the memory while it is copied, the journal is kept until the next try
+            try:
+                save_memory(self.memory, self.snapshot_path)
+            except (OSError, RuntimeError) as e:
+                self.logger.error(f"Failed to compact {self.path}: {e}")
+                return
+
+            if self.file is not None:
+                self.file.truncate(0)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+        metrics.increment("memory.compactions")
+
+
+    # Write the last changes and the final snapshot and close the journal
+    def close(self):
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+            self.condition.notify_all()
+
+        if self.thread.is_alive():
+            self.thread.join()
+
+        self.compact()
+
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,73 @@
+import time
+import bisect
+import threading
+
+from collections import deque
+
+from utils import metrics
+
+
+class LagTracker:
+    # Seconds the transcript may trail the stream before the backend skips to the live edge
+    max_lag: float = 15
+
+    # Number of arrival marks kept, one per read of audio
+    max_marks: int = 8192
+
+    def __init__(self, name: str, sample_rate: int = 16000):
+        self.name = name
+        self.sample_rate = sample_rate
+
+        # Total samples read and the (sample offset, arrival time) of the end of every read
+        self.samples = 0
+        self.offsets: deque = deque(maxlen=self.max_marks)
+        self.times: deque = deque(maxlen=self.max_marks)
+
+        self.lock = threading.Lock()
+
+
+    # Record that samples arrived now
+    def add(self, num_samples: int):
+        with self.lock:
+            self.samples += num_samples
+            self.offsets.append(self.samples)
+            self.times.append(time.time())
+
+
+    # Get the stream time in seconds of everything read so far, the live edge
+    def get_live_edge(self) -> float:
+        with self.lock:
+            return self.samples / self.sample_rate
+
+
+    # Get the wall clock time the audio at a stream time arrived, None if it is older than the kept marks
+    def get_arrival_time(self, seconds: float) -> float | None:
+        sample = seconds * self.sample_rate
+
+        with self.lock:
+            index = bisect.bisect_left(self.offsets, sample)
+            if not self.offsets or (index == 0 and sample < self.offsets[0] - self.sample_rate):
+                return None
+
+            return self.times[min(index, len(self.times) - 1)]
+
+
+    # Measure and export the lag of a transcript that reaches up to a stream time
+    def record(self, seconds: float) -> float:
+        arrival_time = self.get_arrival_time(seconds)
+        if arrival_time is None:
+            return 0.0
+
+        lag = max(0.0, time.time() - arrival_time)
+        metrics.set_gauge(f"{self.name}.lag_s", lag)
+        return lag
+
+
+    # Check if a lag is beyond what is accepted
+    def is_behind(self, lag: float) -> bool:
+        return lag > self.max_lag
+
+
+    # Count audio that was skipped to catch up
+    def record_skip(self, seconds: float):
+        metrics.increment(f"{self.name}.skipped_s", seconds)
@@ -1,21 +1,50 @@
 import os
 import time
 import logging
+import functools
 import threading
 import subprocess
 import numpy as np
 
+from utils import metrics
+from utils.lag import LagTracker
+from utils.audio import MUSIC, SILENCE
 from utils.ffmpeg_base import FfmpegBase
 from utils.pubsub import PubSub, PubEvents
 
-from faster_whisper.transcribe import WhisperModel, TranscriptionInfo, Segment, Iterable
+from typing import TYPE_CHECKING, Iterable
+
+# faster_whisper is only imported once a model is loaded, the deepgram backend never needs it
+if TYPE_CHECKING:
+    from faster_whisper.transcribe import WhisperModel, TranscriptionInfo, Segment
+
+
+# Load a whisper model once per process, every channel transcribes with the same weights
+# Only the model in use is kept, a model left behind by a quality tier change is freed once no channel uses it
+@functools.lru_cache(maxsize=1)
+def load_whisper_model(model: str, num_workers: int) -> "WhisperModel":
+    from faster_whisper import WhisperModel
+
+    return WhisperModel(
+        model_size_or_path=model,
+        device="cpu",
+        compute_type="int8",
+        num_workers=num_workers,
+        local_files_only=False,
+    )
 
 
 class TranscriptionServer(FfmpegBase):
-    def __init__(self, pubsub: PubSub, language: str = "en", model: str = "tiny.en"):
+    # Replace music without speech with silence so whisper does not transcribe it
+    # Off by default, speech over background music is classified as music too, when on only music that lasted this long is replaced
+    skip_music: bool = False
+    min_music_seconds: float = 10
+
+    def __init__(self, pubsub: PubSub, channel: str, language: str = "en", model: str = "tiny.en"):
         super().__init__(pubsub)
         
         self.pubsub = pubsub
+        self.channel = channel
         self.stop_event = threading.Event()
 
         self.logger = logging.getLogger("local_transcription")
@@ -23,9 +52,15 @@ class TranscriptionServer(FfmpegBase):
         # subscribe to showtdown event
         self.pubsub.subscribe(PubEvents.SHUTDOWN, self.stop)
 
+        # subscribe to the audio state
+        self.audio_state = SILENCE
+        self.music_since: float | None = None
+        self.pubsub.subscribe(PubEvents.AUDIO_STATE, self.set_audio_state)
+
         # Start the transcription server
         self.client = ServeClientFasterWhisper(
             pubsub=pubsub,
+            channel=channel,
             language=language,
             model=model,
         )
@@ -48,6 +83,18 @@ class TranscriptionServer(FfmpegBase):
         self.client.stop()
 
 
+    # Callback for the audio state event
+    def set_audio_state(self, state: str):
+        self.audio_state = state
+        self.music_since = time.monotonic() if state == MUSIC else None
+
+
+    # Check if the audio has been music for long enough to replace it
+    def is_sustained_music(self) -> bool:
+        music_since = self.music_since
+        return music_since is not None and time.monotonic() - music_since >= self.min_music_seconds
+
+
     @staticmethod
     def bytes_to_float_array(audio_bytes):
         raw_data = np.frombuffer(buffer=audio_bytes, dtype=np.int16)
@@ -73,9 +120,16 @@ class TranscriptionServer(FfmpegBase):
                 # Read the audio stream
                 out_bytes = self.ffmpeg_process.stdout.read(4096 * 2)
 
+                # Share the pcm audio with the audio analysis
+                self.pubsub.publish(PubEvents.AUDIO_FRAMES, out_bytes)
+
                 # Convert the bytes to a float array
                 audio_array = self.bytes_to_float_array(out_bytes)
 
+                # Keep the timing but drop the music
+                if self.skip_music and self.is_sustained_music():
+                    audio_array = np.zeros_like(audio_array)
+
                 # Send the audio array to the server
                 self.client.add_frames(audio_array)
 
@@ -87,7 +141,15 @@ class TranscriptionServer(FfmpegBase):
 
 
 class ServeClientFasterWhisper():
-    def __init__(self, pubsub: PubSub, language: str = None, model: str = "small.en"):
+    logger = logging.getLogger("local_transcription")
+
+    # Seconds of new audio collected before each transcription pass by quality tier
+    tier_hop_seconds = [10, 15, 20]
+
+    # Number of channels a shared model transcribes at the same time
+    num_workers: int = 2
+
+    def __init__(self, pubsub: PubSub, channel: str, language: str = None, model: str = "small.en"):
         # variables
         self.RATE = 16000
         self.frames = b""
@@ -105,6 +167,16 @@ class ServeClientFasterWhisper():
         self.transcript = []
         self.send_last_n_segments = 50
 
+        # Wall clock lag of the transcript behind the stream, the gauges are kept per channel
+        self.metric_prefix = f"transcription.{channel.lower()}"
+        self.lag_tracker = LagTracker(self.metric_prefix, self.RATE)
+
+        # Quality settings, the model is switched by the transcription thread between two passes
+        self.hop_seconds = self.tier_hop_seconds[0]
+        self.model = model
+        self.current_model = model
+        self.target_model = model
+
         # threading
         self.lock = threading.Lock()
         self.stop_event = threading.Event()
@@ -122,6 +194,7 @@ class ServeClientFasterWhisper():
         # subscribe to pubsub events
         self.pubsub.subscribe(PubEvents.PAUSE_TRANSCRIPTION, self.pause)
         self.pubsub.subscribe(PubEvents.RESUME_TRANSCRIPTION, self.resume)
+        self.pubsub.subscribe(PubEvents.QUALITY_TIER, self.set_quality_tier)
 
         # Check if the model is valid
         if model not in self.model_sizes and not os.path.exists(model):
@@ -132,12 +205,47 @@ class ServeClientFasterWhisper():
         self.no_speech_thresh = 0.45
 
         # Initialize the transcriber
-        self.transcriber = WhisperModel(
-            model_size_or_path=model,
-            device="cpu",
-            compute_type="int8",
-            local_files_only=False,
-        )
+        self.transcriber = self.load_model(model)
+
+
+    # Load a whisper model, shared with the transcription of the other channels
+    def load_model(self, model: str) -> "WhisperModel":
+        return load_whisper_model(model, self.num_workers)
+
+
+    # Use a smaller model and longer hops on lower quality tiers
+    def set_quality_tier(self, tier: int):
+        model = self.get_tier_model(tier)
+        if tier > 0 and model == self.target_model:
+            self.logger.info(f"No smaller whisper model than {model} for quality tier {tier}, only the hop gets longer")
+
+        self.target_model = model
+        self.hop_seconds = self.tier_hop_seconds[min(tier, len(self.tier_hop_seconds) - 1)]
+
+
+    # Get the model of a quality tier, one size smaller per tier within the same language family
+    def get_tier_model(self, tier: int) -> str:
+        if tier == 0 or self.model not in self.model_sizes:
+            return self.model
+
+        suffix = ".en" if self.model.endswith(".en") else ""
+        ladder = [f"{size}{suffix}" for size in ("tiny", "base", "small", "medium")]
+        index = ladder.index(self.model) if self.model in ladder else len(ladder)
+        return ladder[max(0, index - tier)]
+
+
+    # Switch to the model of the current quality tier
+    def update_model(self):
+        if self.target_model == self.current_model:
+            return
+
+        model = self.target_model
+        self.logger.info(f"Switching whisper model from {self.current_model} to {model}")
+
+        # Let go of the old model first, a failed load is tried again on the next pass
+        self.transcriber = None
+        self.transcriber = self.load_model(model)
+        self.current_model = model
 
 
     # Start the transcription thread.
@@ -164,7 +272,14 @@ class ServeClientFasterWhisper():
 
 
     # Add audio frames to the ongoing audio stream buffer.
-    def add_frames(self, frame_np: np.ndarray, max_new_buffer_seconds: int = 10, max_buffer_seconds: int = 35, min_buffer_seconds: int = 20):          
+    def add_frames(self, frame_np: np.ndarray, max_new_buffer_seconds: int = None, max_buffer_seconds: int = 35, min_buffer_seconds: int = 20):          
+        # Collect the hop of the quality tier by default
+        if max_new_buffer_seconds is None:
+            max_new_buffer_seconds = self.hop_seconds
+
+        # Remember when the audio arrived to measure the lag
+        self.lag_tracker.add(frame_np.shape[0])
+
         self.lock.acquire()
 
         # Initialize the new frames buffer with the provided audio frame
@@ -246,7 +361,7 @@ class ServeClientFasterWhisper():
     
 
     # Updates the language attribute based on the detected language information.
-    def set_language(self, info: TranscriptionInfo):
+    def set_language(self, info: "TranscriptionInfo"):
         if info.language_probability > 0.5:
             self.language = info.language
             self.logger.info(f"Detected language {self.language} with probability {info.language_probability}")
@@ -297,7 +412,7 @@ class ServeClientFasterWhisper():
 
 
     # Handle the transcription output, updating the transcript and sending data to the client.
-    def handle_transcription_output(self, result: Iterable[Segment], duration: float):
+    def handle_transcription_output(self, result: Iterable["Segment"], duration: float):
         segments = []
 
         # if there is output from whisper
@@ -333,6 +448,9 @@ class ServeClientFasterWhisper():
 
             self.clip_audio_if_no_valid_segment()
 
+            # stream time of the end of the buffered audio
+            chunk_end = self.frames_offset + self.frames_np.shape[0] / self.RATE
+
             # get the next chunk of audio data for processing
             input_bytes, duration = self.get_audio_chunk_for_processing()
 
@@ -343,8 +461,13 @@ class ServeClientFasterWhisper():
             try:
                 # transcribe the audio chunk
                 input_sample = input_bytes.copy()
+                self.update_model()
+                start = time.time()
                 result = self.transcribe_audio(input_sample)
 
+                # real-time factor of the pass, above 1 means transcription is slower than the stream
+                metrics.set_gauge(f"{self.metric_prefix}.rtf", (time.time() - start) / duration)
+
                 # if the language is not set, continue until it is detected
                 if self.language is None:
                     continue
@@ -355,6 +478,11 @@ class ServeClientFasterWhisper():
                 # reset the new frames event
                 self.new_frames_event.clear()
 
+                # skip to the live edge if the transcript fell too far behind
+                lag = self.lag_tracker.record(chunk_end)
+                if self.lag_tracker.is_behind(lag):
+                    self.drop_to_live(lag)
+
             except Exception as e:
                 self.logger.error(f"[ERROR]: Failed to transcribe audio chunk: {e}")
                 time.sleep(0.01)
@@ -363,6 +491,25 @@ class ServeClientFasterWhisper():
         self.logger.info("[INFO]: Exiting speech to text thread")
 
     
+    # Skips the audio that was not transcribed yet and marks the gap in the transcript.
+    def drop_to_live(self, lag: float):
+        with self.lock:
+            live_edge = self.frames_offset + self.frames_np.shape[0] / self.RATE
+            gap = live_edge - self.timestamp_offset
+            if gap <= 0:
+                return
+
+            # mark the gap and drop the incomplete output
+            self.transcript.append(self.format_segment(self.timestamp_offset, live_edge, f"[skipped {gap:.0f}s] "))
+            self.timestamp_offset = live_edge
+            self.current_out = ''
+            self.prev_out = ''
+            self.same_output_threshold = 0
+
+        self.lag_tracker.record_skip(gap)
+        self.logger.warning(f"Transcript was {lag:.1f}s behind the stream, skipped {gap:.1f}s to the live edge")
+
+
     # Formats a transcription segment with precise start and end times alongside the transcribed text.
     def format_segment(self, start: float, end: float, text: str) -> dict:
         return {
@@ -373,7 +520,7 @@ class ServeClientFasterWhisper():
 
 
     # Processes the segments from whisper. Appends all the segments to the list except for the last segment assuming that it is incomplete.
-    def update_segments(self, segments: Iterable[Segment], duration: float) -> dict | None:
+    def update_segments(self, segments: Iterable["Segment"], duration: float) -> dict | None:
         offset = None
         self.current_out = ''
         last_segment = None
@@ -382,7 +529,7 @@ class ServeClientFasterWhisper():
         if len(segments) > 1:
             # process all segments except the last one
             for i, s in enumerate(segments[:-1]):
-                segment: Segment = s
+                segment: "Segment" = s
                 
                 # add the segment text to the list
                 text = segment.text
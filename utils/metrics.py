@@ -0,0 +1,62 @@
+import fnmatch
+import threading
+
+from typing import Dict
+
+# Process wide counters and gauges shown in the status output
+lock = threading.Lock()
+counters: Dict[str, float] = {}
+gauges: Dict[str, float] = {}
+
+
+# Add to a counter
+def increment(name: str, value: float = 1):
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+# Set a gauge to its current value
+def set_gauge(name: str, value: float):
+    with lock:
+        gauges[name] = value
+
+
+# Get the value of a counter or gauge
+def get(name: str, default: float = 0) -> float:
+    with lock:
+        if name in gauges:
+            return gauges[name]
+        return counters.get(name, default)
+
+
+# Get the largest of the gauges matching a pattern, such as the same gauge of every channel
+def get_max(pattern: str, default: float = 0) -> float:
+    with lock:
+        values = [value for name, value in gauges.items() if fnmatch.fnmatchcase(name, pattern)]
+
+    return max(values, default=default)
+
+
+# Get the gauges matching a pattern
+def get_gauges(pattern: str) -> Dict[str, float]:
+    with lock:
+        return {name: value for name, value in gauges.items() if fnmatch.fnmatchcase(name, pattern)}
+
+
+# Set several gauges at once, such as the gauges another process sent
+def set_gauges(values: Dict[str, float]):
+    with lock:
+        gauges.update(values)
+
+
+# Format all counters and gauges for the status output
+def format_metrics() -> str:
+    with lock:
+        values = {**counters, **gauges}
+
+    lines = []
+    for name in sorted(values):
+        value = values[name]
+        lines.append(f"{name}: {value:.2f}" if isinstance(value, float) else f"{name}: {value}")
+
+    return " | ".join(lines)
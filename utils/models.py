@@ -4,6 +4,9 @@ from dataclasses import dataclass, field
 @dataclass
 class Config:
     target_channel: str = ""
+    target_channels: str = ""  # Comma separated, serves all of them in one process
+    ipc_dir: str = "ipc"  # Sockets connecting the ingest and chat processes
+    transcription_backend: str = "deepgram"  # deepgram or local
     bot_username: str = ""
     admin_username: str = ""
     twitch_api_client_id: str = ""
@@ -26,6 +29,13 @@ class Memory:
     banned_users: list = field(default_factory=list)
     timed_out_users: dict = field(default_factory=dict)  # Dict[str, float]
     conversations: dict = field(default_factory=dict)  # Dict[str, list]
+    summaries: dict = field(default_factory=dict)  # Dict[str, list]
+
+
+@dataclass
+class Channel:
+    name: str = ""
+    description: str = ""
 
 
 @dataclass
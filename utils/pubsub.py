@@ -2,7 +2,7 @@ import uuid
 import threading
 
 from enum import Enum
-from typing import Callable, Dict
+from typing import Callable, Dict, List
 
 class PubEvents(Enum):
     SHUTDOWN = 0
@@ -14,17 +14,28 @@ class PubEvents(Enum):
     PAUSE_TRANSCRIPTION = 6
     RESUME_TRANSCRIPTION = 7
     STREAM_BYTES = 8
+    AUDIO_FRAMES = 9
+    TRACK_CHANGE = 10
+    AUDIO_STATE = 11
+    QUALITY_TIER = 12
+    METRICS = 13
 
 
 class PubSub:
     def __init__(self):
         self.subscribers: Dict[PubEvents, Dict[uuid.UUID, Callable]] = {}
         self.locks: Dict[PubEvents, threading.Lock] = {}
+        self.locks_lock = threading.Lock()
+
+        # Called with the event whenever a subscription to it is added or removed
+        self.watchers: List[Callable[[PubEvents], None]] = []
 
     def get_lock(self, event: PubEvents) -> threading.Lock:
-        if event not in self.locks:
-            self.locks[event] = threading.Lock()
-        return self.locks[event]
+        # Subscriptions are made from several start-up threads at once
+        with self.locks_lock:
+            if event not in self.locks:
+                self.locks[event] = threading.Lock()
+            return self.locks[event]
 
     def subscribe(self, event: PubEvents, callback: Callable) -> uuid.UUID:
         with self.get_lock(event):
@@ -37,9 +48,11 @@ class PubSub:
 
             # Add the callback to the list of subscribers
             self.subscribers[event][sub_id] = callback
-            
-            # Return the subscription ID
-            return sub_id
+
+        self.notify_watchers(event)
+
+        # Return the subscription ID
+        return sub_id
 
     def unsubscribe(self, event: PubEvents, sub_id: uuid.UUID):
         with self.get_lock(event):
@@ -47,6 +60,21 @@ class PubSub:
             if event in self.subscribers and sub_id in self.subscribers[event]:
                 del self.subscribers[event][sub_id]
 
+        self.notify_watchers(event)
+
+    # Watch the subscriptions of every event
+    def watch(self, callback: Callable[[PubEvents], None]):
+        self.watchers.append(callback)
+
+    def notify_watchers(self, event: PubEvents):
+        for watcher in self.watchers:
+            watcher(event)
+
+    # Check if an event has subscribers other than the given callback
+    def has_subscribers(self, event: PubEvents, exclude: Callable = None) -> bool:
+        with self.get_lock(event):
+            return any(callback is not exclude for callback in self.subscribers.get(event, {}).values())
+
     def publish(self, event: PubEvents, *args, **kwargs):
         with self.get_lock(event):
             # Check if the event has subscribers
@@ -0,0 +1,112 @@
+import os
+import time
+import logging
+import threading
+
+from typing import Dict, Tuple
+
+from utils import metrics
+from utils.pubsub import PubSub, PubEvents
+
+# Quality tiers from best to cheapest, consumers decide what each tier means for them
+FULL = 0
+REDUCED = 1
+MINIMAL = 2
+TIER_NAMES = ["full", "reduced", "minimal"]
+
+
+class QualityController:
+    pubsub: PubSub
+
+    logger = logging.getLogger("quality")
+
+    # Seconds between two checks, consecutive overloaded checks before stepping down and calm checks before stepping up
+    check_interval: float = 5
+    down_after: int = 3
+    up_after: int = 12
+
+    # Signals as (metric, overloaded above, calm below), cpu is the share of all cores
+    # A * stands for the channel, the channel under the most load decides
+    signals: Dict[str, Tuple[str, float, float]] = {
+        "cpu": ("system.cpu", 0.85, 0.5),
+        "transcription rtf": ("transcription.*.rtf", 0.8, 0.4),
+        "pending responses": ("bot.*.pending_responses", 8, 2),
+        "llm latency": ("chat.latency_s", 8, 3),
+    }
+
+    def __init__(self, pubsub: PubSub):
+        self.pubsub = pubsub
+        self.tier = FULL
+
+        self.overloaded_checks = 0
+        self.calm_checks = 0
+
+        # Process cpu time at the last check, used where the load average is not available
+        self.last_cpu = (time.perf_counter(), time.process_time())
+
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="quality_controller", daemon=True)
+
+        self.pubsub.subscribe(PubEvents.SHUTDOWN, self.stop)
+
+
+    # Start checking the load
+    def start(self):
+        metrics.set_gauge("quality.tier", self.tier)
+        self.thread.start()
+
+
+    # Stop checking the load
+    def stop(self):
+        self.stop_event.set()
+
+
+    # Check the load until shutdown
+    def run(self):
+        while not self.stop_event.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                self.logger.error(f"Failed to check the load: {e}")
+
+
+    # Get the cpu load as a share of all cores
+    def get_cpu_load(self) -> float:
+        if hasattr(os, "getloadavg"):
+            return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+        # The cpu time of this process since the last check
+        now, cpu = time.perf_counter(), time.process_time()
+        last_now, last_cpu = self.last_cpu
+        self.last_cpu = (now, cpu)
+        return (cpu - last_cpu) / max(now - last_now, 1e-6) / (os.cpu_count() or 1)
+
+
+    # Compare the signals with their thresholds and step the tier down or up
+    def check(self):
+        metrics.set_gauge("system.cpu", self.get_cpu_load())
+
+        values = {name: metrics.get_max(metric) for name, (metric, _, _) in self.signals.items()}
+        overloaded = [f"{name} {values[name]:.2f} > {high}" for name, (_, high, _) in self.signals.items() if values[name] > high]
+        calm = all(values[name] < low for name, (_, _, low) in self.signals.items())
+
+        self.overloaded_checks = self.overloaded_checks + 1 if overloaded else 0
+        self.calm_checks = self.calm_checks + 1 if calm else 0
+
+        if self.overloaded_checks >= self.down_after and self.tier < MINIMAL:
+            self.set_tier(self.tier + 1, ", ".join(overloaded))
+
+        elif self.calm_checks >= self.up_after and self.tier > FULL:
+            self.set_tier(self.tier - 1, "all signals calm: " + ", ".join(f"{name} {value:.2f}" for name, value in values.items()))
+
+
+    # Switch to a tier and tell everyone
+    def set_tier(self, tier: int, cause: str):
+        self.logger.warning(f"Quality {TIER_NAMES[self.tier]} -> {TIER_NAMES[tier]} ({cause})")
+
+        self.tier = tier
+        self.overloaded_checks = 0
+        self.calm_checks = 0
+
+        metrics.set_gauge("quality.tier", tier)
+        self.pubsub.publish(PubEvents.QUALITY_TIER, tier)
@@ -0,0 +1,121 @@
+import re
+import zlib
+import random
+import logging
+
+from typing import Tuple
+
+from utils import metrics
+from utils.cache import TTLCache
+
+
+class ResponseCache:
+    logger = logging.getLogger("response_cache")
+
+    # Cache size, lifetime of an answer in seconds and the estimated similarity a question needs to match
+    max_entries: int = 256
+    ttl: float = 180
+    similarity_threshold: float = 0.6
+
+    # MinHash settings
+    ngram_size: int = 3
+    num_hashes: int = 64
+    prime: int = (1 << 61) - 1
+
+    # Only questions are cached, other messages are too personal to reuse the answer
+    question_regex = re.compile(r"\?|^(what|whats|who|whos|how|when|where|which|why|is|are|does|do|can|did)\b")
+
+    # Questions about the asker or said to the bot in person, their answers are only reused for the same user
+    personal_regex = re.compile(r"\b(i|im|ive|id|ill|me|my|mine|myself|you|youre|youve|your|yours|yourself|u|ur)\b")
+
+    def __init__(self):
+        self.cache = TTLCache(self.max_entries, self.ttl)
+
+        # Fixed random permutations so signatures are comparable for the whole session
+        rng = random.Random(0)
+        self.permutations = [(rng.randrange(1, self.prime), rng.randrange(0, self.prime)) for _ in range(self.num_hashes)]
+
+
+    # Normalize a chat message: lower case, no mentions, no punctuation and single spaces
+    @staticmethod
+    def normalize(message: str) -> str:
+        message = re.sub(r"@\w+", " ", message.lower())
+        message = re.sub(r"[^\w\s?]", "", message)
+        return " ".join(message.split())
+
+
+    # Check if a normalized message is worth caching
+    def is_cacheable(self, normalized: str) -> bool:
+        return len(normalized) >= self.ngram_size and self.question_regex.search(normalized) is not None
+
+
+    # Compute the MinHash signature of the character n-grams of a normalized message
+    def signature(self, normalized: str) -> Tuple[int, ...]:
+        text = normalized.replace("?", "")
+        shingles = {zlib.crc32(text[i:i + self.ngram_size].encode()) for i in range(max(1, len(text) - self.ngram_size + 1))}
+        return tuple(min((a * shingle + b) % self.prime for shingle in shingles) for a, b in self.permutations)
+
+
+    # Estimate the jaccard similarity of two signatures
+    @staticmethod
+    def similarity(first: Tuple[int, ...], second: Tuple[int, ...]) -> float:
+        return sum(1 for a, b in zip(first, second) if a == b) / len(first)
+
+
+    # Get the user a cached answer belongs to, empty for answers every user can get
+    def get_owner(self, normalized: str, username: str) -> str:
+        return username.lower() if self.personal_regex.search(normalized) else ""
+
+
+    # Find a cached response for a message of a user in the same stream context
+    def get(self, message: str, username: str, fingerprint: str, expected_latency: float) -> str | None:
+        normalized = self.normalize(message)
+        if not self.is_cacheable(normalized):
+            return None
+
+        # Exact match of the normalized message
+        owner = self.get_owner(normalized, username)
+        response = self.cache.get((fingerprint, owner, normalized))
+
+        # Closest similar question
+        if response is None:
+            signature = self.signature(normalized)
+            best_key, best_similarity = None, self.similarity_threshold
+
+            for key, (cached_signature, _) in self.cache.items():
+                if key[:2] != (fingerprint, owner):
+                    continue
+                similarity = self.similarity(signature, cached_signature)
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+
+            if best_key is not None:
+                response = self.cache.get(best_key)
+
+        if response is None:
+            metrics.increment("response_cache.misses")
+            self.update_hit_rate()
+            return None
+
+        metrics.increment("response_cache.hits")
+        metrics.increment("response_cache.latency_saved_s", expected_latency)
+        self.update_hit_rate()
+        self.logger.debug(f"Cache hit for '{normalized}'")
+
+        return response[1]
+
+
+    # Cache the response to a message of a user
+    def set(self, message: str, username: str, fingerprint: str, response: str):
+        normalized = self.normalize(message)
+        if not self.is_cacheable(normalized):
+            return
+
+        self.cache.set((fingerprint, self.get_owner(normalized, username), normalized), (self.signature(normalized), response))
+
+
+    # Update the hit rate gauge
+    def update_hit_rate(self):
+        hits = metrics.get("response_cache.hits")
+        lookups = hits + metrics.get("response_cache.misses")
+        metrics.set_gauge("response_cache.hit_rate", hits / lookups if lookups else 0.0)
@@ -0,0 +1,153 @@
+import re
+import math
+import logging
+
+from typing import Dict, List
+from collections import Counter
+
+from utils import metrics
+
+# Routes a message can take
+CHAT = "chat"
+TOOLS = "tools"
+VISION = "vision"
+
+# Keyword rules that decide the route on their own
+RULES = [
+    (VISION, re.compile(r"\b((can|could|do|did) (you|u) see|(see|seeing) (the|my|this|that|his|her|their)|screen|look(s|ing)? (at|like)|showing|shown|on stream|wearing|outfit|hair|background|camera|cam|map|ui|hud|score|health|inventory|chat see)\b")),
+    (TOOLS, re.compile(r"\b(song|music|track|artist|playing right now|what.s playing|shazam|tune|beat)\b")),
+    (TOOLS, re.compile(r"\b(google|search|look (it )?up|lookup|wiki|wikipedia|news|latest|release date|price|weather)\b")),
+]
+
+# Seed examples the naive bayes model is trained on
+EXAMPLES = [
+    (CHAT, "hi how are you doing today"),
+    (CHAT, "you are so funny lol"),
+    (CHAT, "what do you think about pineapple on pizza"),
+    (CHAT, "tell me a joke"),
+    (CHAT, "good night everyone see you tomorrow"),
+    (CHAT, "do you like cats or dogs"),
+    (CHAT, "that was a great play gg"),
+    (CHAT, "how old are you bot"),
+    (CHAT, "who made you"),
+    (CHAT, "can you say hi to my friend"),
+    (CHAT, "what is your favorite color"),
+    (CHAT, "i love this stream so much"),
+    (CHAT, "how is your day going"),
+    (CHAT, "how is it going"),
+    (CHAT, "what are you up to"),
+    (CHAT, "are you a real person"),
+    (CHAT, "i am so tired today"),
+    (CHAT, "thanks for the answer you are the best"),
+    (CHAT, "happy birthday to the streamer"),
+    (CHAT, "what should i eat for dinner"),
+    (TOOLS, "what is the name of this"),
+    (TOOLS, "who sings this"),
+    (TOOLS, "who made this one it slaps"),
+    (TOOLS, "find out when the next patch comes out"),
+    (TOOLS, "how much does that cost"),
+    (TOOLS, "who won the game last night"),
+    (TOOLS, "what year did that come out"),
+    (TOOLS, "when does the new season start"),
+    (VISION, "what is he doing right now"),
+    (VISION, "what game is this"),
+    (VISION, "where is he in the game"),
+    (VISION, "what level is this"),
+    (VISION, "is he winning"),
+    (VISION, "what character is that"),
+    (VISION, "what is happening right now"),
+    (VISION, "how many kills does he have"),
+]
+
+
+class MessageRouter:
+    logger = logging.getLogger("router")
+
+    # Probability the model needs before a message leaves the chat route
+    threshold: float = 0.75
+
+    def __init__(self):
+        # Naive bayes parameters
+        self.word_counts: Dict[str, Counter] = {route: Counter() for route in (CHAT, TOOLS, VISION)}
+        self.route_counts: Counter = Counter()
+        self.vocabulary: set = set()
+
+        for route, text in EXAMPLES:
+            self.train(route, text)
+
+        # Average latency of the completions of each route
+        self.latencies: Dict[str, float] = {}
+
+
+    # Get the features of a message
+    @staticmethod
+    def features(text: str) -> List[str]:
+        words = re.findall(r"[a-z']+", text.lower())
+        return words + [f"{first}_{second}" for first, second in zip(words, words[1:])]
+
+
+    # Add a labeled example to the model
+    def train(self, route: str, text: str):
+        features = self.features(text)
+        self.word_counts[route].update(features)
+        self.route_counts[route] += 1
+        self.vocabulary.update(features)
+
+
+    # Get the probability of each route for a message
+    def predict(self, text: str) -> Dict[str, float]:
+        features = self.features(text)
+        total_examples = sum(self.route_counts.values())
+        vocabulary_size = len(self.vocabulary)
+
+        scores = {}
+        for route, counts in self.word_counts.items():
+            total_words = sum(counts.values())
+            score = math.log(self.route_counts[route] / total_examples)
+            for feature in features:
+                score += math.log((counts[feature] + 1) / (total_words + vocabulary_size))
+            scores[route] = score
+
+        # Normalize the log scores to probabilities
+        highest = max(scores.values())
+        exps = {route: math.exp(score - highest) for route, score in scores.items()}
+        total = sum(exps.values())
+        return {route: value / total for route, value in exps.items()}
+
+
+    # Decide which route a message takes
+    def route(self, text: str) -> str:
+        lowered = text.lower()
+
+        for route, regex in RULES:
+            if regex.search(lowered):
+                return self.record(route, "rule")
+
+        probabilities = self.predict(text)
+        route = max(probabilities, key=probabilities.get)
+        if route != CHAT and probabilities[route] < self.threshold:
+            route = CHAT
+
+        return self.record(route, f"model {probabilities[route]:.2f}")
+
+
+    # Log and count a routing decision
+    def record(self, route: str, reason: str) -> str:
+        metrics.increment(f"router.{route}")
+        self.logger.debug(f"Routed message to {route} ({reason})")
+        return route
+
+
+    # Record the latency of a completion, chat routed completions log the latency saved against the tools route
+    def record_latency(self, route: str | None, seconds: float):
+        # Completions that were not routed
+        if route is None:
+            return
+
+        previous = self.latencies.get(route)
+        self.latencies[route] = seconds if previous is None else previous * 0.9 + seconds * 0.1
+
+        if route == CHAT and TOOLS in self.latencies:
+            saved = max(0.0, self.latencies[TOOLS] - seconds)
+            metrics.increment("router.latency_saved_s", saved)
+            self.logger.debug(f"Chat route saved ~{saved:.2f}s against the tools route")
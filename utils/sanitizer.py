@@ -0,0 +1,63 @@
+import re
+import functools
+
+
+class Sanitizer:
+    # Links are masked instead of removed
+    link_regex = re.compile(r"\b[a-zA-Z]+\.[a-zA-Z]+\b")
+
+    def __init__(self, username: str, bot_username: str):
+        mentions = {"@User", "@user"}
+        if bot_username:
+            mentions.update({f"@{bot_username}", f"{bot_username}:"})
+        if username:
+            mentions.update({f"@{username}:", f"@{username}"})
+
+        # Mentions and hashtags in one pattern, longer mentions first so '@user:' is removed whole
+        mention_pattern = "|".join(re.escape(mention) for mention in sorted(mentions, key=len, reverse=True))
+        self.remove_regex = re.compile(f"{mention_pattern}|#\\w+")
+
+
+    # Remove mentions and hashtags, mask links and flatten newlines with precompiled patterns,
+    # plain replacements keep every pass in C which is faster than one pass with a python callback
+    def clean(self, text: str) -> str:
+        text = self.remove_regex.sub("", text)
+        text = self.link_regex.sub("***", text)
+        return text.replace("\n", " ")
+
+
+    # Start cleaning a streamed text chunk by chunk
+    def stream(self) -> "SanitizerStream":
+        return SanitizerStream(self)
+
+
+class SanitizerStream:
+    sanitizer: Sanitizer
+
+    def __init__(self, sanitizer: Sanitizer):
+        self.sanitizer = sanitizer
+        self.buffer = ""
+
+
+    # Clean a chunk, the text after the last whitespace is held back as it could be the start of a match
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+
+        cut = max(self.buffer.rfind(" "), self.buffer.rfind("\n")) + 1
+        if cut == 0:
+            return ""
+
+        text, self.buffer = self.buffer[:cut], self.buffer[cut:]
+        return self.sanitizer.clean(text)
+
+
+    # Clean whatever is left at the end of the stream
+    def flush(self) -> str:
+        text, self.buffer = self.buffer, ""
+        return self.sanitizer.clean(text)
+
+
+# Get the sanitizer of a bot/user pair, compiled once per pair
+@functools.lru_cache(maxsize=256)
+def get_sanitizer(username: str, bot_username: str) -> Sanitizer:
+    return Sanitizer(username, bot_username)
@@ -0,0 +1,40 @@
+import threading
+
+from typing import Any, Callable, Dict, Hashable
+from concurrent.futures import Future
+
+from utils import metrics
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+
+        # Calls in flight by key
+        self.calls: Dict[Hashable, Future] = {}
+        self.lock = threading.Lock()
+
+
+    # Run the function once for all concurrent callers of the same key, every caller gets its result or error
+    def do(self, key: Hashable, function: Callable[..., Any], *args, **kwargs) -> Any:
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+
+        # Wait for the call that is already in flight
+        if not leader:
+            metrics.increment(f"{self.name}.shared")
+            return future.result()
+
+        try:
+            future.set_result(function(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+        return future.result()
@@ -0,0 +1,119 @@
+import time
+import logging
+
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+
+from utils import metrics
+
+
+# Start-up steps with the steps they depend on, independent steps run at the same time
+class StartupGraph:
+    logger = logging.getLogger("startup")
+
+    # Number of steps that run at the same time
+    max_workers: int = 8
+
+    def __init__(self):
+        self.steps: Dict[str, Tuple[Callable[[], Any], Tuple[str, ...]]] = {}
+        self.results: Dict[str, Any] = {}
+
+        # Start and end of every step in seconds since the start-up began
+        self.timings: Dict[str, Tuple[float, float]] = {}
+
+
+    # Add a step that runs once all the steps it comes after are done
+    def add(self, name: str, function: Callable[[], Any], after: Iterable[str] = ()):
+        if name in self.steps:
+            raise ValueError(f"Start-up step {name} is added twice")
+
+        self.steps[name] = (function, tuple(after))
+
+
+    # Get the return value of a finished step
+    def get(self, name: str) -> Any:
+        return self.results[name]
+
+
+    # Run all steps, the first failing step stops the start-up and its error is raised
+    def run(self) -> Dict[str, Any]:
+        self.check()
+
+        start = time.perf_counter()
+        pending = dict(self.steps)
+        running: Dict[Future, str] = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="startup") as executor:
+            while pending or running:
+                # Start every step whose dependencies are done
+                for name, (function, after) in list(pending.items()):
+                    if all(dependency in self.results for dependency in after):
+                        del pending[name]
+                        running[executor.submit(self.run_step, name, function, start)] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception:
+                        self.logger.error(f"Start-up step {name} failed, {len(pending)} steps not started")
+                        for other in running:
+                            other.cancel()
+                        raise
+
+        total = time.perf_counter() - start
+        metrics.set_gauge("startup.total_s", total)
+        self.report(total)
+        return self.results
+
+
+    # Run a step and record its timing
+    def run_step(self, name: str, function: Callable[[], Any], start: float) -> Any:
+        step_start = time.perf_counter() - start
+        try:
+            return function()
+        finally:
+            step_end = time.perf_counter() - start
+            self.timings[name] = (step_start, step_end)
+            metrics.set_gauge(f"startup.{name}_s", step_end - step_start)
+
+
+    # Check that every dependency exists and that there is no cycle
+    def check(self):
+        for name, (_, after) in self.steps.items():
+            missing = [dependency for dependency in after if dependency not in self.steps]
+            if missing:
+                raise ValueError(f"Start-up step {name} depends on unknown steps {missing}")
+
+        visited: Dict[str, bool] = {}  # False while the step is on the current path
+
+        def visit(name: str, path: List[str]):
+            if visited.get(name) is False:
+                raise ValueError(f"Start-up steps depend on each other: {' -> '.join(path + [name])}")
+            if name in visited:
+                return
+
+            visited[name] = False
+            for dependency in self.steps[name][1]:
+                visit(dependency, path + [name])
+            visited[name] = True
+
+        for name in self.steps:
+            visit(name, [])
+
+
+    # Log the timing of every step and the chain of steps that made the start-up take as long as it did
+    def report(self, total: float):
+        for name, (step_start, step_end) in sorted(self.timings.items(), key=lambda item: item[1][0]):
+            self.logger.info(f"{name:<32} {step_start:7.2f}s -> {step_end:7.2f}s ({step_end - step_start:.2f}s)")
+
+        # Walk back from the last step to finish through the dependency that finished last
+        path = []
+        name = max(self.timings, key=lambda step: self.timings[step][1], default=None)
+        while name is not None:
+            path.append(name)
+            after = self.steps[name][1]
+            name = max(after, key=lambda step: self.timings[step][1], default=None)
+
+        self.logger.info(f"Started in {total:.2f}s, slowest chain: {' -> '.join(reversed(path))}")
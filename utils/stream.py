@@ -1,4 +1,3 @@
-import os
 import logging
 import threading
 import subprocess
@@ -14,8 +13,9 @@ class Stream:
 
     logger = logging.getLogger("stream")
 
-    def __init__(self, pubsub: PubSub):
+    def __init__(self, pubsub: PubSub, channel: str):
         self.pubsub = pubsub
+        self.channel = channel
         self.stop_event = threading.Event()
         self.recording = threading.Event()
         
@@ -44,7 +44,7 @@ class Stream:
         try:
             # Run the streamlink command
             streamlink_process = subprocess.Popen(
-                ['streamlink', f"twitch.tv/{os.environ['target_channel']}", '480p', '--quiet', '--stdout', '--twitch-disable-ads', '--twitch-low-latency'],
+                ['streamlink', f"twitch.tv/{self.channel}", '480p', '--quiet', '--stdout', '--twitch-disable-ads', '--twitch-low-latency'],
                 stdout=subprocess.PIPE)
 
             # Process the stream
@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+
+import numpy as np
+
+from typing import List, Tuple
+
+from utils import metrics
+
+
+# Difference hash of a rgb frame: 64 bits telling if each cell of a 9x8 grayscale grid is brighter than its right neighbour
+def perceptual_hash(frame: np.ndarray, hash_size: int = 8) -> int:
+    gray = frame.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+    # Average the frame down to hash_size rows and hash_size + 1 columns
+    rows = np.linspace(0, gray.shape[0], hash_size + 1, dtype=int)
+    cols = np.linspace(0, gray.shape[1], hash_size + 2, dtype=int)
+    sums = np.add.reduceat(np.add.reduceat(gray, rows[:-1], axis=0), cols[:-1], axis=1)
+    small = sums / np.outer(np.diff(rows), np.diff(cols))
+
+    bits = small[:, 1:] > small[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+class VisionCache:
+    logger = logging.getLogger("vision_cache")
+
+    # Number of bits two frame hashes may differ by to count as the same scene,
+    # how long a scene description is reused and how many scenes are kept
+    max_distance: int = 8
+    ttl: float = 300
+    max_entries: int = 32
+
+    # Seconds a missed frame is remembered, a scene is only described when a close frame misses again within this time
+    stable_seconds: float = 120
+
+    def __init__(self):
+        # Described scenes as (frame hash, description, expiry time), newest last
+        self.entries: List[Tuple[int, str, float]] = []
+
+        # Frames that are being described right now
+        self.pending: List[int] = []
+
+        # Recent frames that had no description as (frame hash, time)
+        self.missed: List[Tuple[int, float]] = []
+
+        self.lock = threading.Lock()
+
+
+    # Number of differing bits of two hashes
+    @staticmethod
+    def distance(first: int, second: int) -> int:
+        return (first ^ second).bit_count()
+
+
+    # Get the description of the closest recent scene, None if no scene is close enough
+    def get(self, frame_hash: int) -> str | None:
+        now = time.monotonic()
+
+        with self.lock:
+            self.entries = [entry for entry in self.entries if entry[2] > now]
+
+            best_description, best_distance = None, self.max_distance + 1
+            for cached_hash, description, _ in self.entries:
+                distance = self.distance(frame_hash, cached_hash)
+                if distance < best_distance:
+                    best_description, best_distance = description, distance
+
+        if best_description is None:
+            metrics.increment("vision_cache.misses")
+        else:
+            metrics.increment("vision_cache.hits")
+            self.logger.debug(f"Frame matches a cached scene ({best_distance} bits apart)")
+
+        self.update_metrics()
+        return best_description
+
+
+    # Store the description of a frame
+    def set(self, frame_hash: int, description: str):
+        with self.lock:
+            self.entries.append((frame_hash, description, time.monotonic() + self.ttl))
+            del self.entries[:-self.max_entries]
+
+
+    # Claim the description of a frame, False if the scene is new or a close frame is already being described
+    # The request that took the screenshot of a new scene sees it already, describing a scene that is only seen once doubles the vision call
+    def claim(self, frame_hash: int) -> bool:
+        now = time.monotonic()
+
+        with self.lock:
+            if any(self.distance(frame_hash, pending) <= self.max_distance for pending in self.pending):
+                return False
+
+            self.missed = [(missed_hash, missed_at) for missed_hash, missed_at in self.missed if now - missed_at < self.stable_seconds]
+            if not any(self.distance(frame_hash, missed_hash) <= self.max_distance for missed_hash, _ in self.missed):
+                self.missed.append((frame_hash, now))
+                del self.missed[:-self.max_entries]
+                return False
+
+            self.pending.append(frame_hash)
+
+        metrics.increment("vision_cache.describe_calls")
+        self.update_metrics()
+        return True
+
+
+    # Release a claimed frame once it is described
+    def release(self, frame_hash: int):
+        with self.lock:
+            if frame_hash in self.pending:
+                self.pending.remove(frame_hash)
+
+
+    # Update the hit rate and the vision calls avoided, describing a scene costs a call itself
+    def update_metrics(self):
+        hits = metrics.get("vision_cache.hits")
+        lookups = hits + metrics.get("vision_cache.misses")
+        metrics.set_gauge("vision_cache.hit_rate", hits / lookups if lookups else 0.0)
+        metrics.set_gauge("vision_cache.vision_calls_avoided", hits - metrics.get("vision_cache.describe_calls"))